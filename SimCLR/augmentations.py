@@ -9,6 +9,8 @@ import torch
 from scipy.ndimage import rotate
 from sklearn.preprocessing import OneHotEncoder
 
+from SimCLR.utils.label_lut import LabelLUT
+
 
 def rotate_list(l_list):
     "Rotates list by -1"
@@ -105,12 +107,10 @@ class SimplifyTensor(object):
     """
 
     def __init__(self):
-        None
+        self.lut = LabelLUT({11: 0})
 
     def __call__(self, tensor):
-        arr = tensor.numpy()
-        arr[arr == 11] = 0
-        return torch.from_numpy(arr)
+        return self.lut(tensor)
 
 
 class OnlyBottomTensor(object):
@@ -118,12 +118,11 @@ class OnlyBottomTensor(object):
     """
 
     def __init__(self):
-        None
+        self.lut = LabelLUT.from_function(
+            lambda labels: labels * (labels == 30))
 
     def __call__(self, tensor):
-        arr = tensor.numpy()
-        arr = arr * (arr == 30)
-        return torch.from_numpy(arr)
+        return self.lut(tensor)
 
 
 class BinarizeTensor(object):
@@ -131,12 +130,11 @@ class BinarizeTensor(object):
     """
 
     def __init__(self):
-        None
+        self.lut = LabelLUT.from_function(
+            lambda labels: np.where(labels > 0, 1, labels))
 
     def __call__(self, tensor):
-        arr = tensor.numpy()
-        arr[arr > 0] = 1
-        return torch.from_numpy(arr)
+        return self.lut(tensor)
 
 
 class RotateTensor(object):
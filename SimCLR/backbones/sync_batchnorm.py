@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch normalization synchronized over processes on any device
+
+torch.nn.SyncBatchNorm only runs on GPU. CPUSyncBatchNorm computes the
+same batch statistics, over the batches of all processes, with
+torch.distributed all-reduces, so that it also runs with the gloo backend
+on CPU. Out of distributed training, and in eval mode, it is a plain
+BatchNorm.
+"""
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+class _AllReduceSum(torch.autograd.Function):
+    """Differentiable sum over the processes of the group"""
+
+    @staticmethod
+    def forward(ctx, tensor, group):
+        ctx.group = group
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, group=group)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output, group=ctx.group)
+        return grad_output, None
+
+
+class CPUSyncBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """BatchNorm whose batch statistics are those of all processes
+    """
+
+    def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True,
+                 track_running_stats=True, process_group=None):
+        super(CPUSyncBatchNorm, self).__init__(
+            num_features, eps, momentum, affine, track_running_stats)
+        self.process_group = process_group
+
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError(
+                f"expected at least 2D input (got {input.dim()}D input)")
+
+    def _need_sync(self):
+        return self.training and dist.is_available() \
+            and dist.is_initialized() \
+            and dist.get_world_size(self.process_group) > 1
+
+    def forward(self, input):
+        if not self._need_sync():
+            return super(CPUSyncBatchNorm, self).forward(input)
+        self._check_input_dim(input)
+
+        # Sums, sums of squares and counts of all processes
+        nb_channels = input.shape[1]
+        dims = [0] + list(range(2, input.dim()))
+        count = input.new_full([1], input.numel() // nb_channels)
+        stats = _AllReduceSum.apply(
+            torch.cat([input.sum(dims), (input * input).sum(dims), count]),
+            self.process_group)
+        total = stats[-1]
+        mean = stats[:nb_channels] / total
+        var = torch.clamp(stats[nb_channels:2 * nb_channels] / total
+                          - mean * mean, min=0.)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                if self.momentum is None:
+                    momentum = 1. / float(self.num_batches_tracked)
+                else:
+                    momentum = self.momentum
+                # Running variance is unbiased, as in BatchNorm
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                self.running_var.mul_(1 - momentum).add_(
+                    momentum * var * total / max(float(total) - 1, 1.))
+
+        shape = [1, nb_channels] + [1] * (input.dim() - 2)
+        out = (input - mean.view(shape)) \
+            * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            out = out * self.weight.view(shape) + self.bias.view(shape)
+        return out
+
+    @classmethod
+    def convert_sync_batchnorm(cls, module, process_group=None):
+        """Replaces the BatchNorm layers of module by CPUSyncBatchNorm
+
+        Same as torch.nn.SyncBatchNorm.convert_sync_batchnorm.
+
+        Returns:
+            the converted module
+        """
+        module_output = module
+        if isinstance(module, nn.modules.batchnorm._BatchNorm) \
+                and not isinstance(module, cls):
+            module_output = cls(module.num_features, module.eps,
+                                module.momentum, module.affine,
+                                module.track_running_stats, process_group)
+            if module.affine:
+                with torch.no_grad():
+                    module_output.weight = module.weight
+                    module_output.bias = module.bias
+            module_output.running_mean = module.running_mean
+            module_output.running_var = module.running_var
+            module_output.num_batches_tracked = module.num_batches_tracked
+            module_output.training = module.training
+        for name, child in module.named_children():
+            module_output.add_module(
+                name, cls.convert_sync_batchnorm(child, process_group))
+        del module
+        return module_output
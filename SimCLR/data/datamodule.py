@@ -5,37 +5,75 @@
 """
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader
+from torch.utils.data import DistributedSampler
 from torch.utils.data import RandomSampler
+from torch.utils.data import Subset
 
+from SimCLR.data.datasets import create_reference_set
 from SimCLR.data.datasets import create_sets
+from SimCLR.utils.cpu_parallel import node_partition
 
 
 class DataModule(pl.LightningDataModule):
     """Data module class
     """
 
-    def __init__(self, config):
+    def __init__(self, config, shared=None):
         super(DataModule, self).__init__()
         self.config = config
+        self.shared = shared
 
     def setup(self, stage=None, mode=None):
         self.dataset_train, self.dataset_val, self.dataset_test, _ = \
-            create_sets(self.config)
+            create_sets(self.config, shared=self.shared)
+
+    def sampler(self, dataset, shuffle):
+        """Returns the sampler of a dataset
+
+        In distributed training, each process samples its own shard
+        of the dataset; all shards have the same size.
+        """
+        if self.trainer is not None and self.trainer.world_size > 1:
+            return DistributedSampler(dataset,
+                                      num_replicas=self.trainer.world_size,
+                                      rank=self.trainer.global_rank,
+                                      shuffle=shuffle,
+                                      seed=self.config.seed)
+        return RandomSampler(dataset) if shuffle else None
+
+    def worker_init_fn(self):
+        """Returns the worker_init_fn of the loaders
+
+        When config.pin_cores is set on CPU, the loader workers
+        are pinned to the loader cores of their process.
+        """
+        if not self.config.get('pin_cores', False) \
+                or self.config.device != 'cpu' or self.trainer is None:
+            return None
+        partition = node_partition(
+            self.trainer.world_size // self.trainer.num_nodes,
+            self.config.get('loader_cores_per_process', 2))
+        return partition.worker_init_fn(self.trainer.local_rank)
 
     def train_dataloader(self):
         loader_train = DataLoader(self.dataset_train,
                                   batch_size=self.config.batch_size,
-                                  sampler=RandomSampler(self.dataset_train),
+                                  sampler=self.sampler(self.dataset_train,
+                                                       shuffle=True),
                                   pin_memory=self.config.pin_mem,
-                                  num_workers=self.config.num_cpu_workers
+                                  num_workers=self.config.num_cpu_workers,
+                                  worker_init_fn=self.worker_init_fn()
                                   )
         return loader_train
 
     def val_dataloader(self):
         loader_val = DataLoader(self.dataset_val,
                                 batch_size=self.config.batch_size,
+                                sampler=self.sampler(self.dataset_val,
+                                                     shuffle=False),
                                 pin_memory=self.config.pin_mem,
                                 num_workers=self.config.num_cpu_workers,
+                                worker_init_fn=self.worker_init_fn(),
                                 shuffle=False
                                 )
         return loader_val
@@ -54,14 +92,36 @@ class DataModule_Visualization(pl.LightningDataModule):
     """Data module class for visualization
     """
 
-    def __init__(self, config):
+    def __init__(self, config, shared=None):
         super(DataModule_Visualization, self).__init__()
         self.config = config
+        self.shared = shared
 
     def setup(self, stage, mode=None):
         self.dataset_train, self.dataset_val, self.dataset_test,\
             self.dataset_train_val = \
-            create_sets(self.config, mode='visualization')
+            create_sets(self.config, mode='visualization',
+                        shared=self.shared)
+        self.dataset_train_val_reference = \
+            create_reference_set(self.config, shared=self.shared)
+
+    def reference_dataloader(self, indices=None):
+        """Loader of the reference views only of the train/val subjects
+
+        Args:
+            indices (list of int): optional, restricts the loader
+                to these subjects of the train/val set
+        """
+        dataset = self.dataset_train_val_reference
+        if indices is not None:
+            dataset = Subset(dataset, indices)
+        loader_reference = DataLoader(dataset,
+                                      batch_size=self.config.batch_size,
+                                      pin_memory=self.config.pin_mem,
+                                      num_workers=self.config.num_cpu_workers,
+                                      shuffle=False
+                                      )
+        return loader_reference
 
     def train_val_dataloader(self):
         loader_train = DataLoader(self.dataset_train_val,
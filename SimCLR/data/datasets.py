@@ -23,6 +23,47 @@ _ALL_SUBJECTS = -1
 
 log = logging.getLogger(__name__)
 
+# Dataframes already read in this process, keyed by pickle path
+_pickle_cache = {}
+
+
+def read_pickle(pickle_file_path):
+    """Reads a pickle of crops only once per process
+
+    The dataframe is kept in memory, so that successive evaluations
+    (and processes forked afterwards) reuse the already loaded crops.
+    Dataframes must be considered as read-only.
+    """
+    pickle_file_path = os.path.abspath(pickle_file_path)
+    if pickle_file_path not in _pickle_cache:
+        _pickle_cache[pickle_file_path] = pd.read_pickle(pickle_file_path)
+    return _pickle_cache[pickle_file_path]
+
+
+def get_sample(dataframe, crops, idx):
+    """Returns the crop idx as a float32 tensor
+
+    The crop is read from the pre-padded array crops if it is given,
+    from the dataframe otherwise.
+    """
+    if crops is not None:
+        sample = crops[idx].astype('float32')
+    else:
+        sample = dataframe.loc[0].values[idx].astype('float32')
+    return torch.from_numpy(sample)
+
+
+def preprocessing_transforms(config, crops):
+    """Returns the deterministic first transforms (simplify and pad)
+
+    They are skipped when the crops are already simplified and padded.
+    """
+    if crops is not None:
+        return []
+    return [SimplifyTensor(),
+            PaddingTensor(config.input_size,
+                          fill_value=config.fill_value)]
+
 
 class ContrastiveDataset():
     """Custom dataset that includes image file paths.
@@ -30,14 +71,17 @@ class ContrastiveDataset():
     Applies different transformations to data depending on the type of input.
     """
 
-    def __init__(self, dataframe, filenames, config):
+    def __init__(self, dataframe, filenames, config, crops=None):
         """
         Args:
             data_tensor (tensor): contains MRIs as numpy arrays
             filenames (list of strings): list of subjects' IDs
             config (Omegaconf dict): contains configuration information
+            crops (array): optional, simplified and padded crops,
+                used instead of the dataframe
         """
         self.df = dataframe
+        self.crops = crops
         self.transform = True
         self.nb_train = len(filenames)
         log.info(self.nb_train)
@@ -58,8 +102,7 @@ class ContrastiveDataset():
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        sample = self.df.loc[0].values[idx].astype('float32')
-        sample = torch.from_numpy(sample)
+        sample = get_sample(self.df, self.crops, idx)
         filename = self.filenames[idx]
 
         # self.transform1 = transforms.Compose([
@@ -70,27 +113,23 @@ class ContrastiveDataset():
         #     RotateTensor(max_angle=self.config.max_angle)
         # ])
 
-        self.transform1 = transforms.Compose([
-            SimplifyTensor(),
-            PaddingTensor(self.config.input_size,
-                          fill_value=self.config.fill_value),
-            PartialCutOutTensor_Roll(from_skeleton=True,
-                                     patch_size=self.config.patch_size),
-            RotateTensor(max_angle=self.config.max_angle),
-            BinarizeTensor()
-        ])
+        self.transform1 = transforms.Compose(
+            preprocessing_transforms(self.config, self.crops) + [
+                PartialCutOutTensor_Roll(from_skeleton=True,
+                                         patch_size=self.config.patch_size),
+                RotateTensor(max_angle=self.config.max_angle),
+                BinarizeTensor()
+            ])
 
         # - padding
         # - + random rotation
-        self.transform2 = transforms.Compose([
-            SimplifyTensor(),
-            PaddingTensor(self.config.input_size,
-                          fill_value=self.config.fill_value),
-            PartialCutOutTensor_Roll(from_skeleton=False,
-                                     patch_size=self.config.patch_size),
-            RotateTensor(max_angle=self.config.max_angle),
-            BinarizeTensor()
-        ])
+        self.transform2 = transforms.Compose(
+            preprocessing_transforms(self.config, self.crops) + [
+                PartialCutOutTensor_Roll(from_skeleton=False,
+                                         patch_size=self.config.patch_size),
+                RotateTensor(max_angle=self.config.max_angle),
+                BinarizeTensor()
+            ])
 
         view1 = self.transform1(sample)
         view2 = self.transform2(sample)
@@ -107,14 +146,17 @@ class ContrastiveDataset_Visualization():
     Applies different transformations to data depending on the type of input.
     """
 
-    def __init__(self, dataframe, filenames, config):
+    def __init__(self, dataframe, filenames, config, crops=None):
         """
         Args:
             data_tensor (tensor): contains MRIs as numpy arrays
             filenames (list of strings): list of subjects' IDs
             config (Omegaconf dict): contains configuration information
+            crops (array): optional, simplified and padded crops,
+                used instead of the dataframe
         """
         self.df = dataframe
+        self.crops = crops
         self.transform = True
         self.nb_train = len(filenames)
         log.info(self.nb_train)
@@ -135,17 +177,14 @@ class ContrastiveDataset_Visualization():
         """
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        sample = self.df.loc[0].values[idx].astype('float32')
-        sample = torch.from_numpy(sample)
+        sample = get_sample(self.df, self.crops, idx)
         filename = self.filenames[idx]
 
-        self.transform1 = transforms.Compose([
-            SimplifyTensor(),
-            PaddingTensor(self.config.input_size,
-                          fill_value=self.config.fill_value),
-            BinarizeTensor(),
-            EndTensor()
-        ])
+        self.transform1 = transforms.Compose(
+            preprocessing_transforms(self.config, self.crops) + [
+                BinarizeTensor(),
+                EndTensor()
+            ])
         # self.transform1 = transforms.Compose([
         #     SimplifyTensor(),
         #     PaddingTensor(self.config.input_size,
@@ -158,15 +197,13 @@ class ContrastiveDataset_Visualization():
 
         # - padding
         # - + random rotation
-        self.transform2 = transforms.Compose([
-            SimplifyTensor(),
-            PaddingTensor(self.config.input_size,
-                          fill_value=self.config.fill_value),
-            PartialCutOutTensor_Roll(from_skeleton=False,
-                                     patch_size=self.config.patch_size),
-            RotateTensor(max_angle=self.config.max_angle),
-            BinarizeTensor()
-        ])
+        self.transform2 = transforms.Compose(
+            preprocessing_transforms(self.config, self.crops) + [
+                PartialCutOutTensor_Roll(from_skeleton=False,
+                                         patch_size=self.config.patch_size),
+                RotateTensor(max_angle=self.config.max_angle),
+                BinarizeTensor()
+            ])
 
         view1 = self.transform1(sample)
         view2 = self.transform2(sample)
@@ -177,27 +214,26 @@ class ContrastiveDataset_Visualization():
         return tuple_with_path
 
 
-def create_sets(config, mode='training'):
-    """Creates train, validation and test sets
+def select_subjects(config):
+    """Selects the train/val and test subjects and their crops
 
     Args:
         config (Omegaconf dict): contains configuration parameters
-        mode (str): either 'training' or 'visualization'
     Returns:
-        train_set, val_set, test_set (tuple)
+        train_val_subjects, train_val_data, test_subjects, test_data (tuple)
     """
 
     # Loads crops from all subjects
     pickle_file_path = config.pickle_normal
     log.info("Current directory = " + os.getcwd())
-    normal_data = pd.read_pickle(pickle_file_path)
+    normal_data = read_pickle(pickle_file_path)
     print(normal_data.head())
     normal_subjects = normal_data.columns.tolist()
 
     # Loads benchmarks (crops from another region) from all subjects
     if config.pickle_benchmark:
         pickle_benchmark_path = config.pickle_benchmark
-        benchmark_data = pd.read_pickle(pickle_benchmark_path)
+        benchmark_data = read_pickle(pickle_benchmark_path)
 
     # Gets train_val subjects from csv file
     train_val_subjects = pd.read_csv(config.train_val_csv_file, names=['ID']).T
@@ -253,6 +289,103 @@ def create_sets(config, mode='training'):
         train_val_data = normal_data[normal_data.columns.intersection(
             train_val_subjects)]
 
+    return train_val_subjects, train_val_data, test_subjects, test_data
+
+
+class ContrastiveDataset_Reference():
+    """Dataset returning only the reference view of each subject
+
+    The reference view is deterministic (only simplification, padding
+    and binarization are applied), so that it can be computed once
+    and reused by all evaluations.
+    """
+
+    def __init__(self, dataframe, filenames, config, crops=None,
+                 references=None):
+        """
+        Args:
+            dataframe: contains MRIs as numpy arrays
+            filenames (list of strings): list of subjects' IDs
+            config (Omegaconf dict): contains configuration information
+            crops (array): optional, simplified and padded crops,
+                used instead of the dataframe
+            references (array): optional, already computed reference views
+                of size [N_subjects, 1, size_X, size_Y, size_Z]
+        """
+        self.df = dataframe
+        self.crops = crops
+        self.references = references
+        self.nb_train = len(filenames)
+        self.filenames = filenames
+        self.config = config
+        self.transform = transforms.Compose(
+            preprocessing_transforms(self.config, self.crops) + [
+                BinarizeTensor(),
+                EndTensor()
+            ])
+
+    def __len__(self):
+        return (self.nb_train)
+
+    def __getitem__(self, idx):
+        """Returns the reference view corresponding to index idx
+
+        Returns:
+            tuple of (views, subject ID), views being of size
+            [1, 1, size_X, size_Y, size_Z]
+        """
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        if self.references is not None:
+            view = torch.from_numpy(self.references[idx].astype('float32'))
+        else:
+            view = self.transform(get_sample(self.df, self.crops, idx))
+        return (view.unsqueeze(0), self.filenames[idx])
+
+
+def create_reference_set(config, shared=None):
+    """Creates the reference-view dataset of the train/val subjects
+
+    Args:
+        config (Omegaconf dict): contains configuration parameters
+        shared (SharedCrops): optional, already loaded crops;
+            its cached reference views are then used
+    """
+    if shared is None:
+        train_val_subjects, train_val_data, _, _ = select_subjects(config)
+        return ContrastiveDataset_Reference(
+            filenames=train_val_subjects,
+            dataframe=train_val_data,
+            config=config)
+    return ContrastiveDataset_Reference(
+        filenames=shared.train_val_subjects,
+        dataframe=None,
+        config=config,
+        references=shared.reference_views())
+
+
+def create_sets(config, mode='training', shared=None):
+    """Creates train, validation and test sets
+
+    Args:
+        config (Omegaconf dict): contains configuration parameters
+        mode (str): either 'training' or 'visualization'
+        shared (SharedCrops): optional, already loaded and split crops;
+            if given, the pickle files are not read again
+    Returns:
+        train_set, val_set, test_set (tuple)
+    """
+    if shared is None:
+        train_val_subjects, train_val_data, test_subjects, test_data = \
+            select_subjects(config)
+        train_val_crops = None
+    else:
+        train_val_subjects = shared.train_val_subjects
+        train_val_data = None
+        train_val_crops = shared.train_val_crops
+        test_subjects = shared.test_subjects
+        test_data = shared.test_data
+
     # Creates the dataset from these tensors by doing some preprocessing
     if mode == 'visualization':
         test_dataset = ContrastiveDataset_Visualization(
@@ -262,7 +395,8 @@ def create_sets(config, mode='training'):
         train_val_dataset = ContrastiveDataset_Visualization(
             filenames=train_val_subjects,
             dataframe=train_val_data,
-            config=config)
+            config=config,
+            crops=train_val_crops)
     else:
         test_dataset = ContrastiveDataset(
             filenames=test_subjects,
@@ -271,18 +405,25 @@ def create_sets(config, mode='training'):
         train_val_dataset = ContrastiveDataset(
             filenames=train_val_subjects,
             dataframe=train_val_data,
-            config=config)
+            config=config,
+            crops=train_val_crops)
     log.info(f"Length of test data set: {len(test_dataset)}")
     log.info(
         f"Length of complete train/val data set: {len(train_val_dataset)}")
 
     # Split training/val set into train, val set
-    partition = config.partition
-
-    log.info([round(i * (len(train_val_dataset))) for i in partition])
-    np.random.seed(1)
-    train_set, val_set = torch.utils.data.random_split(
-        train_val_dataset,
-        [round(i * (len(train_val_dataset))) for i in partition])
+    if shared is None:
+        partition = config.partition
+
+        log.info([round(i * (len(train_val_dataset))) for i in partition])
+        np.random.seed(1)
+        train_set, val_set = torch.utils.data.random_split(
+            train_val_dataset,
+            [round(i * (len(train_val_dataset))) for i in partition])
+    else:
+        train_set = torch.utils.data.Subset(train_val_dataset,
+                                            shared.train_indices)
+        val_set = torch.utils.data.Subset(train_val_dataset,
+                                          shared.val_indices)
 
     return train_set, val_set, test_dataset, train_val_dataset
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Crops loaded once and shared by all evaluations of a sweep
+
+The train/val crops are simplified and padded once into a single array,
+optionally memory-mapped from a cache directory. The subjects are
+selected and split once, so that all checkpoint evaluations read
+exactly the same data; only the model weights change between them.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+from SimCLR.augmentations import BinarizeTensor
+from SimCLR.augmentations import PaddingTensor
+from SimCLR.augmentations import SimplifyTensor
+from SimCLR.data.datasets import select_subjects
+
+log = logging.getLogger(__name__)
+
+
+def data_key(config):
+    """Returns a key identifying the crops selected by a configuration
+
+    Two configurations with the same key share the same SharedCrops.
+    """
+    def file_id(path):
+        if not path:
+            return None
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime]
+
+    description = {
+        "pickle_normal": file_id(config.pickle_normal),
+        "pickle_benchmark": file_id(config.pickle_benchmark),
+        "train_val_csv_file": file_id(config.train_val_csv_file),
+        "nb_subjects": config.nb_subjects,
+        "input_size": list(config.input_size),
+        "fill_value": config.fill_value,
+        "partition": list(config.partition)}
+    return hashlib.sha1(
+        json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def _save(path, array):
+    """Saves an array atomically
+
+    The array is written to a temporary file of this process, then
+    renamed, so that no reader sees a partially written file.
+    """
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file, path)
+
+
+class SharedCrops():
+    """Train/val crops simplified, padded and split once
+    """
+
+    def __init__(self, config, cache_dir=None):
+        """
+        Args:
+            config (Omegaconf dict): processed configuration
+            cache_dir (str): optional, directory where the padded crops
+                are saved and memory-mapped from. If None, the padded
+                crops are kept in memory.
+        """
+        self.key = data_key(config)
+        self.cache_dir = cache_dir
+        self.references = None
+        self.train_val_subjects, train_val_data, \
+            self.test_subjects, self.test_data = select_subjects(config)
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_file = os.path.join(cache_dir,
+                                      f"train_val_crops_{self.key}.npy")
+            if not os.path.isfile(cache_file):
+                _save(cache_file, self.pad_crops(train_val_data, config))
+            self.train_val_crops = np.load(cache_file, mmap_mode='r')
+        else:
+            self.train_val_crops = self.pad_crops(train_val_data, config)
+        log.info(f"Shared train/val crops: {self.train_val_crops.shape}")
+
+        # Same split as random_split in create_sets,
+        # but drawn once for all evaluations
+        nb_train_val = len(self.train_val_subjects)
+        train_set, val_set = torch.utils.data.random_split(
+            range(nb_train_val),
+            [round(i * nb_train_val) for i in config.partition])
+        self.train_indices = list(train_set.indices)
+        self.val_indices = list(val_set.indices)
+
+    def reference_views(self):
+        """Returns the binarized reference views of the train/val crops
+
+        They are computed on first call, and saved in the cache directory
+        if there is one.
+
+        Returns:
+            uint8 array of size [N_subjects, 1, size_X, size_Y, size_Z]
+        """
+        if self.references is None:
+            cache_file = None
+            if self.cache_dir:
+                cache_file = os.path.join(
+                    self.cache_dir, f"train_val_references_{self.key}.npy")
+            if cache_file and os.path.isfile(cache_file):
+                self.references = np.load(cache_file, mmap_mode='r')
+            else:
+                # The label table binarizes all crops at once;
+                # the channel axis is then moved first, as EndTensor does
+                crops = np.asarray(self.train_val_crops)
+                references = BinarizeTensor()(crops).astype(np.uint8)
+                references = np.ascontiguousarray(
+                    np.moveaxis(references, -1, 1))
+                if cache_file:
+                    _save(cache_file, references)
+                    references = np.load(cache_file, mmap_mode='r')
+                self.references = references
+        return self.references
+
+    def __getstate__(self):
+        """Pickles memory-mapped arrays as their file name
+
+        so that spawned workers reopen the cache instead of copying it.
+        """
+        state = self.__dict__.copy()
+        for name in ('train_val_crops', 'references'):
+            if isinstance(state[name], np.memmap):
+                state[name] = ('memmap', state[name].filename)
+        return state
+
+    def __setstate__(self, state):
+        for name in ('train_val_crops', 'references'):
+            if isinstance(state[name], tuple):
+                state[name] = np.load(state[name][1], mmap_mode='r')
+        self.__dict__.update(state)
+
+    @staticmethod
+    def pad_crops(dataframe, config):
+        """Simplifies and pads all crops of the dataframe
+
+        Returns:
+            array of size [N_subjects, size_X, size_Y, size_Z, 1];
+            uint8 if all values fit, float32 otherwise
+        """
+        simplify = SimplifyTensor()
+        padding = PaddingTensor(config.input_size,
+                                fill_value=config.fill_value)
+        samples = dataframe.loc[0].values
+        crops = np.stack([
+            padding(simplify(torch.from_numpy(
+                sample.astype('float32')))).numpy()
+            for sample in samples])
+        if crops.min() >= 0 and crops.max() <= 255 \
+                and np.array_equal(crops, np.round(crops)):
+            crops = crops.astype(np.uint8)
+        return crops
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bounded cache of the views given to the model
+
+The embedding loops can keep the exact views they embedded, so that
+neighbour plots display them instead of drawing new augmentations.
+Binary views are stored bit-packed (1 bit per voxel).
+"""
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class ViewCache():
+    """Least-recently-used cache of views, keyed by embedding row
+    """
+
+    def __init__(self, max_items=10000, keys=None):
+        """
+        Args:
+            max_items (int): maximum number of views kept;
+                the least recently used views are dropped first
+            keys (list): optional, key of each embedding row, when the
+                embedded loader only covers some rows of the plotted
+                embeddings; by default, the key is the row
+        """
+        self.max_items = max_items
+        self.keys = keys
+        self.views = OrderedDict()
+
+    def __len__(self):
+        return len(self.views)
+
+    def __contains__(self, key):
+        return key in self.views
+
+    def put(self, key, view):
+        """Stores a view (tensor or array), bit-packed if it is binary"""
+        if torch.is_tensor(view):
+            view = view.detach().cpu().numpy()
+        if np.isin(view, (0, 1)).all():
+            stored = (np.packbits(view.astype(bool)), view.shape, view.dtype)
+        else:
+            stored = (view.copy(), view.shape, None)
+        self.views[key] = stored
+        self.views.move_to_end(key)
+        while len(self.views) > self.max_items:
+            self.views.popitem(last=False)
+
+    def put_batch(self, first_key, inputs):
+        """Stores the views of a batch [batch_size, nb_views, ...]
+
+        Keys follow the rows of the embeddings: subject by subject,
+        then view by view, starting at row first_key.
+        """
+        nb_views = inputs.shape[1]
+        inputs = inputs.detach().cpu()
+        for subject in range(inputs.shape[0]):
+            for view in range(nb_views):
+                row = first_key + subject * nb_views + view
+                key = row if self.keys is None else self.keys[row]
+                self.put(key, inputs[subject, view])
+
+    def get(self, key):
+        """Returns the view as a tensor"""
+        stored, shape, dtype = self.views[key]
+        self.views.move_to_end(key)
+        if dtype is not None:
+            view = np.unpackbits(stored, count=int(np.prod(shape)))
+            view = view.reshape(shape).astype(dtype)
+        else:
+            view = stored
+        return torch.from_numpy(view)
@@ -6,22 +6,53 @@ import json
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn import metrics
 from sklearn.cluster import AffinityPropagation
-from sklearn.cluster import DBSCAN
 from sklearn.cluster import KMeans
 from sklearn.cluster import SpectralClustering
 from sklearn.manifold import TSNE
-from sklearn.metrics import silhouette_samples
-from sklearn.metrics import silhouette_score
+
+from SimCLR.evaluation.dbscan_sweep import dbscan_eps_sweep
+from SimCLR.evaluation.silhouette import silhouette_samples
+from SimCLR.evaluation.silhouette import silhouette_score_sampled
 
 
 class Cluster():
 
-    def __init__(self, X, root_dir):
+    def __init__(self, X, root_dir, sample_size=None):
+        """
+        Args:
+            X (array): embeddings of size [N_subjects, N_features]
+            root_dir (str): directory where plots are saved
+            sample_size (int or None): if the number of subjects is larger,
+                silhouette scores are estimated on a stratified subsample
+        """
         self.n_clusters_list = [2, 3, 4, 5, 6, 7, 8, 9, 10]
         self.x = X
         self.dir = root_dir
+        self.sample_size = sample_size
+
+    def silhouette(self, cluster_labels):
+        """Computes the silhouette score and the per-sample values
+
+        Returns:
+            tuple (score, sample values, labels of the samples)
+        """
+        if self.sample_size is None or len(self.x) <= self.sample_size:
+            sample_silhouette_values = silhouette_samples(
+                self.x, cluster_labels)
+            return (np.mean(sample_silhouette_values),
+                    sample_silhouette_values,
+                    cluster_labels)
+        score, lower, upper, rows, sample_silhouette_values = \
+            silhouette_score_sampled(self.x, cluster_labels,
+                                     sample_size=self.sample_size,
+                                     random_state=0,
+                                     return_samples=True)
+        print(f"Silhouette estimated on {len(rows)} subjects, "
+              f"95% confidence interval = [{lower}, {upper}]")
+        return (score,
+                sample_silhouette_values,
+                np.asarray(cluster_labels)[rows])
 
     def plot_silhouette(self):
         """
@@ -54,32 +85,28 @@ class Cluster():
                 n_clusters=n,
                 random_state=0).fit_predict(
                 self.x)
-            res_silhouette['kmeans'][n] = str(
-                metrics.silhouette_score(
-                    self.x, cluster_labels))
+            # Compute the silhouette scores for each sample
+            silhouette_avg, sample_silhouette_values, sample_labels = \
+                self.silhouette(cluster_labels)
+            res_silhouette['kmeans'][n] = str(silhouette_avg)
 
             fig, ax1 = plt.subplots()
             # The (n_clusters+1)*10 is for inserting blank space
             # between silhouette plots of individual clusters,
             # to demarcate them clearly.
             ax1.set_ylim([0, len(self.x) + (n + 1) * 10])
-            silhouette_avg = silhouette_score(self.x, cluster_labels)
             print(
                 "For n_clusters =",
                 n,
                 "The average silhouette_score with kmeans is :",
                 silhouette_avg)
 
-            # Compute the silhouette scores for each sample
-            sample_silhouette_values = silhouette_samples(
-                self.x, cluster_labels)
-
             y_lower = 10
             for i in range(n):
                 # Aggregate the silhouette scores for samples belonging to
                 # cluster i, and sort them
                 ith_cluster_silhouette_values = sorted(
-                    sample_silhouette_values[cluster_labels == i])
+                    sample_silhouette_values[sample_labels == i])
 
                 size_cluster_i = len(ith_cluster_silhouette_values)
                 y_upper = y_lower + size_cluster_i
@@ -124,14 +151,14 @@ class Cluster():
             print(n_clusters_)
 
         if n_clusters_ > 1:
+            silhouette_avg, _, _ = self.silhouette(x_cluster_label)
             res_silhouette['AffinityPropagation'][n_clusters_] = str(
-                metrics.silhouette_score(self.x, x_cluster_label))
+                silhouette_avg)
             fig2, ax2 = plt.subplots()
             # The (n_clusters+1)*10 is for inserting blank space
             # between silhouette plots of individual clusters,
             # to demarcate them clearly.
             ax2.set_ylim([0, len(self.x) + (n_clusters_ + 1) * 10])
-            silhouette_avg = silhouette_score(self.x, x_cluster_label)
             print(
                 "For n_clusters =",
                 n_clusters_,
@@ -139,15 +166,15 @@ class Cluster():
                 silhouette_avg)
 
             # Compute the silhouette scores for each sample
-            sample_silhouette_values = silhouette_samples(
-                self.x, cluster_labels)
+            _, sample_silhouette_values, sample_labels = \
+                self.silhouette(cluster_labels)
 
             y_lower = 10
             for i in range(n_clusters_):
                 # Aggregate the silhouette scores for samples belonging to
                 # cluster i, and sort them
                 ith_cluster_silhouette_values = sorted(
-                    sample_silhouette_values[cluster_labels == i])
+                    sample_silhouette_values[sample_labels == i])
 
                 size_cluster_i = len(ith_cluster_silhouette_values)
                 y_upper = y_lower + size_cluster_i
@@ -181,35 +208,34 @@ class Cluster():
             plt.savefig(f"{self.dir}/AffinityPropagation_silhouette.png")
 
         eps_list = [1.0, 1.5, 1.8, 2.0, 2.2, 2.5, 3.0]
+        dbscan_labels = dbscan_eps_sweep(self.x, eps_list)
         for idx, eps in enumerate(eps_list):
-            cluster_labels = DBSCAN(eps=eps).fit_predict(self.x)
+            cluster_labels = dbscan_labels[eps]
             # print(f"cluster labels = {cluster_labels}")
             if not all([label == 0 for label in cluster_labels]):
-                res_silhouette['dbscan'][idx] = str(
-                    metrics.silhouette_score(self.x, cluster_labels))
+                # Compute the silhouette scores for each sample
+                dbscan_avg, sample_silhouette_values, sample_labels = \
+                    self.silhouette(cluster_labels)
+                res_silhouette['dbscan'][idx] = str(dbscan_avg)
 
                 fig3, ax3 = plt.subplots()
                 # The (n_clusters+1)*10 is for inserting blank space
                 # between silhouette plots of individual clusters,
                 # to demarcate them clearly.
                 ax3.set_ylim([0, len(self.x) + (n_clusters_ + 1) * 10])
-                silhouette_avg = silhouette_score(self.x, x_cluster_label)
+                silhouette_avg, _, _ = self.silhouette(x_cluster_label)
                 print(
                     "For eps =",
                     eps,
                     "The average silhouette_score with dbscan is :",
                     silhouette_avg)
 
-                # Compute the silhouette scores for each sample
-                sample_silhouette_values = silhouette_samples(
-                    self.x, cluster_labels)
-
                 y_lower = 10
                 for i in range(n_clusters_):
                     # Aggregate the silhouette scores for samples belonging to
                     # cluster i, and sort them
                     ith_cluster_silhouette_values = sorted(
-                        sample_silhouette_values[cluster_labels == i])
+                        sample_silhouette_values[sample_labels == i])
 
                     size_cluster_i = len(ith_cluster_silhouette_values)
                     y_upper = y_lower + size_cluster_i
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" DBSCAN clusterings for a whole grid of eps values
+
+The radius-neighbour graph is built once at the largest eps.
+Each smaller eps reuses this graph after filtering out the edges longer
+than eps, and DBSCAN is run on the precomputed sparse distance matrix.
+"""
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+log = logging.getLogger(__name__)
+
+
+class DBSCANSweep():
+    """Shares one radius-neighbour graph between several DBSCAN fits
+    """
+
+    def __init__(self, X, max_eps, min_samples=5):
+        """
+        Args:
+            X (array): embeddings of size [N_subjects, N_features]
+            max_eps (float): largest eps of the sweep
+            min_samples (int): DBSCAN min_samples parameter
+        """
+        self.x = X
+        self.max_eps = max_eps
+        self.min_samples = min_samples
+        self.graph = None
+
+    def build_graph(self):
+        """Computes the radius-neighbour graph at max_eps
+
+        Self-distances are kept as explicit zeros,
+        as DBSCAN counts each point as its own neighbour.
+        """
+        nbrs = NearestNeighbors(radius=self.max_eps).fit(self.x)
+        self.graph = nbrs.radius_neighbors_graph(self.x, mode='distance')
+        log.info(f"Radius-neighbour graph at eps = {self.max_eps}: "
+                 f"{self.graph.nnz} edges")
+        return self.graph
+
+    def graph_at(self, eps):
+        """Returns the sparse distance graph restricted to edges <= eps
+        """
+        if eps > self.max_eps:
+            raise ValueError(
+                f"eps = {eps} is larger than max_eps = {self.max_eps}")
+        if self.graph is None:
+            self.build_graph()
+
+        graph = self.graph
+        keep = graph.data <= eps
+        rows = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+        indptr = np.zeros(graph.shape[0] + 1, dtype=graph.indptr.dtype)
+        np.cumsum(np.bincount(rows[keep], minlength=graph.shape[0]),
+                  out=indptr[1:])
+        return csr_matrix((graph.data[keep], graph.indices[keep], indptr),
+                          shape=graph.shape)
+
+    def fit_predict(self, eps):
+        """Returns the DBSCAN labels for the given eps
+
+        The labels are the same as DBSCAN(eps=eps).fit_predict(X)
+        """
+        return DBSCAN(eps=eps,
+                      min_samples=self.min_samples,
+                      metric='precomputed').fit_predict(self.graph_at(eps))
+
+    def sweep(self, eps_list):
+        """Returns a dictionary {eps: labels} for each eps of eps_list
+        """
+        return {eps: self.fit_predict(eps) for eps in eps_list}
+
+
+def dbscan_eps_sweep(X, eps_list, min_samples=5):
+    """Computes DBSCAN labels for each eps of eps_list
+
+    Args:
+        X (array): embeddings of size [N_subjects, N_features]
+        eps_list (list of float): eps values of the sweep
+        min_samples (int): DBSCAN min_samples parameter
+
+    Returns:
+        dictionary {eps: labels}
+    """
+    sweep = DBSCANSweep(X, max_eps=max(eps_list), min_samples=min_samples)
+    return sweep.sweep(eps_list)
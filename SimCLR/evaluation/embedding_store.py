@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Persistent store of subject embeddings
+
+A store is a directory containing:
+- embeddings.f32: float32 matrix [N_subjects, latent_size], row-major,
+  read through a memory map and extended by appending rows
+- subjects.json: subject IDs, in row order
+- metadata.json: latent size, hash of the checkpoint, temperature
+  and any other information on the model
+
+New subjects can be appended without recomputing the stored ones.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+_EMBEDDINGS_FILE = "embeddings.f32"
+_SUBJECTS_FILE = "subjects.json"
+_METADATA_FILE = "metadata.json"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns the sha1 of a file, used to identify a checkpoint"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _write_json(path, obj):
+    """Writes a json file atomically"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore():
+    """Subject-indexed embeddings saved on disk
+    """
+
+    def __init__(self, path, latent_size=None, checkpoint_hash=None,
+                 temperature=None, on_mismatch='raise', **metadata):
+        """Opens the store at path, or creates it
+
+        Args:
+            path (str): directory of the store
+            latent_size (int): size of the embeddings;
+                may be omitted to open an existing store
+            checkpoint_hash (str): identifies the model that computed
+                the embeddings (see file_hash); if omitted,
+                an existing store is opened whatever its checkpoint
+            temperature (float): temperature of the contrastive loss, if any
+            on_mismatch (str): what to do if the existing store has been
+                computed with another model: 'raise' or 'reset'
+            metadata: other information saved in metadata.json
+        """
+        self.path = path
+        self.metadata = dict(metadata,
+                             latent_size=latent_size,
+                             checkpoint_hash=checkpoint_hash,
+                             temperature=temperature)
+        metadata_file = os.path.join(path, _METADATA_FILE)
+
+        if os.path.isfile(metadata_file):
+            with open(metadata_file, 'r') as f:
+                stored = json.load(f)
+            mismatch = [key for key in ('latent_size', 'checkpoint_hash')
+                        if self.metadata[key] is not None
+                        and stored.get(key) != self.metadata[key]]
+            if mismatch and on_mismatch == 'reset':
+                log.info(f"Embedding store {path} reset: "
+                         f"{mismatch} changed")
+                shutil.rmtree(path)
+            elif mismatch:
+                raise ValueError(
+                    f"Embedding store {path} has been computed with "
+                    f"different {mismatch}")
+
+        if not os.path.isfile(metadata_file):
+            if latent_size is None:
+                raise ValueError(
+                    f"latent_size is needed to create the store {path}")
+            os.makedirs(path, exist_ok=True)
+            open(os.path.join(path, _EMBEDDINGS_FILE), 'wb').close()
+            _write_json(os.path.join(path, _SUBJECTS_FILE), [])
+            _write_json(metadata_file, self.metadata)
+        else:
+            self.metadata = stored
+            self.metadata.update(metadata)
+
+        with open(os.path.join(path, _SUBJECTS_FILE), 'r') as f:
+            self.subjects = json.load(f)
+        self.index = {subject: row for row, subject
+                      in enumerate(self.subjects)}
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __contains__(self, subject):
+        return subject in self.index
+
+    @property
+    def latent_size(self):
+        return self.metadata['latent_size']
+
+    @property
+    def embeddings(self):
+        """Read-only memory map of all embeddings"""
+        if not self.subjects:
+            return np.zeros((0, self.latent_size), dtype=np.float32)
+        return np.memmap(os.path.join(self.path, _EMBEDDINGS_FILE),
+                         dtype=np.float32, mode='r',
+                         shape=(len(self.subjects), self.latent_size))
+
+    def missing(self, subjects):
+        """Returns the subjects that are not yet in the store"""
+        return [subject for subject in subjects if subject not in self.index]
+
+    def append(self, subjects, embeddings):
+        """Appends the embeddings of new subjects
+
+        Subjects already in the store are skipped.
+
+        Args:
+            subjects (list of str): subject IDs
+            embeddings (array): embeddings of size [len(subjects), latent_size]
+
+        Returns:
+            number of added subjects
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.shape != (len(subjects), self.latent_size):
+            raise ValueError(
+                f"Embeddings of shape {embeddings.shape} do not match "
+                f"{len(subjects)} subjects of latent size {self.latent_size}")
+        rows = []
+        new_subjects = []
+        for row, subject in enumerate(subjects):
+            if subject not in self.index and subject not in new_subjects:
+                rows.append(row)
+                new_subjects.append(subject)
+        if not new_subjects:
+            return 0
+
+        # Rows are written after the last indexed subject,
+        # so that an interrupted append leaves the store consistent
+        row_bytes = self.latent_size * embeddings.itemsize
+        with open(os.path.join(self.path, _EMBEDDINGS_FILE), 'r+b') as f:
+            f.seek(len(self.subjects) * row_bytes)
+            f.write(np.ascontiguousarray(embeddings[rows]).tobytes())
+            f.truncate()
+
+        for subject in new_subjects:
+            self.index[subject] = len(self.subjects)
+            self.subjects.append(subject)
+        _write_json(os.path.join(self.path, _SUBJECTS_FILE), self.subjects)
+        return len(new_subjects)
+
+    def get(self, subjects):
+        """Returns the embeddings of the given subject IDs
+
+        Returns:
+            array of size [len(subjects), latent_size]
+        """
+        unknown = self.missing(subjects)
+        if unknown:
+            raise KeyError(f"Subjects not in the store: {unknown[:10]}")
+        rows = [self.index[subject] for subject in subjects]
+        return np.array(self.embeddings[rows])
@@ -9,21 +9,31 @@
 ######################################################################
 import itertools
 import os
+import shutil
 import time
 
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.stats as stat
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
 import torchvision as tv
 import torchvision.transforms as transforms
-from torch.autograd import Variable
+from torch.utils.data import DataLoader
+from torch.utils.data import Subset
 from torchvision.utils import save_image
 import pytorch_ssim
 # https://github.com/jinh0park/pytorch-ssim-3D
 
+from SimCLR.evaluation.outliers import print_outliers
+from SimCLR.utils.snapshots import SnapshotWriter
+
+# Subjects not evaluated by default
+EXCLUDED_SUBJECTS = frozenset(['681998875857',
+                               '855494225893',
+                               '927090337769',
+                               '716588902839'])
+
 
 def plot_loss(list_loss_train, list_loss_val, root_dir):
     """
@@ -182,120 +192,199 @@ def plot_auc(auc_dict, nb_epoch, root_dir):
     fig.savefig(root_dir + "auc_trajectories.png")
 
 
-def compute_loss(dico_set_loaders, model, loss_type, root_dir):
+def box_filter_3d(volume, size=11):
+    """
+    Returns the sum of the values of each size**3 cube centered on each voxel
+    volume: tensor of size [N_batch, N_channels, size_X, size_Y, size_Z]
+    size: odd width of the cube
+    The volume is zero-padded, as F.conv3d with a ones kernel and
+    padding=size//2, but the cube sum is done by three 1D sums:
+    3*size operations per voxel instead of size**3.
+    """
+    nb_channels = volume.shape[1]
+    out = volume
+    for axis in range(3):
+        kernel_shape = [1, 1, 1]
+        kernel_shape[axis] = size
+        padding = [0, 0, 0]
+        padding[axis] = size // 2
+        weight = torch.ones([nb_channels, 1] + kernel_shape,
+                            device=volume.device, dtype=volume.dtype)
+        out = F.conv3d(out, weight, padding=padding, groups=nb_channels)
+    return out
+
+
+def _get_device():
+    """Returns the first GPU if any, else the CPU"""
+    if torch.cuda.is_available():
+        return torch.device("cuda", index=0)
+    return torch.device("cpu")
+
+
+def _subject_ids(dataset):
+    """Returns the IDs of the subjects of a dataset, or of a Subset of it"""
+    if isinstance(dataset, Subset):
+        ids = _subject_ids(dataset.dataset)
+        return [ids[idx] for idx in dataset.indices]
+    return list(dataset.filenames)
+
+
+def exclude_subjects(loader, excluded=EXCLUDED_SUBJECTS):
+    """
+    Returns a dataloader without the excluded subjects
+    loader: dataloader whose dataset has the IDs of its subjects in
+        filenames (or is a Subset of such a dataset)
+    excluded: IDs of the subjects to remove
+    The mask is computed once on the IDs of the dataset, so that the
+    batches only hold evaluated subjects.
+    """
+    excluded = set(map(str, excluded))
+    if not excluded:
+        return loader
+    indices = [idx for idx, subject in enumerate(_subject_ids(loader.dataset))
+               if str(subject) not in excluded]
+    if len(indices) == len(loader.dataset):
+        return loader
+    return DataLoader(Subset(loader.dataset, indices),
+                      batch_size=loader.batch_size,
+                      shuffle=False,
+                      num_workers=loader.num_workers,
+                      collate_fn=loader.collate_fn,
+                      pin_memory=loader.pin_memory)
+
+
+def sample_losses(output, img, loss_type):
+    """
+    Returns the loss of each sample of a batch
+    output: reconstructions, of size [N_batch, N_classes, ...] for
+        'CrossEnt' (skeletons)
+    img: inputs, of size [N_batch, 1, ...]
+    loss_type: 'L2'/'L1'/'CrossEnt'/'SSIM'
+    The loss of a sample is the loss of this sample alone with the
+    default mean reduction: for the weighted cross-entropy, the sum of
+    the voxel losses divided by the sum of the voxel weights.
+    """
+    nb_samples = img.shape[0]
+    if loss_type == 'SSIM':
+        ssim_map = pytorch_ssim.ssim3D(output, img, size_average=False)
+        return ssim_map.reshape(nb_samples, -1).mean(dim=1)
+    if loss_type == 'CrossEnt':
+        # Same weights as during training
+        class_weights = torch.tensor([1., 2.], device=img.device)
+        target = torch.squeeze(img, dim=1).long()
+        loss = F.cross_entropy(output, target, weight=class_weights,
+                               reduction='none')
+        return (loss.reshape(nb_samples, -1).sum(dim=1)
+                / class_weights[target].reshape(nb_samples, -1).sum(dim=1))
+    if loss_type == 'L2':
+        loss = F.mse_loss(output, img, reduction='none')
+    elif loss_type == 'L1':
+        loss = F.l1_loss(output, img, reduction='none')
+    else:
+        raise ValueError(f"Unknown loss {loss_type}")
+    return loss.reshape(nb_samples, -1).mean(dim=1)
+
+
+def evaluate_batches(model, loader, loss_type, skeleton, device):
+    """
+    Yields the evaluation of the model on each batch of loader
+    OUT (for each batch):
+        subjects: list of the IDs of the batch
+        img: inputs on device
+        output: reconstructions on device (labels for skeletons)
+        losses: tensor of the loss of each sample (see sample_losses)
+        encoded: tensor of size [N_batch, N_features] of the encodings
     """
-    Returns list of loss values for each dataset_loader batch
+    with torch.no_grad():
+        for img, path in loader:
+            img = img.to(device, dtype=torch.float)
+            output, encoded = model(img)
+            losses = sample_losses(output, img, loss_type)
+            if skeleton:
+                output = torch.argmax(output, dim=1)
+            yield (list(path), img, output, losses,
+                   encoded.reshape(img.shape[0], -1))
+
+
+def compute_loss(dico_set_loaders, model, loss_type, root_dir,
+                 nb_snapshots=100, excluded=EXCLUDED_SUBJECTS):
+    """
+    Returns list of (loss, encoded) values for each dataset_loader subject
     dataset_loader: dataset on which compute loss
     model: trained model used to compute loss
     loss_type: loss function to use to compute loss (L1, L2, SSIM)
-    path_mode: if True (possible to track loss to samples)
-    show: if True, display output images in Anatomist
+    root_dir: directory where the snapshots are saved
+    nb_snapshots: number of inputs and outputs of each loader saved in
+        root_dir + loader_name + '_snapshots' (see read_snapshots).
+        For L1/L2 losses on images, the error maps (input - output) and
+        their sums over 11**3 cubes are saved, as inputs and outputs, in
+        root_dir + loader_name + '_error_maps'
+    excluded: IDs of the subjects not evaluated
     """
     torch.manual_seed(10)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
-    list_loss = []
-    device = torch.device("cuda", index=0)
+    device = _get_device()
     model = model.to(device)
     model.eval()
     encoded_out = True
 
-
-    dico_sub_loss = dict()
-
-    if loss_type == 'L2':
-        distance = nn.MSELoss()
-    elif loss_type == 'L1':
-        distance = nn.L1Loss()
-    elif loss_type == 'CrossEnt':
-        # weights = [1, 1, 8]
-        # print(weights)
-        weights = [1, 2]
-        class_weights = torch.FloatTensor(weights).to(device)
-        distance = nn.CrossEntropyLoss(weight=class_weights)
-
-    results = {k: {} for k in dico_set_loaders.keys()}
+    skeleton = loss_type != 'SSIM' and 'skeleton' in root_dir
+    results = {}
 
     print(loss_type)
     for loader_name, loader in dico_set_loaders.items():
         print(loader_name)
-        with torch.no_grad():
-            for img, path in loader:
-                if path[0] not in [
-                    '681998875857',
-                    '855494225893',
-                    '927090337769',
-                        '716588902839']:
-                    phase = loader_name
-                    img = Variable(img).to(device, dtype=torch.float)
-                    output, encoded = model(img)
-                    encoded = torch.flatten(encoded)
-                    if loss_type == 'SSIM':
-                        loss = pytorch_ssim.ssim3D(output, img)
-                    else:
-                        if 'skeleton' in root_dir:
-                            target = torch.squeeze(img, dim=0).long()
-                            loss = distance(output, target)
-                            output = torch.argmax(output, dim=1)
-                        else:
-                            loss = distance(output, img)
-                            error_image = img - output
-
-                            weight = torch.ones(
-                                11, 11, 11).unsqueeze(0).unsqueeze(0).to(
-                                device, dtype=torch.float)
-                            out_conv = F.conv3d(
-                                error_image, weight, stride=1, padding=5)
-                    results[loader_name][path] = (
-                        loss.item(), output, img, list(
-                            encoded.squeeze().cpu().detach().numpy()))
-
-    # Saving of outliers
+        # Skeleton reconstructions are labels; others are float images.
+        # Snapshots of a previous evaluation are replaced
+        snapshot_dir = root_dir + str(loader_name) + '_snapshots'
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        snapshots = SnapshotWriter(
+            snapshot_dir,
+            budget=nb_snapshots,
+            dtype=np.uint8 if skeleton else np.float32)
+        error_maps = None
+        if loss_type != 'SSIM' and not skeleton:
+            error_dir = root_dir + str(loader_name) + '_error_maps'
+            shutil.rmtree(error_dir, ignore_errors=True)
+            error_maps = SnapshotWriter(error_dir, budget=nb_snapshots,
+                                        dtype=np.float32)
+        loader = exclude_subjects(loader, excluded)
+        nb_subjects = len(loader.dataset)
+        subjects, losses, encodings = [], np.empty(nb_subjects), None
+        for batch in evaluate_batches(model, loader, loss_type, skeleton,
+                                      device):
+            batch_subjects, img, output, batch_losses, encoded = batch
+            if error_maps is not None and not error_maps.full:
+                error_image = img - output
+                local_error = box_filter_3d(error_image, size=11)
+                error_maps.add(batch_subjects, error_image[:, 0],
+                               local_error[:, 0], phase=loader_name)
+            if not skeleton:
+                output = output[:, 0]
+            snapshots.add(batch_subjects, img[:, 0], output,
+                          phase=loader_name)
+            if encodings is None:
+                encodings = np.empty((nb_subjects, encoded.shape[1]),
+                                     dtype=np.float32)
+            batch_slice = slice(len(subjects),
+                                len(subjects) + len(batch_subjects))
+            losses[batch_slice] = batch_losses.cpu().numpy()
+            encodings[batch_slice] = encoded.cpu().numpy()
+            subjects.extend(batch_subjects)
+        snapshots.close()
+        if error_maps is not None:
+            error_maps.close()
+        results[loader_name] = {
+            subject: (loss, encoding) for subject, loss, encoding
+            in zip(subjects, losses.tolist(),
+                   encodings if encodings is not None else [])}
+
+    # Printing of outliers
     for loader_name in results.keys():
-        input_arr = []
-        output_arr = []
-        phase_arr = []
-        id_arr = []
-        error_arr = []
-        out_conv_arr = []
-
         print(loader_name)
-        quantile = stat.mstats.mquantiles(
-            [res[0] for res in results[loader_name].values()],
-            prob=[0.25, 0.75])
-
-        average = np.mean([res[0] for res in results[loader_name].values()])
-        var = np.std([res[0] for res in results[loader_name].values()])
-        print(
-            "For ",
-            loader_name,
-            "quantile :",
-            quantile,
-            "average :",
-            average,
-            "Variance: ",
-            var)
-        for key, value in results[loader_name].items():
-            if value[0] > min(max([res[0]
-                                   for res in results[loader_name].values()]),
-                              quantile[1] + 1.5 * (quantile[1] - quantile[0])):
-                print(key, value[0])
-            # for k in range(len(results[loader_name])):
-            id_arr.append(key)
-            phase_arr.append(loader_name)
-            input_arr.append(
-                np.array(
-                    np.squeeze(
-                        value[2]).cpu().detach().numpy()))
-            output_arr.append(np.squeeze(value[1]).cpu().detach().numpy())
-            # error_arr.append(np.squeeze(value[3]).cpu().detach().numpy())
-            # out_conv_arr.append(np.squeeze(value[4]).cpu().detach().numpy())
-
-        print(root_dir)
-        for key, array in {'input': input_arr, 'output': output_arr,
-                           'id': id_arr, 'phase': phase_arr}.items():
-            np.save(root_dir + str(loader_name) + '_' + key, np.array([array]))
+        print_outliers(loader_name, results[loader_name])
 
     if encoded_out:
         return {loader_name: [res for res in results[loader_name].values()]
@@ -324,7 +413,8 @@ def plot_distrib(loss_nor, root_dir, *loss_abnor):
     plt.savefig(root_dir + "distrib.png")
 
 
-def get_outliers(skeleton, dico_set_loaders, model, loss_type):
+def get_outliers(skeleton, dico_set_loaders, model, loss_type,
+                 excluded=EXCLUDED_SUBJECTS):
     """
     Print outliers of a given model for each dataset of dico_set_loaders
     IN:
@@ -333,77 +423,60 @@ def get_outliers(skeleton, dico_set_loaders, model, loss_type):
             different populations to compare and values, associated dataloader
             model: model trained
         loss_type: 'L2'/'CrossEnt'
+        excluded: IDs of the subjects not evaluated
     OUT:
+        outliers: dictionary of tables of outliers (see find_outliers)
     """
-    results = test_model(skeleton, dico_set_loaders, model, loss_type)
+    results = test_model(skeleton, dico_set_loaders, model, loss_type,
+                         excluded=excluded)
 
     # Displaying of outliers
+    outliers = {}
     for loader_name in results.keys():
         print(loader_name)
-        quantile = stat.mstats.mquantiles(
-            [res[0] for res in results[loader_name].values()],
-            prob=[0.25, 0.75])
-
-        average = np.mean([res[0] for res in results[loader_name].values()])
-        var = np.std([res[0] for res in results[loader_name].values()])
-        print(
-            "For ",
-            loader_name,
-            "quantile :",
-            quantile,
-            "average :",
-            average,
-            "Variance: ",
-            var)
-        for key, value in results[loader_name].items():
-            if value[0] > min(max([res[0]
-                                   for res in results[loader_name].values()]),
-                              quantile[1] + 1.5 * (quantile[1] - quantile[0])):
-                print(key, value[0])
-
-
-def test_model(skeleton, dico_set_loaders, model, loss_type):
-    """
+        outliers[loader_name] = print_outliers(loader_name,
+                                               results[loader_name])
+    return outliers
+
 
+def test_model(skeleton, dico_set_loaders, model, loss_type,
+               excluded=EXCLUDED_SUBJECTS):
     """
-    list_loss = []
-    device = torch.device("cuda", index=0)
+    Evaluates the model on each dataset of dico_set_loaders
+    IN:
+        skeleton: True/False, whether input are skeleton
+        dico_set_loaders: dictionary loader_name -> dataloader
+        model: model trained
+        loss_type: 'L2'/'L1'/'CrossEnt'/'SSIM'
+        excluded: IDs of the subjects not evaluated
+    OUT:
+        results: dictionary loader_name -> dictionary subject ->
+            (loss, output, input, encoding) of the subject; output and
+            input are CPU tensors, encoding is the row of the subject in
+            a float32 array [N_subjects, N_features] of the loader
+    """
+    device = _get_device()
     model = model.to(device)
     model.eval()
-    encoded_out = True
-    dico_sub_loss = dict()
-
-    if loss_type == 'L2':
-        distance = nn.MSELoss()
-    elif loss_type == 'L1':
-        distance = nn.L1Loss()
-    elif loss_type == 'CrossEnt':
-        weights = [1, 2]
-        class_weights = torch.FloatTensor(weights).to(device)
-        distance = nn.CrossEntropyLoss(weight=class_weights)
 
     results = {k: {} for k in dico_set_loaders.keys()}
 
     for loader_name, loader in dico_set_loaders.items():
         print(loader_name)
-        with torch.no_grad():
-            for img, path in loader:
-                if path[0] not in [
-                    '681998875857',
-                    '855494225893',
-                    '927090337769',
-                        '716588902839']:
-                    img = Variable(img).to(device, dtype=torch.float)
-                    output, encoded = model(img)
-                    encoded = torch.flatten(encoded)
-                    if 'skeleton':
-                        target = torch.squeeze(img, dim=0).long()
-                        loss = distance(output, target)
-                        output = torch.argmax(output, dim=1)
-                    else:
-                        loss = distance(output, img)
-                results[loader_name][path] = (
-                    loss.item(), output, img, list(
-                        encoded.squeeze().cpu().detach().numpy()))
+        loader = exclude_subjects(loader, excluded)
+        encodings = None
+        row = 0
+        for batch in evaluate_batches(model, loader, loss_type, skeleton,
+                                      device):
+            subjects, img, output, losses, encoded = batch
+            if encodings is None:
+                encodings = np.empty((len(loader.dataset), encoded.shape[1]),
+                                     dtype=np.float32)
+            encodings[row:row + len(subjects)] = encoded.cpu().numpy()
+            for subject, loss, sub_output, sub_img in zip(
+                    subjects, losses.tolist(), output.cpu(), img.cpu()):
+                results[loader_name][subject] = (
+                    loss, sub_output, sub_img, encodings[row])
+                row += 1
 
     return results
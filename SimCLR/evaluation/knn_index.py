@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Nearest-neighbour search in the latent space
+
+KNNIndex searches exactly, by blocks of queries, or approximately
+with an HNSW graph if hnswlib is installed (index_type='hnsw').
+An index can be saved next to the embeddings, for instance
+in the folder of an EmbeddingStore.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+log = logging.getLogger(__name__)
+
+_METADATA_FILE = "knn_index.json"
+_HNSW_FILE = "knn_index.bin"
+
+
+def _as_array(X):
+    """Converts embeddings to a float32 numpy array"""
+    if torch.is_tensor(X):
+        X = X.detach().cpu().numpy()
+    return np.ascontiguousarray(X, dtype=np.float32)
+
+
+def _normalize(X):
+    """Normalizes rows to unit norm, for cosine distances"""
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.maximum(norms, np.finfo(np.float32).eps)
+
+
+class KNNIndex():
+    """Index of embeddings for k-nearest-neighbour queries
+    """
+
+    def __init__(self, embeddings, metric='euclidean', index_type='exact',
+                 block_size=1024, hnsw_m=16, hnsw_ef_construction=200):
+        """
+        Args:
+            embeddings (array or tensor): of size [N_subjects, N_features]
+            metric (str): 'euclidean' or 'cosine' (1 - cosine similarity)
+            index_type (str): 'exact' or 'hnsw' (approximate, needs hnswlib)
+            block_size (int): number of queries searched at once
+                by the exact search
+            hnsw_m, hnsw_ef_construction (int): parameters of the HNSW graph
+        """
+        if metric not in ('euclidean', 'cosine'):
+            raise ValueError(f"Unknown metric {metric}")
+        if index_type not in ('exact', 'hnsw'):
+            raise ValueError(f"Unknown index type {index_type}")
+        self.metric = metric
+        self.index_type = index_type
+        self.block_size = block_size
+        self.embeddings = _as_array(embeddings)
+        if metric == 'cosine':
+            self._data = _normalize(self.embeddings)
+        else:
+            # Double precision avoids cancellation for close neighbours
+            self._data = self.embeddings.astype(np.float64)
+            self._sq_norms = np.einsum('ij,ij->i', self._data, self._data)
+        self._hnsw = None
+        if index_type == 'hnsw':
+            self._hnsw = self._build_hnsw(hnsw_m, hnsw_ef_construction)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def _new_hnsw(self):
+        # hnswlib is optional, and only needed for approximate search
+        import hnswlib
+        space = 'l2' if self.metric == 'euclidean' else 'cosine'
+        return hnswlib.Index(space=space, dim=self.embeddings.shape[1])
+
+    def _build_hnsw(self, m, ef_construction):
+        hnsw = self._new_hnsw()
+        hnsw.init_index(max_elements=len(self), M=m,
+                        ef_construction=ef_construction)
+        hnsw.add_items(self.embeddings, np.arange(len(self)))
+        return hnsw
+
+    def _search_exact(self, queries, k):
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), self.block_size):
+            block = queries[start:start + self.block_size]
+            if self.metric == 'cosine':
+                dist = 1. - _normalize(block) @ self._data.T
+            else:
+                block = block.astype(np.float64)
+                dist = np.einsum('ij,ij->i', block, block)[:, np.newaxis] \
+                    - 2. * block @ self._data.T + self._sq_norms
+                np.maximum(dist, 0., out=dist)
+            # Partial sort, then sort of the k selected neighbours only
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k] \
+                if k < dist.shape[1] else \
+                np.tile(np.arange(dist.shape[1]), (len(block), 1))
+            nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+            order = np.argsort(nearest_dist, axis=1, kind='stable')
+            indices[start:start + len(block)] = \
+                np.take_along_axis(nearest, order, axis=1)
+            distances[start:start + len(block)] = \
+                np.take_along_axis(nearest_dist, order, axis=1)
+        if self.metric == 'euclidean':
+            distances = np.sqrt(distances)
+        return distances, indices
+
+    def search(self, queries, k):
+        """Searches the k nearest neighbours of each query
+
+        Args:
+            queries (array or tensor): of size [N_queries, N_features]
+            k (int): number of neighbours
+
+        Returns:
+            tuple (distances, indices), each of size [N_queries, k],
+            sorted by increasing distance
+        """
+        queries = _as_array(queries)
+        k = min(k, len(self))
+        if self._hnsw is None:
+            return self._search_exact(queries, k)
+        self._hnsw.set_ef(max(50, k))
+        indices, distances = self._hnsw.knn_query(queries, k=k)
+        if self.metric == 'euclidean':
+            # hnswlib returns squared euclidean distances
+            distances = np.sqrt(np.maximum(distances, 0.))
+        return distances, indices.astype(np.int64)
+
+    def search_rows(self, rows, k):
+        """Searches the neighbours of already indexed embeddings
+
+        As for sklearn kneighbors, each row is its own first neighbour.
+        """
+        return self.search(self.embeddings[rows], k)
+
+    def save(self, path):
+        """Saves the index parameters (and HNSW graph) in the folder path
+
+        The embeddings themselves are not saved.
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, _METADATA_FILE), 'w') as f:
+            json.dump({"metric": self.metric,
+                       "index_type": self.index_type,
+                       "nb_embeddings": len(self)}, f, indent=2)
+        if self._hnsw is not None:
+            self._hnsw.save_index(os.path.join(path, _HNSW_FILE))
+
+    @classmethod
+    def load(cls, path, embeddings, block_size=1024):
+        """Loads an index saved in the folder path
+
+        Args:
+            path (str): folder given to save
+            embeddings (array or tensor): the indexed embeddings
+        """
+        with open(os.path.join(path, _METADATA_FILE), 'r') as f:
+            metadata = json.load(f)
+        index = cls(embeddings, metric=metadata['metric'],
+                    block_size=block_size)
+        if len(index) != metadata['nb_embeddings']:
+            raise ValueError(
+                f"Index {path} has been built on {metadata['nb_embeddings']} "
+                f"embeddings, not {len(index)}")
+        if metadata['index_type'] == 'hnsw':
+            index.index_type = 'hnsw'
+            index._hnsw = index._new_hnsw()
+            index._hnsw.load_index(os.path.join(path, _HNSW_FILE),
+                                   max_elements=len(index))
+        return index
+
+
+def find_similar_subjects(store, subjects, n_neighbors=5, metric='cosine',
+                          index=None):
+    """Finds the subjects whose embeddings are closest to given subjects
+
+    Args:
+        store (EmbeddingStore): embeddings of all subjects
+        subjects (list of str): subject IDs of the queries
+        n_neighbors (int): number of similar subjects returned per query
+        metric (str): 'euclidean' or 'cosine'
+        index (KNNIndex): optional, index already built on store.embeddings
+
+    Returns:
+        dict {subject: list of (similar subject, distance)}
+    """
+    if index is None:
+        index = KNNIndex(store.embeddings, metric=metric)
+    rows = [store.index[subject] for subject in subjects]
+    # One more neighbour, as each subject is its own nearest neighbour
+    distances, indices = index.search_rows(rows, n_neighbors + 1)
+    similar = {}
+    for subject, row, dist, idx in zip(subjects, rows, distances, indices):
+        similar[subject] = [(store.subjects[i], float(d))
+                            for i, d in zip(idx, dist)
+                            if i != row][:n_neighbors]
+    return similar
@@ -3,15 +3,40 @@
 
 """
 This program launches postprocessing_results for each training subfolder
+
+Each run configuration is composed in-process with the hydra compose API
+from the .hydra folder of the training subfolder.
+Runs are evaluated in a pool of worker processes. The crops are loaded,
+padded and split once in the main process (see SharedCrops) before the
+workers are started, so that all workers share them. Without GPU, the
+workers are forked and run on CPU. With GPUs, they are spawned, since a
+forked process cannot use CUDA, and each worker gets its own GPU (round
+robin if there are more workers than GPUs); memory-mapped crops (see
+cache_dir) are then reopened by the workers rather than copied.
 """
 import argparse
 import glob
+import logging
+import multiprocessing
 import os
 import sys
-import inspect
+
 import six
+import torch
+from hydra import compose
+from hydra import initialize_config_dir
+
+from SimCLR.data.shared_crops import data_key
+from SimCLR.data.shared_crops import SharedCrops
+from SimCLR.utils.config import process_config
+
+log = logging.getLogger(__name__)
 
-from SimCLR import evaluation
+# Crops shared by the evaluations, keyed by data_key
+_shared_crops = {}
+
+# Device of the worker process: GPU index or 'cpu'
+_worker = {}
 
 
 def parse_args(argv):
@@ -34,34 +59,195 @@ def parse_args(argv):
     parser.add_argument(
         "-c", "--csv_file", type=str, required=True,
         help='csv file on which is done the evaluation.')
+    parser.add_argument(
+        "-n", "--nb_workers", type=int, default=1,
+        help='Number of checkpoints evaluated in parallel.')
+    parser.add_argument(
+        "-f", "--force", action='store_true',
+        help='Evaluates also subfolders whose result.json is up to date.')
+    parser.add_argument(
+        "-d", "--cache_dir", type=str, default=None,
+        help='Directory where padded crops are memory-mapped from.')
 
     args = parser.parse_args(argv)
 
     return args
 
 
-def loop_over_directory(src_dir, csv_file):
+def get_checkpoint(deep_dir):
+    """Returns the last checkpoint file of a training subfolder, or None"""
+    checkpoint_files = glob.glob(
+        f"{deep_dir}/logs/default/version_0/checkpoints/*.ckpt")
+    if not checkpoint_files:
+        return None
+    return os.path.abspath(max(checkpoint_files, key=os.path.getmtime))
+
+
+def is_up_to_date(deep_dir, checkpoint_file):
+    """Returns True if result.json is newer than the checkpoint"""
+    result_file = f"{deep_dir}/result.json"
+    return os.path.isfile(result_file) and \
+        os.path.getmtime(result_file) > os.path.getmtime(checkpoint_file)
+
+
+def compose_config(deep_dir, checkpoint_file, csv_file, device=None):
+    """Composes the configuration of one training subfolder
+
+    The configuration is read from the .hydra folder
+    and overriden as done previously on the command line.
+
+    Args:
+        device: GPU index or 'cpu' on which the checkpoint is evaluated;
+            if None, the platform of the training is kept
+    """
+    overrides = [f"++analysis_path=\"{deep_dir}\"",
+                 f"checkpoint_path=\"{checkpoint_file}\"",
+                 f"train_val_csv_file=\"{csv_file}\""]
+    overrides += [f"++{key}={value}"
+                  for key, value in platform_overrides(device).items()]
+    with initialize_config_dir(config_dir=f"{deep_dir}/.hydra"):
+        config = compose(config_name="config", overrides=overrides)
+    return process_config(config)
+
+
+def platform_overrides(device):
+    """Returns the accelerator and devices on which to run
+
+    Args:
+        device: GPU index or 'cpu'; if None, nothing is overridden
+
+    Returns:
+        dict of the overridden configuration keys
+    """
+    if device is None:
+        return {}
+    if device == 'cpu':
+        return {'accelerator': 'cpu', 'devices': 1}
+    return {'accelerator': 'gpu', 'devices': [device]}
+
+
+def _init_worker(shared_crops, devices):
+    """Sets the shared crops and takes the device of a worker process"""
+    _shared_crops.update(shared_crops)
+    _worker['device'] = devices.get()
+
+
+def worker_device():
+    """Returns the device of this worker process, None out of a pool"""
+    return _worker.get('device')
+
+
+def worker_pool(nb_workers):
+    """Returns a pool of processes, each with its own device
+
+    The processes get the crops already loaded in _shared_crops.
+    Without GPU, they are forked and run on CPU. With GPUs, they are
+    spawned, since CUDA cannot be used in forked processes, and take
+    the GPUs round robin.
+    """
+    # device_count does not create a CUDA context in the main process
+    nb_gpus = torch.cuda.device_count()
+    context = multiprocessing.get_context('spawn' if nb_gpus else 'fork')
+    devices = context.SimpleQueue()
+    for worker in range(nb_workers):
+        devices.put(worker % nb_gpus if nb_gpus else 'cpu')
+    return context.Pool(nb_workers, initializer=_init_worker,
+                        initargs=(_shared_crops, devices))
+
+
+def evaluate_directory(deep_dir, checkpoint_file, csv_file, device=None):
+    """Validates and clusterizes one training subfolder
+
+    Args:
+        device: GPU index or 'cpu'; defaults to the device of the worker
+
+    Returns:
+        tuple (deep_dir, error message or None)
+    """
+    # Imported here, so that the main process does not import the model
+    # before it has loaded the crops
+    from SimCLR.evaluation.validate_and_clusterize \
+        import validate_and_clusterize
+    if device is None:
+        device = worker_device()
+    try:
+        config = compose_config(deep_dir, checkpoint_file, csv_file,
+                                device=device)
+        validate_and_clusterize(config, shared=get_shared_crops(config))
+    except Exception as exc:
+        log.exception(f"Evaluation of {deep_dir} failed")
+        return deep_dir, repr(exc)
+    return deep_dir, None
+
+
+def share_crops(config, cache_dir=None):
+    """Loads once the crops of a configuration, for all workers
+
+    Returns:
+        SharedCrops of the configuration
+    """
+    key = data_key(config)
+    if key not in _shared_crops:
+        _shared_crops[key] = SharedCrops(config, cache_dir=cache_dir)
+    return _shared_crops[key]
+
+
+def get_shared_crops(config):
+    """Returns the crops of a configuration if they are shared, else None"""
+    return _shared_crops.get(data_key(config))
+
+
+def load_shared_crops(runs, cache_dir=None):
+    """Loads once the crops needed by all runs"""
+    for deep_dir, checkpoint_file, csv_file in runs:
+        config = compose_config(deep_dir, checkpoint_file, csv_file)
+        share_crops(config, cache_dir=cache_dir).reference_views()
+
+
+def loop_over_directory(src_dir, csv_file, nb_workers=1, force=False,
+                        cache_dir=None):
     """Loops over deep learning directories
+
+    Args:
+        src_dir (str): directory containing the training subfolders
+        csv_file (str): csv file on which is done the evaluation
+        nb_workers (int): number of checkpoints evaluated in parallel
+        force (bool): if False, skips subfolders whose result.json
+            is newer than their checkpoint
+        cache_dir (str): optional, directory where padded crops are
+            memory-mapped from
     """
-    # Gets and creates all filenames
-    dirnames = glob.glob(f"{src_dir}/*")
-    for deep_dir in dirnames:
+    # Gets all directories to evaluate
+    runs = []
+    for deep_dir in sorted(glob.glob(f"{src_dir}/*")):
         deep_dir = os.path.abspath(deep_dir)
-        analysis_path = f"{deep_dir}"
-        checkpoint_file = glob.glob(
-            f"{deep_dir}/logs/default/version_0/checkpoints/*.ckpt")
-        checkpoint_file = os.path.abspath(checkpoint_file[0])
-        checkpoint_path = f"'\"{checkpoint_file}\"'"
-        config_path = f"{deep_dir}/.hydra"
-        prog_path = os.path.dirname(inspect.getabsfile(evaluation))
-        cmd = f"python3 {prog_path}/validate_and_clusterize.py " \
-            f"+analysis_path={analysis_path} " \
-            f"checkpoint_path={checkpoint_path} " \
-            f"train_val_csv_file={csv_file} "\
-            f"--config-path={config_path}"
-
-        print(cmd)
-        os.system(cmd)
+        checkpoint_file = get_checkpoint(deep_dir)
+        if checkpoint_file is None:
+            log.info(f"No checkpoint in {deep_dir}: skipped")
+            continue
+        if not force and is_up_to_date(deep_dir, checkpoint_file):
+            log.info(f"result.json of {deep_dir} is up to date: skipped")
+            continue
+        runs.append((deep_dir, checkpoint_file, csv_file))
+
+    if not runs:
+        return
+
+    # Loads the crops before starting the workers
+    load_shared_crops(runs, cache_dir=cache_dir)
+
+    if nb_workers <= 1:
+        device = 0 if torch.cuda.device_count() else 'cpu'
+        results = [evaluate_directory(*run, device=device) for run in runs]
+    else:
+        with worker_pool(nb_workers) as pool:
+            results = pool.starmap(evaluate_directory, runs, chunksize=1)
+
+    for deep_dir, error in results:
+        if error:
+            print(f"{deep_dir}: FAILED ({error})")
+        else:
+            print(f"{deep_dir}: done")
 
 
 def main(argv):
@@ -76,7 +262,10 @@ def main(argv):
     try:
         # Parsing arguments
         args = parse_args(argv)
-        loop_over_directory(args.src_dir, args.csv_file)
+        loop_over_directory(args.src_dir, args.csv_file,
+                            nb_workers=args.nb_workers,
+                            force=args.force,
+                            cache_dir=args.cache_dir)
     except SystemExit as exc:
         if exc.code != 0:
             six.reraise(*sys.exc_info())
@@ -88,4 +277,5 @@ if __name__ == '__main__':
     main(argv=sys.argv[1:])
 
     # example of use
-    # python3 analysis_each.py -s ../../../Output/t-0.1
+    # python3 loop_validate_and_clusterize.py -s ../../../Output/t-0.1 \
+    #   -c /path/to/csv/file -n 4
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Outliers of the loss distribution of a population
+
+The losses are converted once to an array: quartiles, mean, std and
+outlier fence are computed on the whole array, so that the analysis is
+linear in the number of subjects.
+"""
+import numpy as np
+import pandas as pd
+import scipy.stats as stat
+
+
+def find_outliers(subjects, losses):
+    """
+    Finds subjects whose loss is above the upper Tukey fence
+    subjects: list of N subject keys
+    losses: N loss values
+    The fence is Q3 + 1.5 * (Q3 - Q1), capped at the maximal loss.
+    OUT:
+        stats: dictionary of the quartiles, mean, std and fence
+        outliers: DataFrame of the flagged subjects (columns subject
+            and loss), in the order of subjects
+    """
+    losses = np.asarray(losses, dtype=np.float64)
+    quantile = stat.mstats.mquantiles(losses, prob=[0.25, 0.75])
+    threshold = min(losses.max(),
+                    quantile[1] + 1.5 * (quantile[1] - quantile[0]))
+    stats = {'quantile': quantile,
+             'average': losses.mean(),
+             'std': losses.std(),
+             'threshold': threshold}
+    flagged = np.flatnonzero(losses > threshold)
+    outliers = pd.DataFrame({'subject': [subjects[i] for i in flagged],
+                             'loss': losses[flagged]})
+    return stats, outliers
+
+
+def print_outliers(loader_name, loader_results):
+    """
+    Prints the loss statistics and the outliers of a loader
+    loader_results: dictionary subject -> tuple whose first item is the loss
+    OUT:
+        outliers: DataFrame of the outliers (see find_outliers)
+    """
+    subjects = list(loader_results.keys())
+    losses = [res[0] for res in loader_results.values()]
+    stats, outliers = find_outliers(subjects, losses)
+    print(
+        "For ",
+        loader_name,
+        "quantile :",
+        stats['quantile'],
+        "average :",
+        stats['average'],
+        "Variance: ",
+        stats['std'])
+    for subject, loss in zip(outliers['subject'], outliers['loss']):
+        print(subject, loss)
+    return outliers
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Silhouette coefficients with bounded memory
+
+Distances are computed by blocks of rows, so that memory is
+O(block_size * N) instead of O(N^2).
+For large cohorts, the silhouette score can be estimated
+from a stratified subsample of the subjects, together with
+a confidence interval.
+"""
+import logging
+
+import numpy as np
+from scipy.stats import norm
+from sklearn.metrics import pairwise_distances
+
+log = logging.getLogger(__name__)
+
+_DEFAULT_BLOCK_SIZE = 1024
+
+
+def _encode_labels(X, labels):
+    """Encodes labels as 0..n_labels-1 and checks their number
+    """
+    _, labels = np.unique(labels, return_inverse=True)
+    labels = labels.ravel()
+    n_labels = labels.max() + 1
+    if not 1 < n_labels < X.shape[0]:
+        raise ValueError("Number of labels is %d. Valid values are 2 "
+                         "to n_samples - 1 (inclusive)" % n_labels)
+    return labels, n_labels
+
+
+def _silhouette_rows(X, rows, labels, n_labels, label_freqs,
+                     metric, block_size):
+    """Computes the silhouette coefficient of the given rows against all X
+    """
+    sil = np.empty(len(rows))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        distances = pairwise_distances(X[block], X, metric=metric)
+        # Self-distances are set exactly to 0, as done by sklearn
+        distances[np.arange(len(block)), block] = 0
+
+        # Sums the distances to each cluster: [block_size, n_labels]
+        clust_dists = np.zeros((len(block), n_labels))
+        for label in range(n_labels):
+            clust_dists[:, label] = \
+                distances[:, labels == label].sum(axis=1)
+
+        block_labels = labels[block]
+        arange = np.arange(len(block))
+        intra_clust_dists = clust_dists[arange, block_labels]
+        clust_dists[arange, block_labels] = np.inf
+        clust_dists /= label_freqs
+        inter_clust_dists = clust_dists.min(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intra_clust_dists /= (label_freqs - 1)[block_labels]
+            sil_block = inter_clust_dists - intra_clust_dists
+            sil_block /= np.maximum(intra_clust_dists, inter_clust_dists)
+        # Samples alone in their cluster have a silhouette of 0
+        sil[start:start + len(block)] = np.nan_to_num(sil_block)
+    return sil
+
+
+def silhouette_samples(X, labels, metric='euclidean',
+                       block_size=_DEFAULT_BLOCK_SIZE):
+    """Computes the silhouette coefficient of each sample
+
+    Same output as sklearn.metrics.silhouette_samples,
+    computed block of rows by block of rows.
+
+    Args:
+        X (array): embeddings of size [N_subjects, N_features]
+        labels (array): cluster labels of size [N_subjects]
+        metric (str): metric used by pairwise_distances
+        block_size (int): number of rows handled at once
+
+    Returns:
+        array of size [N_subjects]
+    """
+    X = np.asarray(X)
+    labels, n_labels = _encode_labels(X, labels)
+    label_freqs = np.bincount(labels, minlength=n_labels)
+    return _silhouette_rows(X, np.arange(X.shape[0]), labels, n_labels,
+                            label_freqs, metric, block_size)
+
+
+def silhouette_score(X, labels, metric='euclidean',
+                     block_size=_DEFAULT_BLOCK_SIZE):
+    """Computes the mean silhouette coefficient over all samples
+
+    Same output as sklearn.metrics.silhouette_score
+    """
+    return np.mean(silhouette_samples(X, labels, metric=metric,
+                                      block_size=block_size))
+
+
+def silhouette_score_sampled(X, labels, sample_size, confidence=0.95,
+                             metric='euclidean',
+                             block_size=_DEFAULT_BLOCK_SIZE,
+                             random_state=None, return_samples=False):
+    """Estimates the silhouette score from a stratified subsample
+
+    The subsample is drawn cluster by cluster, proportionally to the
+    cluster sizes. The silhouette coefficients of the sampled subjects
+    are computed exactly against the whole cohort, so the estimator is
+    unbiased. The confidence interval uses the stratified variance
+    with finite population correction.
+
+    Args:
+        X (array): embeddings of size [N_subjects, N_features]
+        labels (array): cluster labels of size [N_subjects]
+        sample_size (int): number of sampled subjects
+        confidence (float): level of the confidence interval
+        random_state (int or None): seed of the subsampling
+        return_samples (bool): if True, also returns the indices of the
+            sampled subjects and their silhouette coefficients
+
+    Returns:
+        tuple (score, lower_bound, upper_bound)
+        or (score, lower_bound, upper_bound, rows, sample_values)
+    """
+    X = np.asarray(X)
+    labels, n_labels = _encode_labels(X, labels)
+    label_freqs = np.bincount(labels, minlength=n_labels)
+    n_samples = X.shape[0]
+    if sample_size >= n_samples:
+        rows = np.arange(n_samples)
+        sil = _silhouette_rows(X, rows, labels, n_labels, label_freqs,
+                               metric, block_size)
+        score = np.mean(sil)
+        if return_samples:
+            return score, score, score, rows, sil
+        return score, score, score
+
+    rng = np.random.RandomState(random_state)
+    # At least 2 subjects per cluster to estimate a within-cluster variance
+    quotas = np.maximum(
+        np.round(sample_size * label_freqs / n_samples).astype(int), 2)
+    quotas = np.minimum(quotas, label_freqs)
+    strata = [rng.choice(np.flatnonzero(labels == label),
+                         size=quotas[label], replace=False)
+              for label in range(n_labels)]
+    rows = np.concatenate(strata)
+    sil = _silhouette_rows(X, rows, labels, n_labels, label_freqs,
+                           metric, block_size)
+
+    weights = label_freqs / n_samples
+    means = np.empty(n_labels)
+    variances = np.empty(n_labels)
+    start = 0
+    for label in range(n_labels):
+        sil_label = sil[start:start + quotas[label]]
+        start += quotas[label]
+        means[label] = sil_label.mean()
+        # A fully enumerated cluster does not contribute to the variance
+        fpc = 1. - quotas[label] / label_freqs[label]
+        variances[label] = \
+            sil_label.var(ddof=1) / quotas[label] * fpc if fpc > 0 else 0.
+
+    score = np.sum(weights * means)
+    half_width = norm.ppf(0.5 + confidence / 2.) * \
+        np.sqrt(np.sum(weights**2 * variances))
+    log.info(f"Silhouette estimated on {len(rows)} subjects: "
+             f"{score} +/- {half_width}")
+    if return_samples:
+        return score, score - half_width, score + half_width, rows, sil
+    return score, score - half_width, score + half_width
@@ -13,7 +13,6 @@ import os
 
 import hydra
 import matplotlib.pyplot as plt
-import numpy as np
 import pytorch_lightning as pl
 import torch
 from omegaconf import DictConfig
@@ -21,22 +20,24 @@ from omegaconf import OmegaConf
 from pytorch_lightning import loggers as pl_loggers
 from pytorch_lightning.utilities.seed import seed_everything
 from sklearn.cluster import AffinityPropagation
-from sklearn.cluster import DBSCAN
 from sklearn.cluster import KMeans
-from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary
 
 from SimCLR.data.datamodule import DataModule
 from SimCLR.data.datamodule import DataModule_Visualization
+from SimCLR.data.view_cache import ViewCache
 from SimCLR.evaluation.clustering import Cluster
+from SimCLR.evaluation.dbscan_sweep import dbscan_eps_sweep
+from SimCLR.evaluation.embedding_store import EmbeddingStore
+from SimCLR.evaluation.embedding_store import file_hash
 from SimCLR.models.contrastive_learner_visualization \
     import ContrastiveLearner_Visualization
 from SimCLR.utils.config import process_config
+from SimCLR.utils.plots.visualize_nearest_neighhbours \
+    import plot_knn_examples
 from SimCLR.utils.plots.visualize_tsne import plot_tsne
 # from sklearn.cluster import OPTICS
 
-tb_logger = pl_loggers.TensorBoardLogger('logs')
-writer = SummaryWriter()
 log = logging.getLogger(__name__)
 
 """
@@ -48,11 +49,16 @@ We call:
 """
 
 
-@hydra.main(config_name='config', config_path="configs")
-def postprocessing_results(config: DictConfig) -> None:
-    print(OmegaConf.to_yaml(config))
-    config = process_config(config)
+def validate_and_clusterize(config, logger=None, shared=None):
+    """Validates the checkpoint config.checkpoint_path and clusterizes
 
+    Results are saved in config.analysis_path.
+
+    Args:
+        config (Omegaconf dict): processed configuration
+        logger: pytorch-lightning logger, defaults to a TensorBoardLogger
+        shared (SharedCrops): optional, crops already loaded for a sweep
+    """
     # Sets seed for pseudo-random number generators
     # in: pytorch, numpy, python.random
     # seed_everything(config.seed)
@@ -65,7 +71,7 @@ def postprocessing_results(config: DictConfig) -> None:
         plt.show()
         plt.pause(0.001)
 
-    data_module = DataModule_Visualization(config)
+    data_module = DataModule_Visualization(config, shared=shared)
     data_module.setup(stage='validate')
 
     # Show the views of the first skeleton after each epoch
@@ -77,57 +83,74 @@ def postprocessing_results(config: DictConfig) -> None:
                                        mode="encoder",
                                        sample_data=data_module)
     summary(model, tuple(config.input_size), device="cpu")
+    if logger is None:
+        logger = pl_loggers.TensorBoardLogger('logs')
+    # One device, given by the platform configuration; older training
+    # folders, without platform keys, are evaluated on the first GPU
     trainer = pl.Trainer(
-        gpus=1,
+        accelerator=config.get('accelerator', 'gpu'),
+        devices=config.get('devices', 1),
         max_epochs=config.max_epochs,
-        logger=tb_logger,
+        logger=logger,
         flush_logs_every_n_steps=config.nb_steps_per_flush_logs,
         resume_from_checkpoint=config.checkpoint_path)
     result_dict = trainer.validate(model, data_module)[0]
-    embeddings, filenames = model.compute_representations(
-        data_module.train_val_dataloader())
-
-    # Gets coordinates of first views of the embeddings
-    nb_first_views = (embeddings.shape[0]) // 2
-    index = np.arange(nb_first_views) * 2
-    embeddings = embeddings[index, :]
-    filenames = filenames[::2]
-
-    # plot_knn_buckets(embeddings=embeddings,
-    #                 dataset=data_module.dataset_train,
-    #                 n_neighbors=6,
-    #                 num_examples=3
-    #                 )
-
-    # log.info("knn meshes done")
 
-    # plot_knn_examples(embeddings=embeddings,
-    #                   dataset=data_module.dataset_val,
-    #                   n_neighbors=6,
-    #                   num_examples=3,
-    #                   savepath=config.analysis_path
-    #                   )
-
-    # log.info("knn examples done")
+    # Embeds only the reference view (padded and binarized) of each subject.
+    # Subjects already embedded with this checkpoint are read from the store
+    store = EmbeddingStore(
+        f"{config.analysis_path}/embedding_store",
+        latent_size=config.num_representation_features,
+        checkpoint_hash=file_hash(config.checkpoint_path),
+        temperature=config.temperature,
+        on_mismatch='reset')
+    # The views embedded now are kept for the neighbour plots
+    filenames = list(data_module.dataset_train_val_reference.filenames)
+    missing = set(store.missing(filenames))
+    indices = [i for i, filename in enumerate(filenames)
+               if filename in missing]
+    view_cache = ViewCache(keys=indices)
+    if missing:
+        new_embeddings, new_filenames = model.compute_representations(
+            data_module.reference_dataloader(indices=indices),
+            view_cache=view_cache)
+        store.append(new_filenames, new_embeddings.numpy())
+    log.info(f"{len(missing)} subjects embedded, "
+             f"{len(filenames) - len(missing)} read from the store")
+    embeddings = torch.from_numpy(store.get(filenames))
+
+    # Plots subjects with their nearest neighbours. There is one
+    # embedding row per subject; views that are not in the cache
+    # (read from the store) are the same deterministic reference views
+    if config.get('nb_knn_examples', 0):
+        plot_knn_examples(embeddings=embeddings,
+                          dataset=data_module.dataset_train_val_reference,
+                          filenames=filenames,
+                          n_neighbors=6,
+                          num_examples=config.nb_knn_examples,
+                          savepath=config.analysis_path,
+                          view_cache=view_cache,
+                          nb_views=1)
+        log.info("knn examples done")
 
     # Makes Kmeans and represents it on a t-SNE plot
-    X_tsne = model.compute_tsne(
-        data_module.train_val_dataloader(),
-        "representation")
+    X_tsne = model.fit_tsne(embeddings)
     n_clusters = 2
 
     clustering = KMeans(n_clusters=n_clusters, random_state=0).fit(embeddings)
-    plot_tsne(X_tsne=X_tsne[index, :],
+    plot_tsne(X_tsne=X_tsne,
               buffer=False,
               labels=clustering.labels_,
               savepath=config.analysis_path,
               type='kmeans')
-    for eps in [1., 1.5, 1.8, 2., 2.2, 2.5, 3., 3.5]:
-        clustering = DBSCAN(eps=eps).fit(embeddings)
+    # The radius-neighbour graph is built once for all eps values
+    dbscan_labels = dbscan_eps_sweep(
+        embeddings, [1., 1.5, 1.8, 2., 2.2, 2.5, 3., 3.5])
+    for eps, labels in dbscan_labels.items():
         # clustering = OPTICS().fit(embeddings)
-        plot_tsne(X_tsne=X_tsne[index, :],
+        plot_tsne(X_tsne=X_tsne,
                   buffer=False,
-                  labels=clustering.labels_,
+                  labels=labels,
                   savepath=config.analysis_path,
                   type=f"dbscan_{eps}")
 
@@ -141,8 +164,7 @@ def postprocessing_results(config: DictConfig) -> None:
         x_cluster_label = af.predict(embeddings)
         n_clusters_ = len(af.cluster_centers_indices_)
         print(n_clusters_)
-    plot_tsne(X_tsne=X_tsne[index,
-                            :],
+    plot_tsne(X_tsne=X_tsne,
               buffer=False,
               labels=x_cluster_label,
               savepath=config.analysis_path,
@@ -163,5 +185,12 @@ def postprocessing_results(config: DictConfig) -> None:
         json.dump(filenames, f, indent=2)
 
 
+@hydra.main(config_name='config', config_path="configs")
+def postprocessing_results(config: DictConfig) -> None:
+    print(OmegaConf.to_yaml(config))
+    config = process_config(config)
+    validate_and_clusterize(config)
+
+
 if __name__ == "__main__":
     postprocessing_results()
@@ -13,15 +13,13 @@ import hydra
 import pytorch_lightning as pl
 from pytorch_lightning import loggers as pl_loggers
 from pytorch_lightning.utilities.seed import seed_everything
-from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary
 
+from SimCLR.backbones.sync_batchnorm import CPUSyncBatchNorm
 from SimCLR.data.datamodule import DataModule
 from SimCLR.models.contrastive_learner import ContrastiveLearner
 from SimCLR.utils.config import process_config
 
-tb_logger = pl_loggers.TensorBoardLogger('logs')
-writer = SummaryWriter()
 log = logging.getLogger(__name__)
 
 """
@@ -33,11 +31,25 @@ We use the following definitions:
 """
 
 
-@hydra.main(config_name='config', config_path="configs")
-def train(config):
-    config = process_config(config)
+def train_model(config, logger=None, shared=None):
+    """Trains the contrastive model of a processed configuration
+
+    Training resumes from config.checkpoint_path if it is set.
+
+    Args:
+        config (Omegaconf dict): processed configuration
+        logger: pytorch-lightning logger, defaults to a TensorBoardLogger
+            in the logs folder of the working directory
+        shared (SharedCrops): optional, crops already loaded for a sweep
+
+    Returns:
+        tuple (model, trainer)
+    """
+    # Created here, not at import: hydra has set the output directory
+    if logger is None:
+        logger = pl_loggers.TensorBoardLogger('logs')
 
-    data_module = DataModule(config)
+    data_module = DataModule(config, shared=shared)
 
     model = ContrastiveLearner(config,
                                mode="encoder",
@@ -45,10 +57,24 @@ def train(config):
 
     summary(model, tuple(config.input_size), device="cpu")
 
+    # torch.nn.SyncBatchNorm only runs on GPU:
+    # on CPU (gloo), BatchNorm layers are synchronized by CPUSyncBatchNorm
+    sync_batchnorm = config.sync_batchnorm
+    if sync_batchnorm and config.accelerator == 'cpu':
+        model = CPUSyncBatchNorm.convert_sync_batchnorm(model)
+        sync_batchnorm = False
+
+    # Distributed training is set by the platform configuration.
+    # The DataModule shards the datasets itself
     trainer = pl.Trainer(
-        gpus=1,
+        accelerator=config.accelerator,
+        devices=config.devices,
+        num_nodes=config.num_nodes,
+        strategy=config.strategy,
+        sync_batchnorm=sync_batchnorm,
+        replace_sampler_ddp=False,
         max_epochs=config.max_epochs,
-        logger=tb_logger,
+        logger=logger,
         flush_logs_every_n_steps=config.nb_steps_per_flush_logs,
         log_every_n_steps=config.log_every_n_steps,
         resume_from_checkpoint=config.checkpoint_path)
@@ -56,6 +82,13 @@ def train(config):
     trainer.fit(model, data_module)
 
     print("Number of hooks: ", len(model.save_output.outputs))
+    return model, trainer
+
+
+@hydra.main(config_name='config', config_path="configs")
+def train(config):
+    config = process_config(config)
+    train_model(config)
 
 
 if __name__ == "__main__":
@@ -6,18 +6,17 @@ Some helper functions are taken from:
 https://learnopencv.com/tensorboard-with-pytorch-lightning
 
 """
+from contextlib import contextmanager
+
 import numpy as np
 import torch
-from sklearn.manifold import TSNE
 from toolz.itertoolz import first
 from toolz.itertoolz import last
 
 from SimCLR.backbones.densenet import DenseNet
 from SimCLR.losses import NTXenLoss
-from SimCLR.utils.plots.visualize_anatomist import Visu_Anatomist
-from SimCLR.utils.plots.visualize_images import plot_bucket
-from SimCLR.utils.plots.visualize_images import plot_histogram
-from SimCLR.utils.plots.visualize_tsne import plot_tsne
+from SimCLR.utils.cpu_parallel import node_partition
+from SimCLR.utils.plots import registry
 
 
 class SaveOutput:
@@ -49,7 +48,9 @@ class ContrastiveLearner(DenseNet):
         self.save_output = SaveOutput()
         self.hook_handles = []
         self.get_layers()
-        self.visu_anatomist = Visu_Anatomist()
+        self._rendering_service = None
+        # Snapshots being rendered: list of (tag, epoch, future)
+        self.pending_snapshots = []
 
     def get_layers(self):
         for layer in self.modules():
@@ -57,6 +58,52 @@ class ContrastiveLearner(DenseNet):
                 handle = layer.register_forward_hook(self.save_output)
                 self.hook_handles.append(handle)
 
+    @property
+    def rendering_service(self):
+        """Pool of bucket renderers, created at first use"""
+        if self._rendering_service is None:
+            self._rendering_service = registry.get('RenderingService')(
+                renderer=self.config.get('renderer', 'auto'),
+                nb_renderers=self.config.get('nb_renderers', 1))
+        return self._rendering_service
+
+    def submit_snapshot(self, tag, img):
+        """Queues the rendering of the first volume of the batch img
+
+        The image is logged by log_snapshots once rendered."""
+        self.pending_snapshots.append(
+            (tag, self.current_epoch,
+             self.rendering_service.submit_batch(img)))
+
+    def log_snapshots(self, wait=False):
+        """Logs the rendered snapshots
+
+        Snapshots still being rendered are logged at a later call,
+        unless wait is True."""
+        pending = []
+        for tag, epoch, future in self.pending_snapshots:
+            if wait or future.done():
+                self.logger.experiment.add_image(tag, future.result(), epoch)
+            else:
+                pending.append((tag, epoch, future))
+        self.pending_snapshots = pending
+
+    def on_fit_start(self):
+        """Pins the process to its compute cores on CPU
+
+        Only when config.pin_cores is set; each process of the node
+        gets its own cores (see SimCLR.utils.cpu_parallel)."""
+        if self.config.get('pin_cores', False) and self.device.type == 'cpu':
+            partition = node_partition(
+                self.trainer.world_size // self.trainer.num_nodes,
+                self.config.get('loader_cores_per_process', 2))
+            partition.pin_process(self.trainer.local_rank)
+
+    def on_train_end(self):
+        """Logs the last snapshots"""
+        if self.global_rank == 0:
+            self.log_snapshots(wait=True)
+
     def custom_histogram_adder(self):
         """Builds histogram for each model parameter.
         """
@@ -74,6 +121,43 @@ class ContrastiveLearner(DenseNet):
                                      weight_decay=self.config.weight_decay)
         return optimizer
 
+    def gather_batch(self, z):
+        """Gathers the outputs of all processes in distributed training
+
+        The gather is differentiable, so that each process computes the
+        loss of the global batch, with the negatives of all processes,
+        as a single large batch would do.
+
+        Returns:
+            tensor of size [N_processes * N_batch, N_features]
+        """
+        if self.trainer is None or self.trainer.world_size <= 1:
+            return z
+        return self.all_gather(z, sync_grads=True).flatten(0, 1)
+
+    def inference_device(self):
+        """Device used to compute embeddings outside of training steps
+
+        It is the device of the model when it has been moved
+        to an accelerator, config.device otherwise."""
+        if self.device.type == 'cpu':
+            return torch.device(self.config.device)
+        return self.device
+
+    @contextmanager
+    def evaluation_mode(self):
+        """Puts the model in eval mode, and back in its mode afterwards
+
+        Forward passes made by the first process only (visualizations)
+        must neither update the BatchNorm statistics nor synchronize them
+        with the other processes, which would wait forever."""
+        training = self.training
+        self.eval()
+        try:
+            yield
+        finally:
+            self.train(training)
+
     def nt_xen_loss(self, z_i, z_j):
         """Loss function"""
         loss = NTXenLoss(temperature=self.config.temperature,
@@ -84,14 +168,15 @@ class ContrastiveLearner(DenseNet):
         """Training step.
         """
         (inputs, filenames) = train_batch
-        z_i = self.forward(inputs[:, 0, :])
-        z_j = self.forward(inputs[:, 1, :])
+        z_i = self.gather_batch(self.forward(inputs[:, 0, :]))
+        z_j = self.gather_batch(self.forward(inputs[:, 1, :]))
         batch_loss, sim_zij, sim_zii, sim_zjj = self.nt_xen_loss(z_i, z_j)
         self.log('train_loss', float(batch_loss))
 
         # Only computes graph on first step
-        if self.global_step == 1:
-            self.logger.experiment.add_graph(self, inputs[:, 0, :])
+        if self.global_step == 1 and self.global_rank == 0:
+            with self.evaluation_mode():
+                self.logger.experiment.add_graph(self, inputs[:, 0, :])
 
         # Records sample for first batch of each epoch
         if batch_idx == 0:
@@ -113,69 +198,90 @@ class ContrastiveLearner(DenseNet):
 
         return batch_dictionary
 
-    def compute_outputs_skeletons(self, loader):
+    def compute_outputs_skeletons(self, loader, view_cache=None):
         """Computes the outputs of the model for each crop.
 
-        This includes the projection head"""
+        This includes the projection head.
+        All views given by the loader are embedded: rows are ordered
+        subject by subject, then view by view. A loader giving only
+        the reference view makes one forward pass per subject.
+        If view_cache (ViewCache) is given, the embedded views are kept
+        in it, keyed by row. The model is in eval mode."""
 
         # Initialization
         X = torch.zeros([0, self.config.num_outputs]).cpu()
         filenames_list = []
 
         # Computes embeddings without computing gradient
-        with torch.no_grad():
+        with torch.no_grad(), self.evaluation_mode():
             for (inputs, filenames) in loader:
-                # First views of the whole batch
-                inputs = inputs.cuda()
-                model = self.cuda()
-                X_i = model.forward(inputs[:, 0, :])
-                # Second views of the whole batch
-                X_j = model.forward(inputs[:, 1, :])
-                # First views and second views
-                # are put side by side
-                X_reordered = torch.cat([X_i, X_j], dim=-1)
-                X_reordered = X_reordered.view(-1, X_i.shape[-1])
+                if view_cache is not None:
+                    view_cache.put_batch(X.shape[0], inputs)
+                device = self.inference_device()
+                inputs = inputs.to(device)
+                model = self.to(device)
+                nb_views = inputs.shape[1]
+                X_views = [model.forward(inputs[:, view, :])
+                           for view in range(nb_views)]
+                # Views of a same subject are put side by side
+                X_reordered = torch.stack(X_views, dim=1)
+                X_reordered = X_reordered.view(-1, X_views[0].shape[-1])
                 X = torch.cat((X, X_reordered.cpu()), dim=0)
                 filenames_duplicate = [item
                                        for item in filenames
-                                       for repetitions in range(2)]
+                                       for repetitions in range(nb_views)]
                 filenames_list = filenames_list + filenames_duplicate
                 del inputs
 
         return X, filenames_list
 
-    def compute_representations(self, loader):
+    def compute_representations(self, loader, view_cache=None):
         """Computes representations for each crop.
 
-        Representation are before the projection head"""
+        Representation are before the projection head.
+        Rows are ordered as in compute_outputs_skeletons,
+        which also describes view_cache."""
 
         # Initialization
         X = torch.zeros([0, self.config.num_representation_features]).cpu()
         filenames_list = []
 
         # Computes representation (without gradient computation)
-        with torch.no_grad():
+        with torch.no_grad(), self.evaluation_mode():
             for (inputs, filenames) in loader:
-                # First views of the whole batch
-                inputs = inputs.cuda()
-                model = self.cuda()
-                model.forward(inputs[:, 0, :])
-                X_i = first(self.save_output.outputs.values())
-                # Second views of the whole batch
-                model.forward(inputs[:, 1, :])
-                X_j = first(self.save_output.outputs.values())
-                # First views and second views are put side by side
-                X_reordered = torch.cat([X_i, X_j], dim=-1)
-                X_reordered = X_reordered.view(-1, X_i.shape[-1])
+                if view_cache is not None:
+                    view_cache.put_batch(X.shape[0], inputs)
+                device = self.inference_device()
+                inputs = inputs.to(device)
+                model = self.to(device)
+                nb_views = inputs.shape[1]
+                X_views = []
+                for view in range(nb_views):
+                    model.forward(inputs[:, view, :])
+                    X_views.append(first(self.save_output.outputs.values()))
+                # Views of a same subject are put side by side
+                X_reordered = torch.stack(X_views, dim=1)
+                X_reordered = X_reordered.view(-1, X_views[0].shape[-1])
                 X = torch.cat((X, X_reordered.cpu()), dim=0)
                 filenames_duplicate = [
                     item for item in filenames
-                    for repetitions in range(2)]
+                    for repetitions in range(nb_views)]
                 filenames_list = filenames_list + filenames_duplicate
                 del inputs
 
         return X, filenames_list
 
+    def fit_tsne(self, X):
+        """Fits t-SNE on already computed embeddings"""
+
+        tsne = registry.get('TSNE')(n_components=2, perplexity=5,
+                                    init='pca', random_state=50)
+
+        Y = X.detach().numpy() if torch.is_tensor(X) else X
+
+        # Returns tsne embeddings
+        return tsne.fit_transform(Y)
+
     def compute_tsne(self, loader, register):
         """Computes t-SNE.
 
@@ -190,55 +296,46 @@ class ContrastiveLearner(DenseNet):
             raise ValueError(
                 "Argument register must be either output or representation")
 
-        tsne = TSNE(n_components=2, perplexity=5, init='pca', random_state=50)
-
-        Y = X.detach().numpy()
-
         # Makes the t-SNE fit
-        X_tsne = tsne.fit_transform(Y)
-
-        # Returns tsne embeddings
-        return X_tsne
+        return self.fit_tsne(X)
 
     def training_epoch_end(self, outputs):
-        """Computation done at the end of the epoch"""
+        """Computation done at the end of the epoch
+
+        Visualizations are made by the first process only."""
 
         # Computes t-SNE both in representation and output space
-        if self.current_epoch % self.config.nb_epochs_per_tSNE == 0 \
-                or self.current_epoch >= self.config.max_epochs:
+        if self.global_rank == 0 and (
+                self.current_epoch % self.config.nb_epochs_per_tSNE == 0
+                or self.current_epoch >= self.config.max_epochs):
             X_tsne = self.compute_tsne(
                 self.sample_data.train_dataloader(), "output")
-            image_TSNE = plot_tsne(X_tsne, buffer=True)
-            self.logger.experiment.add_image(
-                'TSNE output image', image_TSNE, self.current_epoch)
+            self.logger.experiment.add_embedding(
+                X_tsne, tag='TSNE output', global_step=self.current_epoch)
             X_tsne = self.compute_tsne(
                 self.sample_data.train_dataloader(), "representation")
-            image_TSNE = plot_tsne(X_tsne, buffer=True)
+            self.logger.experiment.add_embedding(
+                X_tsne, tag='TSNE representation',
+                global_step=self.current_epoch)
+
+        if self.global_rank == 0:
+            # Logs histogram of sim_zij
+            self.logger.experiment.add_histogram(
+                'histo_sim_zij', self.sim_zij, self.current_epoch)
+
+            # Plots views
+            plot_bucket = registry.get('plot_bucket')
+            image_input_i = plot_bucket(self.sample_i, buffer=True)
+            self.logger.experiment.add_image(
+                'input_i', image_input_i, self.current_epoch)
+            image_input_j = plot_bucket(self.sample_j, buffer=True)
             self.logger.experiment.add_image(
-                'TSNE representation image', image_TSNE, self.current_epoch)
-
-        # Computes histogram of sim_zij
-        histogram_sim_zij = plot_histogram(self.sim_zij, buffer=True)
-        self.logger.experiment.add_image(
-            'histo_sim_zij', histogram_sim_zij, self.current_epoch)
-
-        # Plots views
-        image_input_i = plot_bucket(self.sample_i, buffer=True)
-        self.logger.experiment.add_image(
-            'input_i', image_input_i, self.current_epoch)
-        image_input_j = plot_bucket(self.sample_j, buffer=True)
-        self.logger.experiment.add_image(
-            'input_j', image_input_j, self.current_epoch)
-
-        # Plots view using anatomist
-        image_input_i = self.visu_anatomist.plot_bucket(
-            self.sample_i, buffer=True)
-        self.logger.experiment.add_image(
-            'input_ana_i', image_input_i, self.current_epoch)
-        image_input_j = self.visu_anatomist.plot_bucket(
-            self.sample_j, buffer=True)
-        self.logger.experiment.add_image(
-            'input_ana_j', image_input_j, self.current_epoch)
+                'input_j', image_input_j, self.current_epoch)
+
+            # Plots view using anatomist, in the background
+            self.log_snapshots()
+            self.submit_snapshot('input_ana_i', self.sample_i)
+            self.submit_snapshot('input_ana_j', self.sample_j)
 
         # Plots one representation image
         # image_output = plot_output(
@@ -269,8 +366,8 @@ class ContrastiveLearner(DenseNet):
         """Validation step"""
 
         (inputs, filenames) = val_batch
-        z_i = self.forward(inputs[:, 0, :])
-        z_j = self.forward(inputs[:, 1, :])
+        z_i = self.gather_batch(self.forward(inputs[:, 0, :]))
+        z_j = self.gather_batch(self.forward(inputs[:, 1, :]))
         batch_loss, sim_zij, sim_zii, sim_zjj = self.nt_xen_loss(z_i, z_j)
         self.log('val_loss', float(batch_loss))
 
@@ -290,22 +387,21 @@ class ContrastiveLearner(DenseNet):
     def validation_epoch_end(self, outputs):
         """Computaion done at the end of each validation epoch"""
 
-        # Computes t-SNE
-        if self.current_epoch % self.config.nb_epochs_per_tSNE == 0 \
-                or self.current_epoch >= self.config.max_epochs:
+        # Computes t-SNE on the first process only
+        if self.global_rank == 0 and (
+                self.current_epoch % self.config.nb_epochs_per_tSNE == 0
+                or self.current_epoch >= self.config.max_epochs):
             X_tsne = self.compute_tsne(
                 self.sample_data.val_dataloader(), "output")
-            image_TSNE = plot_tsne(X_tsne, buffer=True)
-            self.logger.experiment.add_image(
-                'TSNE output validation image', image_TSNE, self.current_epoch)
+            self.logger.experiment.add_embedding(
+                X_tsne, tag='TSNE output validation',
+                global_step=self.current_epoch)
             X_tsne = self.compute_tsne(
                 self.sample_data.val_dataloader(),
                 "representation")
-            image_TSNE = plot_tsne(X_tsne, buffer=True)
-            self.logger.experiment.add_image(
-                'TSNE representation validation image',
-                image_TSNE,
-                self.current_epoch)
+            self.logger.experiment.add_embedding(
+                X_tsne, tag='TSNE representation validation',
+                global_step=self.current_epoch)
 
         # Plots one representation image
         # image_output = plot_output(
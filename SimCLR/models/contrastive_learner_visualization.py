@@ -8,7 +8,6 @@ import torch
 
 from SimCLR.losses import NTXenLoss
 from SimCLR.models.contrastive_learner import ContrastiveLearner
-from SimCLR.utils.plots.visualize_anatomist import Visu_Anatomist
 
 
 class ContrastiveLearner_Visualization(ContrastiveLearner):
@@ -23,7 +22,6 @@ class ContrastiveLearner_Visualization(ContrastiveLearner):
         self.val_sample_i = []
         self.val_sample_j = []
         self.recording_done = False
-        self.visu_anatomist = Visu_Anatomist()
 
     def custom_histogram_adder(self):
 
@@ -51,11 +49,7 @@ class ContrastiveLearner_Visualization(ContrastiveLearner):
             self.sample_j.append(inputs[:, 1, :].cpu())
 
     def training_epoch_end(self, outputs):
-        image_input_i = self.visu_anatomist.plot_bucket(
-            self.sample_i, buffer=True)
-        self.logger.experiment.add_image(
-            'input_test_i', image_input_i, self.current_epoch)
-        image_input_j = self.visu_anatomist.plot_bucket(
-            self.sample_j, buffer=True)
-        self.logger.experiment.add_image(
-            'input_test_j', image_input_j, self.current_epoch)
+        self.log_snapshots()
+        # Snapshots of the last recorded batches
+        self.submit_snapshot('input_test_i', self.sample_i[-1])
+        self.submit_snapshot('input_test_j', self.sample_j[-1])
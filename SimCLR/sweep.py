@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This program trains a grid of configurations with successive halving
+
+The grid is given with the hydra multirun syntax, for instance:
+
+    num_representation_features=2,4,8,16,32 temperature=0.1,0.3,0.5
+
+All trials are first trained for min_epochs. At each rung, only the best
+1/eta trials (on val_loss or silhouette score) are trained eta times
+longer, until max_epochs. Trials are trained in a pool of worker
+processes, each with its own GPU, or on CPU without GPU (see
+worker_pool). The crops are loaded, padded and split once in the main
+process (see SharedCrops) before the workers are started.
+
+Each trial is saved as a training subfolder (.hydra/config.yaml and
+logs/default/version_0/checkpoints), so that it can be evaluated with
+loop_validate_and_clusterize.py.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+
+import six
+from hydra import compose
+from hydra import initialize_config_dir
+from hydra.core.override_parser.overrides_parser import OverridesParser
+from omegaconf import OmegaConf
+
+from SimCLR.evaluation.loop_validate_and_clusterize import get_checkpoint
+from SimCLR.evaluation.loop_validate_and_clusterize import get_shared_crops
+from SimCLR.evaluation.loop_validate_and_clusterize import \
+    platform_overrides
+from SimCLR.evaluation.loop_validate_and_clusterize import share_crops
+from SimCLR.evaluation.loop_validate_and_clusterize import worker_device
+from SimCLR.evaluation.loop_validate_and_clusterize import worker_pool
+from SimCLR.utils.config import process_config
+
+log = logging.getLogger(__name__)
+
+_CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "configs")
+
+# Metrics on which trials are ranked, with True if higher is better
+_METRICS = {'val_loss': False, 'silhouette': True}
+
+
+def parse_args(argv):
+    """Parses command-line arguments
+
+    Args:
+        argv: a list containing command line arguments
+
+    Returns:
+        args
+    """
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog='sweep.py',
+        description='Trains a grid of configurations '
+                    'with successive halving')
+    parser.add_argument(
+        "-o", "--overrides", type=str, nargs='+', required=True,
+        help='Overrides in hydra multirun syntax, '
+             'e.g. temperature=0.1,0.5 num_representation_features=4,8')
+    parser.add_argument(
+        "-s", "--sweep_dir", type=str, required=True,
+        help='Directory where the training subfolders are written.')
+    parser.add_argument(
+        "-n", "--nb_workers", type=int, default=1,
+        help='Number of trials trained in parallel.')
+    parser.add_argument(
+        "-e", "--min_epochs", type=int, default=10,
+        help='Number of epochs of the first rung.')
+    parser.add_argument(
+        "--eta", type=int, default=3,
+        help='Reduction factor: 1/eta of the trials are kept at each rung, '
+             'and trained eta times longer.')
+    parser.add_argument(
+        "-m", "--metric", type=str, default='val_loss',
+        choices=sorted(_METRICS),
+        help='Metric on which trials are ranked.')
+    parser.add_argument(
+        "-d", "--cache_dir", type=str, default=None,
+        help='Directory where padded crops are memory-mapped from.')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def expand_overrides(overrides):
+    """Expands multirun overrides into the overrides of each trial
+
+    Returns:
+        list of lists of overrides, as done by the hydra basic sweeper
+    """
+    parser = OverridesParser.create()
+    choices = []
+    for override in parser.parse_overrides(overrides):
+        key = override.get_key_element()
+        if override.is_sweep_override():
+            choices.append([f"{key}={value}"
+                            for value in override.sweep_string_iterator()])
+        else:
+            choices.append([f"{key}={override.get_value_element_as_str()}"])
+    return [list(trial) for trial in itertools.product(*choices)]
+
+
+def create_trial(trial_dir, overrides):
+    """Composes the configuration of a trial and saves it in trial_dir
+
+    The configuration is saved as .hydra/config.yaml, as hydra does.
+
+    Returns:
+        processed configuration
+    """
+    with initialize_config_dir(config_dir=_CONFIG_DIR):
+        config = compose(config_name="config", overrides=overrides)
+    os.makedirs(f"{trial_dir}/.hydra", exist_ok=True)
+    OmegaConf.save(config, f"{trial_dir}/.hydra/config.yaml")
+    with open(f"{trial_dir}/.hydra/overrides.json", 'w') as f:
+        json.dump(overrides, f)
+    return process_config(config)
+
+
+def embedding_silhouette(model, loader, n_clusters=2):
+    """Returns the silhouette score of a k-means of the embeddings"""
+    from sklearn.cluster import KMeans
+
+    from SimCLR.evaluation.silhouette import silhouette_score
+    embeddings, _ = model.compute_representations(loader)
+    embeddings = embeddings.numpy()
+    labels = KMeans(n_clusters=n_clusters,
+                    random_state=0).fit_predict(embeddings)
+    return float(silhouette_score(embeddings, labels))
+
+
+def train_trial(trial_dir, config, max_epochs):
+    """Trains a trial up to max_epochs, resuming from its last checkpoint
+
+    In a worker process, the trial runs on the device of the worker.
+
+    Returns:
+        tuple (trial_dir, metrics or None, error message or None)
+    """
+    # Imported here, so that the main process does not import the model
+    # before it has loaded the crops
+    from pytorch_lightning import loggers as pl_loggers
+
+    from SimCLR.main import train_model
+    try:
+        config = config.copy()
+        config.max_epochs = max_epochs
+        config.checkpoint_path = get_checkpoint(trial_dir)
+        for key, value in platform_overrides(worker_device()).items():
+            config[key] = value
+        logger = pl_loggers.TensorBoardLogger(f"{trial_dir}/logs",
+                                              name='default', version=0)
+        model, trainer = train_model(
+            config, logger=logger,
+            shared=get_shared_crops(config))
+        metrics = {
+            'epochs': max_epochs,
+            'val_loss': float(trainer.callback_metrics['val_loss']),
+            'silhouette': embedding_silhouette(
+                model, model.sample_data.val_dataloader())}
+    except Exception as exc:
+        log.exception(f"Training of {trial_dir} failed")
+        return trial_dir, None, repr(exc)
+    return trial_dir, metrics, None
+
+
+def run_rung(trials, budget, pool=None):
+    """Trains the trials up to budget epochs
+
+    Returns:
+        dict trial_dir -> metrics, without the failed trials
+    """
+    runs = [(trial_dir, config, min(budget, config.max_epochs))
+            for trial_dir, config in trials.items()]
+    if pool is None:
+        results = [train_trial(*run) for run in runs]
+    else:
+        results = pool.starmap(train_trial, runs, chunksize=1)
+
+    rung = {}
+    for trial_dir, metrics, error in results:
+        if error:
+            print(f"{trial_dir}: FAILED ({error})")
+        else:
+            print(f"{trial_dir}: {metrics}")
+            rung[trial_dir] = metrics
+    return rung
+
+
+def successive_halving(trials, min_epochs=10, eta=3, metric='val_loss',
+                       pool=None):
+    """Trains the trials, keeping the best 1/eta of them at each rung
+
+    Args:
+        trials (dict): trial_dir -> processed configuration
+        min_epochs (int): number of epochs of the first rung
+        eta (int): reduction factor of the number of trials,
+            and growth factor of the number of epochs
+        metric (str): 'val_loss' or 'silhouette'
+        pool: optional pool in which trials are trained (see worker_pool)
+
+    Returns:
+        dict trial_dir -> list of the metrics of each rung
+    """
+    higher_is_better = _METRICS[metric]
+    max_epochs = max(config.max_epochs for config in trials.values())
+    history = {trial_dir: [] for trial_dir in trials}
+    survivors = dict(trials)
+    budget = min_epochs
+    while survivors:
+        log.info(f"Rung of {budget} epochs: {len(survivors)} trials")
+        rung = run_rung(survivors, budget, pool=pool)
+        for trial_dir, metrics in rung.items():
+            history[trial_dir].append(metrics)
+        if budget >= max_epochs:
+            break
+
+        ranking = sorted(rung, key=lambda trial_dir: rung[trial_dir][metric],
+                         reverse=higher_is_better)
+        survivors = {trial_dir: trials[trial_dir]
+                     for trial_dir in ranking[:max(1, len(rung) // eta)]}
+        # The last trial is trained directly up to the end
+        budget = max_epochs if len(survivors) == 1 else budget * eta
+    return history
+
+
+def sweep(overrides, sweep_dir, nb_workers=1, min_epochs=10, eta=3,
+          metric='val_loss', cache_dir=None):
+    """Trains the grid of configurations given by the multirun overrides
+
+    The history of the trials is saved in sweep_dir/sweep.json.
+    """
+    trials = {}
+    for number, trial_overrides in enumerate(expand_overrides(overrides)):
+        trial_dir = os.path.abspath(f"{sweep_dir}/trial_{number:03d}")
+        trials[trial_dir] = create_trial(trial_dir, trial_overrides)
+        log.info(f"{trial_dir}: {trial_overrides}")
+
+    # Loads the crops before starting the workers
+    for config in trials.values():
+        share_crops(config, cache_dir=cache_dir)
+
+    if nb_workers <= 1:
+        history = successive_halving(trials, min_epochs=min_epochs, eta=eta,
+                                     metric=metric)
+    else:
+        with worker_pool(nb_workers) as pool:
+            history = successive_halving(trials, min_epochs=min_epochs,
+                                         eta=eta, metric=metric, pool=pool)
+
+    with open(f"{sweep_dir}/sweep.json", 'w') as f:
+        json.dump(history, f, indent=2)
+    return history
+
+
+def main(argv):
+    """Reads argument line and launches sweep
+
+    Args:
+        argv: a list containing command line arguments
+    """
+
+    # This code permits to catch SystemExit with exit code 0
+    # such as the one raised when "--help" is given as argument
+    try:
+        # Parsing arguments
+        args = parse_args(argv)
+        sweep(args.overrides, args.sweep_dir,
+              nb_workers=args.nb_workers,
+              min_epochs=args.min_epochs,
+              eta=args.eta,
+              metric=args.metric,
+              cache_dir=args.cache_dir)
+    except SystemExit as exc:
+        if exc.code != 0:
+            six.reraise(*sys.exc_info())
+
+
+if __name__ == '__main__':
+    # This permits to call main also from another python program
+    # without having to make system calls
+    main(argv=sys.argv[1:])
+
+    # example of use
+    # python3 sweep.py -s ../../Output/sweep -n 4 -e 10 \
+    #   -o num_representation_features=2,4,8,16,32 temperature=0.1,0.3,0.5
@@ -34,6 +34,15 @@ def parse_args(argv):
     parser.add_argument(
         "-c", "--csv_file", type=str, required=True,
         help='csv file on which is done the evaluation.')
+    parser.add_argument(
+        "-n", "--nb_workers", type=int, default=1,
+        help='Number of checkpoints evaluated in parallel.')
+    parser.add_argument(
+        "-f", "--force", action='store_true',
+        help='Evaluates also subfolders whose result.json is up to date.')
+    parser.add_argument(
+        "-d", "--cache_dir", type=str, default=None,
+        help='Directory where padded crops are memory-mapped from.')
 
     args = parser.parse_args(argv)
 
@@ -55,7 +64,10 @@ def main(argv):
         src_dir = abspath(args.src_dir)
         csv_file = abspath(args.csv_file)
 
-        loop_over_directory(src_dir, csv_file)
+        loop_over_directory(src_dir, csv_file,
+                            nb_workers=args.nb_workers,
+                            force=args.force,
+                            cache_dir=args.cache_dir)
         plot_loss_silhouette_score(src_dir)
     except SystemExit as exc:
         if exc.code != 0:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This program measures the scaling of CPU data-parallel training
+
+The model is trained on random crops with 1, 2, ..., N processes
+(torch DDP, gloo backend). Each process has the same batch size (weak
+scaling), so that N processes should process N times more samples per
+second than one process; the efficiency is the fraction of this ideal
+speed-up that is reached.
+"""
+import argparse
+import os
+import sys
+import time
+
+import six
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from SimCLR.utils.cpu_parallel import available_cores
+from SimCLR.utils.cpu_parallel import node_partition
+
+# Crops of the cingulate region
+_IN_SHAPE = (1, 20, 40, 40)
+
+
+def parse_args(argv):
+    """Parses command-line arguments
+
+    Args:
+        argv: a list containing command line arguments
+
+    Returns:
+        args
+    """
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog='benchmark_cpu_scaling.py',
+        description='Measures the scaling of CPU data-parallel training')
+    parser.add_argument(
+        "-m", "--model", type=str, default='densenet',
+        choices=['densenet', 'vae'],
+        help='Model trained: the SimCLR DenseNet or the beta-VAE.')
+    parser.add_argument(
+        "-n", "--nb_processes", type=int, default=None,
+        help='Maximal number of processes. '
+             'Default is the number of cores // (loader cores + 1).')
+    parser.add_argument(
+        "-b", "--batch_size", type=int, default=16,
+        help='Batch size of each process.')
+    parser.add_argument(
+        "-s", "--steps", type=int, default=20,
+        help='Number of timed training steps.')
+    parser.add_argument(
+        "-l", "--loader_cores_per_process", type=int, default=0,
+        help='Cores kept for the loader workers of each process.')
+    parser.add_argument(
+        "--no_pinning", action='store_true',
+        help='Does not pin the processes to their cores.')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def build_model(model):
+    """Returns (module, loss function of a batch of crops)"""
+    if model == 'densenet':
+        from SimCLR.backbones.densenet import DenseNet
+        from SimCLR.losses import NTXenLoss
+        # Parameters of configs/backbone/DenseNet.yaml
+        densenet = DenseNet(growth_rate=32, block_config=[6, 16],
+                            num_init_features=64,
+                            num_representation_features=4,
+                            num_outputs=4)
+        criterion = NTXenLoss(temperature=0.1)
+
+        def loss(module, inputs):
+            # The two views are the crop and its mirror
+            return criterion(module(inputs), module(inputs.flip(-1)))
+        return densenet, loss
+
+    # beta-VAE modules are imported from their directory, as main.py does
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', '..', 'betaVAE'))
+    from vae import VAE
+    from vae import vae_loss
+    vae = VAE(_IN_SHAPE, 4, depth=3)
+    criterion = torch.nn.CrossEntropyLoss(
+        weight=torch.FloatTensor([1, 2]), reduction='sum')
+
+    def loss(module, inputs):
+        output, z, logvar = module(inputs)
+        target = torch.squeeze(inputs, dim=1).long()
+        return vae_loss(output, target, z, logvar, criterion,
+                        kl_weight=2)[2]
+    return vae, loss
+
+
+def _train_process(rank, world_size, args, queue):
+    """Trains the model in process rank and reports its duration"""
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    if not args.no_pinning:
+        node_partition(world_size,
+                       args.loader_cores_per_process).pin_process(rank)
+
+    torch.manual_seed(rank)
+    module, loss = build_model(args.model)
+    model = DistributedDataParallel(module)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    inputs = (torch.rand(args.batch_size, *_IN_SHAPE) > 0.9).float()
+
+    def step():
+        optimizer.zero_grad()
+        loss(model, inputs).backward()
+        optimizer.step()
+
+    # Warm-up step, then timed steps
+    step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    if rank == 0:
+        queue.put(time.perf_counter() - start)
+    dist.destroy_process_group()
+
+
+def time_training(world_size, args):
+    """Returns the duration of args.steps steps with world_size processes"""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29501")
+    queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_train_process, args=(world_size, args, queue),
+             nprocs=world_size, join=True)
+    return queue.get()
+
+
+def benchmark_cpu_scaling(args):
+    """Prints the speed and efficiency of training with 1..N processes"""
+    nb_processes = args.nb_processes
+    if nb_processes is None:
+        nb_processes = max(1, len(available_cores())
+                           // (args.loader_cores_per_process + 1))
+    print(f"{args.model}: batch size {args.batch_size} per process, "
+          f"{len(available_cores())} cores")
+    speed_1 = None
+    for world_size in range(1, nb_processes + 1):
+        duration = time_training(world_size, args)
+        speed = world_size * args.batch_size * args.steps / duration
+        speed_1 = speed_1 or speed
+        print(f"{world_size} processes: {speed:.1f} samples/s; "
+              f"efficiency {speed / (world_size * speed_1):.2f}")
+
+
+def main(argv):
+    """Reads argument line and launches benchmark_cpu_scaling
+
+    Args:
+        argv: a list containing command line arguments
+    """
+
+    # This code permits to catch SystemExit with exit code 0
+    # such as the one raised when "--help" is given as argument
+    try:
+        # Parsing arguments
+        args = parse_args(argv)
+        benchmark_cpu_scaling(args)
+    except SystemExit as exc:
+        if exc.code != 0:
+            six.reraise(*sys.exc_info())
+
+
+if __name__ == '__main__':
+    # This permits to call main also from another python program
+    # without having to make system calls
+    main(argv=sys.argv[1:])
+
+    # example of use
+    # python3 benchmark_cpu_scaling.py -m vae -n 4 -b 16 -l 1
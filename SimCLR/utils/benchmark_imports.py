@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This program measures the time needed to import modules
+
+Each import is done in a new python process, several times, and the
+median time is reported together with the heavy visualization modules
+that the import has loaded.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+import six
+
+_DEFAULT_MODULES = ["SimCLR.models.contrastive_learner",
+                    "SimCLR.main",
+                    "SimCLR.evaluation.validate_and_clusterize"]
+
+# Modules that should be loaded only when a visualization is made
+_HEAVY_MODULES = ["anatomist", "soma", "deep_folding", "colorado",
+                  "matplotlib", "mpl_toolkits", "sklearn.manifold"]
+
+_TIMING_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{"duration": duration, "heavy": heavy}}))
+"""
+
+
+def parse_args(argv):
+    """Parses command-line arguments
+
+    Args:
+        argv: a list containing command line arguments
+
+    Returns:
+        args
+    """
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog='benchmark_imports.py',
+        description='Measures the import time of modules')
+    parser.add_argument(
+        "-m", "--modules", type=str, nargs='+', default=_DEFAULT_MODULES,
+        help='Modules to import.')
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5,
+        help='Number of imports of each module, each in a new process.')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def time_import(module, repeat=5):
+    """Imports module in repeat new processes
+
+    Returns:
+        tuple (median duration in seconds, heavy modules loaded),
+        or (None, error message) if the import fails
+    """
+    code = _TIMING_CODE.format(module=module, heavy=_HEAVY_MODULES)
+    durations = []
+    heavy = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, "-c", code],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            return None, process.stderr.strip().splitlines()[-1]
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        durations.append(result["duration"])
+        heavy = result["heavy"]
+    return statistics.median(durations), heavy
+
+
+def benchmark_imports(modules, repeat=5):
+    """Prints the import time of each module"""
+    for module in modules:
+        duration, heavy = time_import(module, repeat=repeat)
+        if duration is None:
+            print(f"{module}: FAILED ({heavy})")
+        else:
+            print(f"{module}: {duration:.3f} s; "
+                  f"heavy modules loaded: {heavy or 'none'}")
+
+
+def main(argv):
+    """Reads argument line and launches benchmark_imports
+
+    Args:
+        argv: a list containing command line arguments
+    """
+
+    # This code permits to catch SystemExit with exit code 0
+    # such as the one raised when "--help" is given as argument
+    try:
+        # Parsing arguments
+        args = parse_args(argv)
+        benchmark_imports(args.modules, repeat=args.repeat)
+    except SystemExit as exc:
+        if exc.code != 0:
+            six.reraise(*sys.exc_info())
+
+
+if __name__ == '__main__':
+    # This permits to call main also from another python program
+    # without having to make system calls
+    main(argv=sys.argv[1:])
+
+    # example of use
+    # python3 benchmark_imports.py -m SimCLR.models.contrastive_learner -r 10
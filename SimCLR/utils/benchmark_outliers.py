@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This program measures the outlier analysis of the evaluation losses
+
+Random losses are given to N subjects, and find_outliers is timed on
+them. The former analysis, which rebuilt the list of losses for each
+subject, is quadratic: it is timed on a smaller population and its
+duration for N subjects is extrapolated.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import scipy.stats as stat
+import six
+
+from SimCLR.evaluation.outliers import find_outliers
+
+
+def parse_args(argv):
+    """Parses command-line arguments
+
+    Args:
+        argv: a list containing command line arguments
+
+    Returns:
+        args
+    """
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog='benchmark_outliers.py',
+        description='Measures the outlier analysis of the losses')
+    parser.add_argument(
+        "-n", "--nb_subjects", type=int, default=100000,
+        help='Number of subjects.')
+    parser.add_argument(
+        "-l", "--nb_subjects_legacy", type=int, default=2000,
+        help='Number of subjects on which the former analysis is timed.')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def legacy_outliers(results):
+    """Outlier analysis as formerly done in eval_tools
+
+    Returns:
+        list of (subject, loss) of the outliers
+    """
+    quantile = stat.mstats.mquantiles(
+        [res[0] for res in results.values()], prob=[0.25, 0.75])
+    return [(key, value[0]) for key, value in results.items()
+            if value[0] > min(max([res[0] for res in results.values()]),
+                              quantile[1] + 1.5 * (quantile[1] - quantile[0]))]
+
+
+def random_results(nb_subjects, rng):
+    """Returns dictionary subject -> (loss,), with heavy-tailed losses"""
+    losses = rng.lognormal(mean=0., sigma=0.5, size=nb_subjects)
+    return {f"sub-{i:06d}": (loss,) for i, loss in enumerate(losses)}
+
+
+def benchmark_outliers(nb_subjects=100000, nb_subjects_legacy=2000):
+    """Prints the durations of the vectorized and former analyses"""
+    rng = np.random.default_rng(0)
+
+    results = random_results(nb_subjects_legacy, rng)
+    start = time.perf_counter()
+    expected = legacy_outliers(results)
+    legacy = time.perf_counter() - start
+    _, outliers = find_outliers(list(results.keys()),
+                                [res[0] for res in results.values()])
+    assert list(zip(outliers['subject'], outliers['loss'])) == expected
+
+    results = random_results(nb_subjects, rng)
+    start = time.perf_counter()
+    stats, outliers = find_outliers(list(results.keys()),
+                                    [res[0] for res in results.values()])
+    vectorized = time.perf_counter() - start
+    extrapolated = legacy * (nb_subjects / nb_subjects_legacy)**2
+
+    print(f"{nb_subjects} subjects, {len(outliers)} outliers "
+          f"(threshold {stats['threshold']:.3f})")
+    print(f"find_outliers: {vectorized:.3f} s")
+    print(f"former analysis: {legacy:.3f} s for {nb_subjects_legacy} "
+          f"subjects, about {extrapolated:.0f} s for {nb_subjects}")
+
+
+def main(argv):
+    """Reads argument line and launches benchmark_outliers
+
+    Args:
+        argv: a list containing command line arguments
+    """
+
+    # This code permits to catch SystemExit with exit code 0
+    # such as the one raised when "--help" is given as argument
+    try:
+        # Parsing arguments
+        args = parse_args(argv)
+        benchmark_outliers(nb_subjects=args.nb_subjects,
+                           nb_subjects_legacy=args.nb_subjects_legacy)
+    except SystemExit as exc:
+        if exc.code != 0:
+            six.reraise(*sys.exc_info())
+
+
+if __name__ == '__main__':
+    # This permits to call main also from another python program
+    # without having to make system calls
+    main(argv=sys.argv[1:])
+
+    # example of use
+    # python3 benchmark_outliers.py -n 100000 -l 2000
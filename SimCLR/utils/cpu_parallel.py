@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Partition of the CPU cores between data-parallel processes
+
+On CPU nodes, each training process gets its own set of cores: a few
+of them for its data loader workers, the others for its compute threads
+(torch.set_num_threads). Processes and loader workers are pinned to
+their cores, so that they do not compete for the same cores.
+"""
+import functools
+import logging
+import os
+
+import torch
+
+log = logging.getLogger(__name__)
+
+
+def available_cores():
+    """Returns the cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _set_affinity(cores):
+    # Core pinning is not available on all systems (e.g. macOS)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+class CorePartition():
+    """Cores of each process, split between loader workers and compute
+    """
+
+    def __init__(self, nb_processes, loader_cores_per_process=2, cores=None):
+        """
+        Args:
+            nb_processes (int): number of processes on this node
+            loader_cores_per_process (int): cores given to the data loader
+                workers of each process; 0 to share the compute cores
+            cores (list of int): cores to partition,
+                defaults to the cores available to this process
+        """
+        cores = available_cores() if cores is None else list(cores)
+        cores_per_process = len(cores) // nb_processes
+        if cores_per_process <= loader_cores_per_process:
+            raise ValueError(
+                f"{len(cores)} cores cannot be split between {nb_processes} "
+                f"processes with {loader_cores_per_process} loader cores each")
+        self.nb_processes = nb_processes
+        self.loader_cores_per_process = loader_cores_per_process
+        self.process_cores = [
+            cores[rank * cores_per_process:(rank + 1) * cores_per_process]
+            for rank in range(nb_processes)]
+
+    def compute_cores(self, local_rank):
+        """Cores of the compute threads of process local_rank"""
+        return self.process_cores[local_rank][self.loader_cores_per_process:]
+
+    def loader_cores(self, local_rank):
+        """Cores of the loader workers of process local_rank"""
+        if self.loader_cores_per_process == 0:
+            return self.compute_cores(local_rank)
+        return self.process_cores[local_rank][:self.loader_cores_per_process]
+
+    def pin_process(self, local_rank):
+        """Pins the current process to its compute cores
+
+        torch uses one compute thread per core.
+        """
+        cores = self.compute_cores(local_rank)
+        _set_affinity(cores)
+        torch.set_num_threads(len(cores))
+        log.info(f"Process {local_rank} pinned to cores {cores}")
+
+    def worker_init_fn(self, local_rank):
+        """Returns the worker_init_fn of the DataLoader of process local_rank
+
+        Each loader worker is pinned to the loader cores
+        and uses a single thread.
+        """
+        return _PinWorker(self.loader_cores(local_rank))
+
+
+@functools.lru_cache()
+def node_partition(nb_processes, loader_cores_per_process=2):
+    """Returns the partition of the cores of the node
+
+    It is computed once per process, before the process is pinned,
+    so that the data module and the model get the same partition.
+    """
+    return CorePartition(nb_processes, loader_cores_per_process)
+
+
+class _PinWorker():
+    """Picklable worker_init_fn pinning loader workers"""
+
+    def __init__(self, cores):
+        self.cores = cores
+
+    def __call__(self, worker_id):
+        _set_affinity([self.cores[worker_id % len(self.cores)]])
+        torch.set_num_threads(1)
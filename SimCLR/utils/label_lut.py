@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Remapping of skeleton labels with a lookup table
+
+Skeleton voxels carry integer labels between 0 and 255 (0 background,
+30 bottom, 60 simple surface, ...). A remapping of these labels is a
+table of 256 entries, applied in a single pass to a sample or to a whole
+batch, whatever the number of labels changed:
+
+    binarize = LabelLUT.from_function(lambda labels: labels > 0)
+    batch = binarize(batch)
+
+Two remappings applied one after the other are also a single table
+(see LabelLUT.then).
+
+Floating-point arrays (as interpolated or normalized crops) are
+remapped value by value, as the former masks did, by the mapping or the
+function of the table; the table is only used for them if there is no
+function. Other arrays that are not labels (outside 0..255) are
+remapped by the function too.
+"""
+import numpy as np
+import torch
+
+_NB_LABELS = 256
+
+
+class LabelLUT():
+    """Lookup table of the new value of each label 0..255
+    """
+
+    def __init__(self, mapping=None, table=None, function=None):
+        """
+        Args:
+            mapping (dict): label -> new label; the other labels are kept
+            table (array): alternatively, the new value of each label,
+                of size [256]
+            function: optional, vectorized numpy function of the values,
+                applied to arrays that are not labels; by default, the
+                values equal to a key of mapping are replaced. Without
+                mapping nor function, such arrays raise a ValueError.
+        """
+        if table is None:
+            table = np.arange(_NB_LABELS)
+            for label, new_label in (mapping or {}).items():
+                table[label] = new_label
+            if function is None and mapping is not None:
+                function = self._mapping_function(mapping)
+        self.function = function
+        self.table = np.asarray(table)
+        if self.table.shape != (_NB_LABELS,):
+            raise ValueError(f"A label table has {_NB_LABELS} entries, "
+                             f"not {self.table.shape}")
+        # Table converted to the dtype (and device) of the inputs
+        self._tables = {}
+
+    @classmethod
+    def from_function(cls, function):
+        """Builds the table of a vectorized numpy function of the labels
+
+        The function is also applied to arrays that are not labels."""
+        return cls(table=np.asarray(function(np.arange(_NB_LABELS)),
+                                    dtype=np.int64),
+                   function=function)
+
+    @staticmethod
+    def _mapping_function(mapping):
+        def function(values):
+            out = values.copy()
+            for label, new_label in mapping.items():
+                out[values == label] = new_label
+            return out
+        return function
+
+    def then(self, other):
+        """Returns the table applying self, then other"""
+        def composed(values):
+            return other.function(self.function(values))
+        has_function = self.function is not None \
+            and other.function is not None
+        return LabelLUT(table=other.table[self.table],
+                        function=composed if has_function else None)
+
+    def _not_labels(self, values):
+        """Remaps values with the function, or raises ValueError"""
+        if self.function is None:
+            raise ValueError("Skeleton labels must be integers between 0 "
+                             f"and {_NB_LABELS - 1}")
+        return np.asarray(self.function(values)).astype(values.dtype,
+                                                        copy=False)
+
+    @staticmethod
+    def _are_labels(values, labels):
+        """True if values are integers in 0..255
+
+        labels are the values converted to integers."""
+        if labels.min() < 0 or labels.max() >= _NB_LABELS:
+            return False
+        if torch.is_tensor(values):
+            return not values.is_floating_point() \
+                or torch.equal(values, labels.to(values.dtype))
+        return np.issubdtype(values.dtype, np.integer) \
+            or np.array_equal(values, labels)
+
+    def _numpy(self, arr):
+        if self.function is not None \
+                and np.issubdtype(arr.dtype, np.floating):
+            return self._not_labels(arr)
+        key = arr.dtype
+        if key not in self._tables:
+            self._tables[key] = self.table.astype(arr.dtype)
+        if arr.dtype == np.uint8:
+            return np.take(self._tables[key], arr)
+        labels = arr.astype(np.intp)
+        if labels.size and not self._are_labels(arr, labels):
+            return self._not_labels(arr)
+        return np.take(self._tables[key], labels)
+
+    def _torch(self, tensor):
+        if self.function is not None and tensor.is_floating_point():
+            return torch.from_numpy(self._not_labels(
+                tensor.detach().cpu().numpy())).to(tensor.device)
+        labels = tensor.long()
+        if tensor.dtype != torch.uint8 and labels.numel() \
+                and not self._are_labels(tensor, labels):
+            return torch.from_numpy(self._not_labels(
+                tensor.detach().cpu().numpy())).to(tensor.device)
+        key = (tensor.dtype, tensor.device)
+        if key not in self._tables:
+            self._tables[key] = torch.from_numpy(self.table).to(
+                device=tensor.device, dtype=tensor.dtype)
+        return self._tables[key][labels]
+
+    def __call__(self, arr):
+        """Remaps the labels of an array or a tensor of any shape
+
+        Returns:
+            array or tensor of the same type, shape and dtype
+        """
+        if torch.is_tensor(arr):
+            return self._torch(arr)
+        return self._numpy(np.asarray(arr))
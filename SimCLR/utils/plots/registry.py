@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Registry of the visualization backends, imported at first use
+
+Matplotlib, sklearn t-SNE and Anatomist (with soma.aims and deep_folding)
+are slow to import, and Anatomist is missing on hosts without BrainVISA.
+Modules that only need them at epoch end or for analyses look them up
+here, so that importing the models stays light:
+
+    plot_bucket = registry.get('plot_bucket')
+
+New backends are registered with register(name, "module:attribute").
+"""
+import importlib
+import logging
+
+log = logging.getLogger(__name__)
+
+# name -> "module:attribute"
+_backends = {
+    'TSNE': "sklearn.manifold:TSNE",
+    'plot_bucket': "SimCLR.utils.plots.visualize_images:plot_bucket",
+    'plot_histogram': "SimCLR.utils.plots.visualize_images:plot_histogram",
+    'plot_img': "SimCLR.utils.plots.visualize_images:plot_img",
+    'plot_output': "SimCLR.utils.plots.visualize_images:plot_output",
+    'plot_tsne': "SimCLR.utils.plots.visualize_tsne:plot_tsne",
+    'RenderingService':
+        "SimCLR.utils.plots.rendering_service:RenderingService",
+    'Visu_Anatomist': "SimCLR.utils.plots.visualize_anatomist:Visu_Anatomist",
+}
+
+# Backends already imported
+_loaded = {}
+
+
+def register(name, target):
+    """Registers a backend
+
+    Args:
+        name (str): name given to get
+        target (str): "module:attribute", imported at the first get
+    """
+    _backends[name] = target
+    _loaded.pop(name, None)
+
+
+def get(name):
+    """Returns the backend name, importing it on first use
+
+    Raises:
+        KeyError if name is not registered,
+        ImportError if its module cannot be imported
+    """
+    if name not in _loaded:
+        if name not in _backends:
+            raise KeyError(f"Unknown visualization backend {name}; "
+                           f"registered: {sorted(_backends)}")
+        module_name, attribute = _backends[name].split(':')
+        log.debug(f"Importing visualization backend {name} "
+                  f"from {module_name}")
+        _loaded[name] = getattr(importlib.import_module(module_name),
+                                attribute)
+    return _loaded[name]
+
+
+def available(name):
+    """Returns True if the backend name can be imported"""
+    try:
+        get(name)
+    except ImportError:
+        return False
+    return True
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Rendering of bucket snapshots outside of the training loop
+
+The RenderingService keeps a pool of renderers, each one created once
+in its own worker thread. Volumes are submitted to the service, which
+returns futures of RGB image tensors of size [3, H, W], so that
+epoch-end logging never waits for the rendering.
+
+Anatomist is used if it is installed; otherwise, or if asked to,
+the volumes are rendered in numpy by render_voxels. Qt objects must be
+created and used by the thread owning the Qt application: the Anatomist
+renderer therefore lives in the main thread of a dedicated process
+(see RendererProcess), fed through a queue.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .voxel_renderer import render_voxels
+
+log = logging.getLogger(__name__)
+
+
+class NumpyRenderer:
+    """Renders a volume with the vectorized voxel renderer
+
+    Pure numpy: it does not need Anatomist nor a display.
+    """
+
+    def __init__(self, size=(320, 320)):
+        """
+        Args:
+            size (tuple): (height, width) of the images in pixels
+        """
+        self.size = size
+
+    def render(self, volume):
+        """Renders the non-zero voxels of a 3D volume
+
+        Args:
+            volume (array): 3D volume of size [size_X, size_Y, size_Z]
+
+        Returns:
+            float tensor of size [3, H, W] with values in [0, 1]
+        """
+        return render_voxels(volume, size=self.size)
+
+
+class AnatomistRenderer:
+    """Renders a volume as a bucket in a headless Anatomist 3D window
+    """
+
+    def __init__(self, width=320, height=320):
+        self.width = width
+        self.height = height
+        # Imported here, as Anatomist is not installed everywhere
+        import anatomist.headless as anatomist
+        from deep_folding.anatomist_tools.utils import remove_hull
+        from soma import aims
+        self.aims = aims
+        self.remove_hull = remove_hull
+        self.a = anatomist.Anatomist()
+        self.win = self.a.createWindow('3D')
+        self.win.setHasCursor(0)
+
+    def render(self, volume):
+        """Renders the non-zero voxels of a 3D volume
+
+        Args:
+            volume (array): 3D volume of size [size_X, size_Y, size_Z]
+
+        Returns:
+            float tensor of size [3, H, W] with values in [0, 1]
+        """
+        vol = self.aims.Volume(np.asarray(volume).astype(np.int16))
+        bucket_map, _ = self.remove_hull.convert_volume_to_bucket(vol)
+        bucket_a = self.a.toAObject(bucket_map)
+        bucket_a.addInWindows(self.win)
+        view_quaternion = [0.4, 0.4, 0.5, 0.5]
+        self.win.camera(view_quaternion=view_quaternion)
+        # The snapshot is taken by Anatomist itself, without matplotlib
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_file = os.path.join(tmp_dir, "snapshot.png")
+            self.win.snapshot(snapshot_file, self.width, self.height)
+            image = np.asarray(Image.open(snapshot_file).convert('RGB'))
+        self.win.removeObjects(bucket_a)
+        return torch.from_numpy(
+            image.transpose(2, 0, 1).astype(np.float32) / 255.)
+
+
+def anatomist_available():
+    """Returns True if Anatomist can be imported"""
+    try:
+        import anatomist.headless  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _serve_renderer(renderer_class, requests, results):
+    """Main loop of the process of a RendererProcess
+
+    The renderer is created and used in the main thread of the process.
+    Results are (request id, image array, error message); the first one,
+    with id None, tells whether the renderer could be created.
+    """
+    try:
+        renderer = renderer_class()
+    except Exception as exc:
+        results.put((None, None, repr(exc)))
+        return
+    results.put((None, None, None))
+    for request_id, volume in iter(requests.get, None):
+        try:
+            image = renderer.render(volume)
+            results.put((request_id, np.asarray(image), None))
+        except Exception as exc:
+            results.put((request_id, None, repr(exc)))
+    results.put((None, None, None))
+
+
+class RendererProcess:
+    """Renderer running in the main thread of a dedicated process
+
+    Volumes are rendered one at a time, in the order of submission.
+    """
+
+    def __init__(self, renderer_class):
+        """
+        Args:
+            renderer_class: class of the renderer, created without
+                arguments in the process; it must be importable
+
+        Raises:
+            RuntimeError if the renderer cannot be created
+        """
+        # Spawn: the process must not inherit the Qt state of the parent
+        context = multiprocessing.get_context('spawn')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(
+            target=_serve_renderer,
+            args=(renderer_class, self._requests, self._results),
+            daemon=True)
+        self._process.start()
+        _, _, error = self._results.get()
+        if error:
+            self._process.join()
+            raise RuntimeError(f"{renderer_class.__name__} could not be "
+                               f"created: {error}")
+        self._futures = {}
+        self._next_id = 0
+        self._error = None
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_results,
+                                        daemon=True)
+        self._reader.start()
+
+    def _read_results(self):
+        """Sets the result of the futures, as images are rendered
+
+        If the process dies (e.g. a crash of Anatomist), the pending
+        futures and the later ones fail.
+        """
+        while True:
+            try:
+                request_id, image, error = self._results.get(timeout=1.)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                self._fail(f"Renderer process died "
+                           f"(exit code {self._process.exitcode})")
+                break
+            if request_id is None:
+                break
+            with self._lock:
+                future = self._futures.pop(request_id)
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(torch.from_numpy(image))
+
+    def _fail(self, error):
+        """Fails the pending futures and the next submissions"""
+        with self._lock:
+            self._error = error
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future in futures:
+            future.set_exception(RuntimeError(error))
+
+    def submit(self, volume):
+        """Queues a volume; returns the future of its image"""
+        future = Future()
+        with self._lock:
+            if self._error:
+                future.set_exception(RuntimeError(self._error))
+                return future
+            request_id = self._next_id
+            self._next_id += 1
+            self._futures[request_id] = future
+        self._requests.put((request_id, volume))
+        return future
+
+    def close(self, wait=True):
+        """Stops the process once the queued volumes are rendered"""
+        self._requests.put(None)
+        if wait:
+            self._reader.join()
+            self._process.join()
+
+
+class RenderingService:
+    """Pool of renderers working in the background
+    """
+
+    def __init__(self, renderer='auto', nb_renderers=1, isolated=None):
+        """
+        Args:
+            renderer: 'anatomist', 'numpy' or 'auto' (anatomist if it is
+                installed, numpy otherwise), or a renderer class, created
+                without arguments, with a method render(volume)
+            nb_renderers (int): number of renderers working in parallel
+                threads. An isolated renderer is alone in its process.
+            isolated (bool): if True, the renderer runs in a dedicated
+                process (see RendererProcess). Default is True for
+                anatomist only, whose Qt objects cannot be used
+                from worker threads.
+        If the isolated renderer cannot be created, numpy renderers
+        are used instead.
+        """
+        if renderer == 'auto':
+            renderer = 'anatomist' if anatomist_available() else 'numpy'
+        if isinstance(renderer, str):
+            if renderer not in ('anatomist', 'numpy'):
+                raise ValueError(f"Unknown renderer {renderer}")
+            renderer = AnatomistRenderer if renderer == 'anatomist' \
+                else NumpyRenderer
+        if isolated is None:
+            isolated = renderer is AnatomistRenderer
+        self.renderer = renderer
+        self._process = None
+        if isolated:
+            try:
+                self._process = RendererProcess(renderer)
+                return
+            except Exception:
+                log.exception("Isolated renderer could not be created: "
+                              "numpy renderer used instead")
+                self.renderer = NumpyRenderer
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=nb_renderers,
+            thread_name_prefix='renderer')
+        # Renderers are created now, not at the first snapshot:
+        # the barrier makes each worker thread start
+        barrier = threading.Barrier(nb_renderers)
+        for future in [self._executor.submit(self._start_worker, barrier)
+                       for _ in range(nb_renderers)]:
+            future.result()
+
+    def _start_worker(self, barrier):
+        """Creates the renderer of a worker thread, then waits for the
+        other worker threads"""
+        self._init_renderer()
+        barrier.wait()
+
+    def _init_renderer(self):
+        """Creates the renderer of the current worker thread"""
+        try:
+            self._local.renderer = self.renderer()
+        except Exception:
+            log.exception(f"{self.renderer.__name__} could not be created: "
+                          "numpy renderer used instead")
+            self._local.renderer = NumpyRenderer()
+
+    def _render(self, volume):
+        if not hasattr(self._local, 'renderer'):
+            self._init_renderer()
+        return self._local.renderer.render(volume)
+
+    def submit(self, volume):
+        """Queues a volume for rendering
+
+        Args:
+            volume (array or tensor): 3D volume [size_X, size_Y, size_Z];
+                it is copied, so that it can be modified afterwards
+
+        Returns:
+            future of the image tensor [3, H, W]
+        """
+        if torch.is_tensor(volume):
+            volume = volume.detach().cpu().numpy()
+        if self._process is not None:
+            return self._process.submit(np.array(volume))
+        return self._executor.submit(self._render, np.array(volume))
+
+    def submit_batch(self, img):
+        """Queues the first volume of a batch [size_batch, 1, X, Y, Z]
+
+        Same convention as plot_bucket.
+        """
+        return self.submit(img[0, 0])
+
+    def render_batch(self, volumes):
+        """Renders a batch of volumes and waits for the images
+
+        Returns:
+            float tensor of size [N_volumes, 3, H, W]
+        """
+        futures = [self.submit(volume) for volume in volumes]
+        return torch.stack([future.result() for future in futures])
+
+    def close(self, wait=True):
+        """Stops the renderers"""
+        if self._process is not None:
+            self._process.close(wait=wait)
+        else:
+            self._executor.shutdown(wait=wait)
@@ -4,7 +4,9 @@
 import logging
 
 import matplotlib.pyplot as plt
+import numpy as np
 import PIL
+import torch
 from torchvision.transforms import ToTensor
 
 logger = logging.getLogger(__name__)
@@ -21,6 +23,29 @@ def buffer_to_image(buffer):
     return image
 
 
+def get_figure(name):
+    """Returns the figure called name, cleared
+
+    The figure is created at the first call and reused afterwards,
+    instead of building a new figure at each epoch.
+    """
+    return plt.figure(num=name, clear=True)
+
+
+def figure_to_image(fig):
+    """Draws a figure and returns its RGB pixels
+
+    The pixels are read from the figure canvas, without PNG encoding.
+
+    Returns:
+        float tensor of size [3, H, W] with values in [0, 1]
+    """
+    fig.canvas.draw()
+    rgba = np.asarray(fig.canvas.buffer_rgba())
+    image = rgba[:, :, :3].transpose(2, 0, 1).astype(np.float32) / 255.
+    return torch.from_numpy(image)
+
+
 def prime_factors(n):
     i = 2
     factors = []
@@ -1,9 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from deep_folding.anatomist_tools.utils import remove_hull
-import anatomist.headless as anatomist
-from soma import aims
 import io
 import logging
 
@@ -22,11 +19,20 @@ win = None
 class Visu_Anatomist:
 
     def __init__(self, ):
+        """Anatomist and its 3D window are created at the first plot"""
+        pass
+
+    @staticmethod
+    def init_anatomist():
+        """Creates the global Anatomist instance and 3D window once"""
         global a
         global win
-        a = anatomist.Anatomist()
-        win = a.createWindow('3D')
-        win.setHasCursor(0)
+        if a is None:
+            # Imported here, as Anatomist is not installed everywhere
+            import anatomist.headless as anatomist
+            a = anatomist.Anatomist()
+            win = a.createWindow('3D')
+            win.setHasCursor(0)
 
     def plot_bucket(self, img, buffer):
         """Plots as 3D buckets the first 3D image of the batch
@@ -36,8 +42,11 @@ class Visu_Anatomist:
             buffer (boolean): True -> returns PNG image buffer
                             False -> plots the figure
         """
+        from deep_folding.anatomist_tools.utils import remove_hull
+        from soma import aims
         global a
         global win
+        self.init_anatomist()
         arr = img[0, 0, :, :, :]
         vol = aims.Volume(arr.numpy().astype(int16))
         bucket_map, _ = remove_hull.convert_volume_to_bucket(vol)
@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import io
 import logging
 
 import matplotlib.pyplot as plt
 import numpy as np
-from mpl_toolkits.mplot3d import Axes3D
 
-from .visu_utils import buffer_to_image
+from .visu_utils import figure_to_image
+from .visu_utils import get_figure
 from .visu_utils import prime_factors
+from .voxel_renderer import render_voxels
 
 logger = logging.getLogger(__name__)
 
@@ -19,13 +19,15 @@ def plot_img(img, buffer):
 
     Args:
         img: batch of images of size [N_batch, 1, size_X, size_Y, size_Z]
-        buffer (boolean): True -> returns PNG image buffer
+        buffer (boolean): True -> returns the RGB image tensor [3, H, W]
                           False -> plots the figure
     """
-    plt.imshow(img[0, 0, img.shape[2] // 2, :, :])
+    fig = get_figure('img')
+    ax = fig.subplots()
+    ax.imshow(img[0, 0, img.shape[2] // 2, :, :])
 
     if buffer:
-        return buffer_to_image(buffer=io.BytesIO())
+        return figure_to_image(fig)
     else:
         plt.show()
 
@@ -33,32 +35,23 @@ def plot_img(img, buffer):
 def plot_bucket(img, buffer):
     """Plots as 3D buckets the first 3D image of the batch
 
+    The visible voxel faces are rasterised by render_voxels,
+    without matplotlib figure nor PNG encoding.
+
     Args:
         img: batch of images of size [size_batch, 1, size_X, size_Y, size_Z]
-        buffer (boolean): True -> returns PNG image buffer
+        buffer (boolean): True -> returns the RGB image tensor [3, H, W]
                           False -> plots the figure
     """
 
     arr = img[0, 0, :, :, :]
-    logger.info(np.unique(arr, return_counts=True))
-    logger.info(img.shape)
-    logger.info(arr.shape)
-    bucket = np.argwhere(arr)
-    bucket_t = (bucket).T
-    x = bucket_t[:, 0]
-    y = bucket_t[:, 1]
-    z = bucket_t[:, 2]
-
-    fig = plt.figure()
-    ax = Axes3D(fig)
-    ax.set_xlim3d(0, 12)
-    ax.set_ylim3d(0, 40)
-    ax.set_zlim3d(0, 40)
-    ax.scatter(x, y, z)
+    logger.debug(img.shape)
+    image = render_voxels(arr)
 
     if buffer:
-        return buffer_to_image(buffer=io.BytesIO())
+        return image
     else:
+        plt.imshow(image.permute(1, 2, 0).numpy())
         plt.show()
 
 
@@ -70,21 +63,28 @@ def plot_output(img, buffer):
     row_size = np.prod(primes[:len(primes) // 2])
     arr = arr.reshape(row_size, -1)
 
-    plt.imshow(arr)
+    fig = get_figure('output')
+    ax = fig.subplots()
+    ax.imshow(arr)
 
     if buffer:
-        return buffer_to_image(buffer=io.BytesIO())
+        return figure_to_image(fig)
     else:
         plt.show()
 
 
 def plot_histogram(tensor, buffer):
-    """Plots histogram of the values of a tensor"""
+    """Plots histogram of the values of a tensor
+
+    The figure is cleared first, so that successive calls
+    do not accumulate bars."""
     arr = tensor.detach().cpu().numpy() * 100
 
-    plt.hist(arr.flatten(), bins=50, range=[-100, 100])
+    fig = get_figure('histogram')
+    ax = fig.subplots()
+    ax.hist(arr.flatten(), bins=50, range=[-100, 100])
 
     if buffer:
-        return buffer_to_image(buffer=io.BytesIO())
+        return figure_to_image(fig)
     else:
         plt.show()
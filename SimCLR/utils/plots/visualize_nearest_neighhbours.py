@@ -1,15 +1,12 @@
-import colorado as cld
 import logging
 
-import anatomist.api as anatomist
 import matplotlib.pyplot as plt
 import numpy as np
 import PIL
 import torch
-from sklearn.neighbors import NearestNeighbors
-from soma import aims
 
-from .visualize_anatomist import Visu_Anatomist
+from SimCLR.evaluation.knn_index import KNNIndex
+from SimCLR.utils.plots import registry
 
 """Inspired from lightly
 https://docs.lightly.ai/tutorials/package/tutorial_simclr_clothing.html
@@ -26,16 +23,32 @@ def get_image_as_np_array(filename: str):
     return np.asarray(img)
 
 
-def get_input(dataset, filenames, idx):
-    """gets input numbered idx"""
+def get_input(dataset, filenames, idx, view_cache=None, nb_views=2):
+    """gets input numbered idx
 
-    (views, filename) = dataset[idx // 2]
+    idx is a row of the embeddings, which have nb_views rows per subject
+    (see ContrastiveLearner.compute_outputs_skeletons).
+    The view is read from view_cache (ViewCache) if it holds it:
+    it is then exactly the view that has been embedded.
+    Otherwise, it is drawn again from the dataset.
+    """
+    if view_cache is not None and idx in view_cache:
+        return view_cache.get(idx)
+
+    (views, filename) = dataset[idx // nb_views]
     if filenames:
         if filename != filenames[idx]:
             log.error(
                 "filenames dont match: {} != {}".format(
                     filename, filenames[idx]))
-    return views[idx % 2]
+    return views[idx % nb_views]
+
+
+def sample_rows(embeddings, num_examples):
+    """Returns at most num_examples distinct random rows of embeddings"""
+    return np.random.choice(len(embeddings),
+                            size=min(num_examples, len(embeddings)),
+                            replace=False)
 
 
 def plot_knn_examples(
@@ -44,31 +57,36 @@ def plot_knn_examples(
         filenames=None,
         n_neighbors=3,
         num_examples=6,
-        savepath=None):
+        savepath=None,
+        view_cache=None,
+        nb_views=2):
     """Plots multiple rows of random images with their nearest neighbors
+
+    view_cache (ViewCache), if given, holds the embedded views.
+    nb_views is the number of embedding rows per subject.
     """
-    # lets look at the nearest neighbors for some samples
-    # we use the sklearn library
-    nbrs = NearestNeighbors(n_neighbors=n_neighbors).fit(embeddings)
-    distances, indices = nbrs.kneighbors(embeddings)
+    # get random samples
+    samples_idx = sample_rows(embeddings, num_examples)
 
-    # get 5 random samples
-    samples_idx = np.random.choice(
-        len(indices), size=num_examples, replace=False)
+    # lets look at the nearest neighbors for the samples only
+    index = KNNIndex(embeddings)
+    distances, indices = index.search_rows(samples_idx, n_neighbors)
 
     # loop through our randomly picked samples
-    for idx in samples_idx:
+    for idx, sample_distances, sample_indices in \
+            zip(samples_idx, distances, indices):
         fig = plt.figure()
         # loop through their nearest neighbors
-        for plot_x_offset, neighbor_idx in enumerate(indices[idx]):
+        for plot_x_offset, neighbor_idx in enumerate(sample_indices):
             # add the subplot
-            ax = fig.add_subplot(1, len(indices[idx]), plot_x_offset + 1)
+            ax = fig.add_subplot(1, len(sample_indices), plot_x_offset + 1)
             # Recovers input
-            view = get_input(dataset, filenames, neighbor_idx)
+            view = get_input(dataset, filenames, neighbor_idx,
+                             view_cache=view_cache, nb_views=nb_views)
             # plot the image
             plt.imshow(view[0, view.shape[1] // 2, :, :].numpy())
             # set the title to the distance of the neighbor
-            ax.set_title(f'd={distances[idx][plot_x_offset]:.3f}')
+            ax.set_title(f'd={sample_distances[plot_x_offset]:.3f}')
             # let's disable the axis
             plt.axis('off')
             if savepath:
@@ -85,43 +103,54 @@ def plot_knn_buckets(
         dataset,
         filenames=None,
         n_neighbors=3,
-        num_examples=6):
-    """Plots multiple rows of random images with their nearest neighbors
+        num_examples=6,
+        savepath=None,
+        view_cache=None,
+        nb_views=2):
+    """Plots as 3D buckets random subjects with their nearest neighbors
+
+    view_cache (ViewCache), if given, holds the embedded views.
+    nb_views is the number of embedding rows per subject.
     """
-    # lets look at the nearest neighbors for some samples
-    # we use the sklearn library
     global visu_anatomist
-    nbrs = NearestNeighbors(n_neighbors=n_neighbors).fit(embeddings)
-    distances, indices = nbrs.kneighbors(embeddings)
+    if visu_anatomist is None:
+        visu_anatomist = registry.get('Visu_Anatomist')()
 
-    # get 5 random samples
-    view = get_input(dataset, filenames, 0)
+    # get random samples
+    samples_idx = sample_rows(embeddings, num_examples)
 
-    # Converts from tensor to aims volume
-    arr = view.numpy()
-    arr = np.reshape(arr, (1,) + arr.shape).astype(np.int16)
-    if visu_anatomist is None:
-        visu_anatomist = Visu_Anatomist()
-    log.info(f"shape = {arr.shape}")
-    visu_anatomist.plot_bucket(torch.from_numpy(arr),
-                               buffer=False)
-
-    # block = a.AWindowsBlock(a, n_neighbors)
-
-    # # loop through our randomly picked samples
-    # for idx in samples_idx:
-    #     # loop through their nearest neighbors
-    #     for plot_x_offset, neighbor_idx in enumerate(indices[idx]):
-    #         # add the subplot
-    #         ax = fig.add_subplot(1, len(indices[idx]), plot_x_offset + 1)
-    #         # Recovers input
-    #         view = get_input(dataset, filenames, neighbor_idx)
-    #         # plot the image
-    #         plt.imshow(view[0,view.shape[1]//2, :, :].numpy())
-    #         # set the title to the distance of the neighbor
-    #         ax.set_title(f'd={distances[idx][plot_x_offset]:.3f}')
-    #         # let's disable the axis
-    #         plt.axis('off')            win.imshow(show=False)
+    # lets look at the nearest neighbors for the samples only
+    index = KNNIndex(embeddings)
+    distances, indices = index.search_rows(samples_idx, n_neighbors)
+
+    # loop through our randomly picked samples
+    for idx, sample_distances, sample_indices in \
+            zip(samples_idx, distances, indices):
+        # Renders the buckets first: rendering closes the open figures
+        images = []
+        for neighbor_idx in sample_indices:
+            view = get_input(dataset, filenames, neighbor_idx,
+                             view_cache=view_cache, nb_views=nb_views)
+            # Converts from tensor to a batch of one volume
+            arr = view.numpy()
+            arr = np.reshape(arr, (1,) + arr.shape).astype(np.int16)
+            images.append(visu_anatomist.plot_bucket(torch.from_numpy(arr),
+                                                     buffer=True))
+        fig = plt.figure()
+        # loop through their nearest neighbors
+        for plot_x_offset, image in enumerate(images):
+            ax = fig.add_subplot(1, len(images), plot_x_offset + 1)
+            plt.imshow(image.permute(1, 2, 0).numpy())
+            # set the title to the distance of the neighbor
+            ax.set_title(f'd={sample_distances[plot_x_offset]:.3f}')
+            plt.axis('off')
+        if savepath:
+            plt.savefig(f"{savepath}/nearest_buckets_{idx}.png")
+
+    if not savepath:
+        plt.ion()
+        plt.show()
+        plt.pause(0.001)
 
 
 if __name__ == "__main__":
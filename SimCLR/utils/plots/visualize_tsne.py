@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import io
 import logging
 
 import matplotlib
@@ -11,7 +10,8 @@ import numpy as np
 import torch
 from sklearn.manifold import TSNE
 
-from .visu_utils import buffer_to_image
+from .visu_utils import figure_to_image
+from .visu_utils import get_figure
 
 logger = logging.getLogger(__name__)
 
@@ -60,14 +60,17 @@ def compute_tsne(loader, model, num_outputs):
 
 
 def plot_tsne(X_tsne, buffer, labels=None, savepath=None, type=""):
-    """Generates TSNE plot either in a PNG image buffer or as a plot
+    """Generates TSNE plot either as an RGB image tensor or as a plot
+
+    The same figure is reused by all calls.
 
     Args:
         X_tsne: TSNE N_features rows x 2 columns
-        buffer (boolean): True -> returns PNG image buffer
+        buffer (boolean): True -> returns the RGB image tensor [3, H, W]
                           False -> plots the figure
     """
-    fig, ax = plt.subplots(1)
+    fig = get_figure('tsne')
+    ax = fig.subplots()
     logger.info(f"Matplotlib backend = {matplotlib.get_backend()}")
     logger.info(f"X_tsne shape = {X_tsne.shape}")
     nb_points = X_tsne.shape[0]
@@ -80,9 +83,9 @@ def plot_tsne(X_tsne, buffer, labels=None, savepath=None, type=""):
     mscatter(X_tsne[:, 0], X_tsne[:, 1], c=c, m=m, s=8, ax=ax)
 
     if buffer:
-        return buffer_to_image(buffer=io.BytesIO())
+        return figure_to_image(fig)
     elif savepath:
-        plt.savefig(f"{savepath}/tsne_{type}.png")
+        fig.savefig(f"{savepath}/tsne_{type}.png")
     else:
         plt.ion()
         plt.show()
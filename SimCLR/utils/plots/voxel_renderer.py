@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized rendering of binary volumes as voxel surfaces
+
+Only the visible faces of the voxels (faces whose neighbour is empty)
+are kept. They are rotated, sampled and rasterised with an orthographic
+z-buffer directly into an RGB tensor: no matplotlib figure is created
+and no PNG is encoded.
+"""
+import numpy as np
+import torch
+
+# Normals of the 6 faces of a voxel
+_NORMALS = np.array([[1, 0, 0], [-1, 0, 0],
+                     [0, 1, 0], [0, -1, 0],
+                     [0, 0, 1], [0, 0, -1]])
+
+
+def rotation_matrix(elevation, azimuth):
+    """Returns the rotation of the view (angles in degrees)
+
+    The azimuth turns around the first axis of the volume,
+    the elevation tilts the scene towards the viewer.
+    """
+    elevation = np.radians(elevation)
+    azimuth = np.radians(azimuth)
+    cos_a, sin_a = np.cos(azimuth), np.sin(azimuth)
+    cos_e, sin_e = np.cos(elevation), np.sin(elevation)
+    rot_azimuth = np.array([[1, 0, 0],
+                            [0, cos_a, -sin_a],
+                            [0, sin_a, cos_a]])
+    rot_elevation = np.array([[cos_e, 0, sin_e],
+                              [0, 1, 0],
+                              [-sin_e, 0, cos_e]])
+    return rot_elevation @ rot_azimuth
+
+
+def visible_faces(volume):
+    """Returns the voxel faces not hidden by a neighbouring voxel
+
+    Args:
+        volume (array): 3D volume; non-zero voxels are rendered
+
+    Returns:
+        tuple (centers, normal_ids): face centers [N_faces, 3]
+        and indices of their normals in _NORMALS [N_faces]
+    """
+    filled = np.asarray(volume) != 0
+    padded = np.pad(filled, 1)
+    voxels = np.argwhere(filled)
+    centers = []
+    normal_ids = []
+    for normal_id, normal in enumerate(_NORMALS):
+        neighbours = voxels + 1 + normal
+        empty = ~padded[neighbours[:, 0], neighbours[:, 1], neighbours[:, 2]]
+        centers.append(voxels[empty] + 0.5 + 0.5 * normal)
+        normal_ids.append(np.full(empty.sum(), normal_id))
+    return np.concatenate(centers), np.concatenate(normal_ids)
+
+
+def render_voxels(volume, size=(320, 320), elevation=30., azimuth=45.,
+                  color=(0.6, 0.8, 1.), background=(0., 0., 0.)):
+    """Renders the non-zero voxels of a 3D volume
+
+    Args:
+        volume (array or tensor): 3D volume [size_X, size_Y, size_Z]
+        size (tuple): (height, width) of the image in pixels
+        elevation, azimuth (float): view angles in degrees
+        color (tuple): RGB color of the voxels, lit from the viewer
+        background (tuple): RGB color of the background
+
+    Returns:
+        float tensor of size [3, height, width] with values in [0, 1]
+    """
+    if torch.is_tensor(volume):
+        volume = volume.detach().cpu().numpy()
+    volume = np.asarray(volume)
+    height, width = size
+    image = np.empty((3, height * width), dtype=np.float32)
+    image[:] = np.asarray(background, dtype=np.float32)[:, np.newaxis]
+
+    centers, normal_ids = visible_faces(volume)
+    if len(centers) == 0:
+        return torch.from_numpy(image.reshape(3, height, width))
+
+    # Faces turned away from the viewer (looking towards -z) are hidden
+    rotation = rotation_matrix(elevation, azimuth)
+    normals = _NORMALS @ rotation.T
+    front = normals[normal_ids, 2] > 0
+    centers, normal_ids = centers[front], normal_ids[front]
+
+    # Orthographic view of the whole volume, centered in the image
+    shape = np.array(volume.shape, dtype=float)
+    pixels_per_voxel = min(height, width) / np.linalg.norm(shape)
+
+    # Each face is sampled finely enough to leave no hole between pixels
+    nb_samples = max(2, int(np.ceil(1.5 * pixels_per_voxel)))
+    steps = (np.arange(nb_samples) + 0.5) / nb_samples - 0.5
+    grid_u, grid_v = [g.ravel() for g in np.meshgrid(steps, steps)]
+    # For each normal, the two axes spanning the face
+    tangents = np.array([[a for a in range(3) if a != abs(n).argmax()]
+                         for n in _NORMALS])
+    offsets = np.zeros((len(_NORMALS), nb_samples**2, 3))
+    for normal_id, (axis_u, axis_v) in enumerate(tangents):
+        offsets[normal_id, :, axis_u] = grid_u
+        offsets[normal_id, :, axis_v] = grid_v
+    points = centers[:, np.newaxis, :] + offsets[normal_ids]
+    points = (points.reshape(-1, 3) - shape / 2.) @ rotation.T
+
+    # Lambertian shading with the light coming from the viewer
+    shade = 0.25 + 0.75 * np.abs(normals[:, 2])
+    point_shade = np.repeat(shade[normal_ids], nb_samples**2)
+
+    rows = np.floor(height / 2. - points[:, 0] * pixels_per_voxel)
+    cols = np.floor(width / 2. + points[:, 1] * pixels_per_voxel)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    pixels = (rows[inside] * width + cols[inside]).astype(np.int64)
+    depth = -points[inside, 2]
+    point_shade = point_shade[inside]
+
+    # z-buffer: the nearest point of each pixel is kept
+    order = np.lexsort((depth, pixels))
+    pixels, first = np.unique(pixels[order], return_index=True)
+    pixel_shade = point_shade[order][first].astype(np.float32)
+    image[:, pixels] = np.asarray(color, dtype=np.float32)[:, np.newaxis] \
+        * pixel_shade
+    return torch.from_numpy(image.reshape(3, height, width))
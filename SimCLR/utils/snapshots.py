@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+On-disk store of reconstruction snapshots
+
+Inputs and reconstructions of selected subjects are written by chunks
+of compressed uint8 arrays, so that memory does not grow with the
+dataset, and at most budget snapshots are kept. The store is
+append-only; an index gives the chunk and row of each snapshot:
+
+    snapshots/
+        index.json          [[subject, phase, chunk, row], ...]
+        chunk_00000.npz     inputs, outputs [N_chunk, size_X, size_Y, size_Z]
+        ...
+
+Snapshots are read back with read_snapshots.
+"""
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+
+_INDEX_FILE = "index.json"
+
+
+def _to_numpy(arr):
+    if torch.is_tensor(arr):
+        return arr.detach().cpu().numpy()
+    return np.asarray(arr)
+
+
+def _write_json(path, data):
+    """Writes a json file atomically"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+class SnapshotWriter():
+    """Appends snapshots to a store, by chunks, within a budget
+    """
+
+    def __init__(self, path, budget=None, chunk_size=64, dtype=np.uint8):
+        """
+        Args:
+            path (str): directory of the store, created if needed;
+                snapshots of an existing store are kept
+            budget (int): maximal number of snapshots of the store,
+                None for no limit
+            chunk_size (int): number of snapshots per chunk file
+            dtype: dtype of the stored arrays; the values of
+                the snapshots must fit in it
+        """
+        self.path = path
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        os.makedirs(path, exist_ok=True)
+        index_file = os.path.join(path, _INDEX_FILE)
+        self.index = []
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                self.index = json.load(f)
+        self.nb_chunks = len(glob.glob(os.path.join(path, "chunk_*.npz")))
+        self._pending = []
+
+    def __len__(self):
+        return len(self.index) + len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def full(self):
+        """True if the budget is reached"""
+        return self.budget is not None and len(self) >= self.budget
+
+    def _cast(self, arr):
+        arr = _to_numpy(arr)
+        if np.issubdtype(self.dtype, np.integer) and arr.size:
+            info = np.iinfo(self.dtype)
+            if arr.min() < info.min or arr.max() > info.max:
+                raise ValueError(f"Snapshot values do not fit in {self.dtype}")
+        return arr.astype(self.dtype)
+
+    def add(self, subjects, inputs, outputs, phase=''):
+        """Adds the snapshots of a batch, within the budget
+
+        Args:
+            subjects (list of str): IDs of the batch
+            inputs, outputs (arrays or tensors): [N_batch, ...]
+            phase (str): label of the snapshots (e.g. 'train')
+
+        Returns:
+            number of snapshots added
+        """
+        nb_added = len(subjects)
+        if self.budget is not None:
+            nb_added = max(0, min(nb_added, self.budget - len(self)))
+        if nb_added == 0:
+            return 0
+        inputs = self._cast(inputs[:nb_added])
+        outputs = self._cast(outputs[:nb_added])
+        for subject, subject_input, subject_output in zip(
+                subjects[:nb_added], inputs, outputs):
+            self._pending.append(
+                (str(subject), phase, subject_input, subject_output))
+            if len(self._pending) >= self.chunk_size:
+                self.flush()
+        return nb_added
+
+    def flush(self):
+        """Writes the pending snapshots as a new chunk"""
+        if not self._pending:
+            return
+        chunk = self.nb_chunks
+        subjects, phases, inputs, outputs = zip(*self._pending)
+        chunk_file = os.path.join(self.path, f"chunk_{chunk:05d}.npz")
+        # np.savez_compressed adds .npz to names without it
+        with open(chunk_file + '.tmp', 'wb') as f:
+            np.savez_compressed(f, inputs=np.stack(inputs),
+                                outputs=np.stack(outputs))
+        os.replace(chunk_file + '.tmp', chunk_file)
+        self.index.extend([subject, phase, chunk, row]
+                          for row, (subject, phase)
+                          in enumerate(zip(subjects, phases)))
+        _write_json(os.path.join(self.path, _INDEX_FILE), self.index)
+        self.nb_chunks += 1
+        self._pending = []
+
+    def close(self):
+        """Writes the last snapshots"""
+        self.flush()
+
+
+def read_snapshots(path, subjects=None, phase=None):
+    """Reads snapshots from a store
+
+    Args:
+        path (str): directory of the store
+        subjects (list of str): IDs to read, all if None
+        phase (str): only snapshots with this label if given
+
+    Returns:
+        tuple (subjects, phases, inputs, outputs), inputs and outputs
+        being arrays of size [N_snapshots, ...]
+    """
+    with open(os.path.join(path, _INDEX_FILE)) as f:
+        index = json.load(f)
+    if subjects is not None:
+        wanted = set(map(str, subjects))
+        index = [entry for entry in index if entry[0] in wanted]
+    if phase is not None:
+        index = [entry for entry in index if entry[1] == phase]
+
+    if not index:
+        return [], [], np.empty((0,)), np.empty((0,))
+
+    # Only one chunk is loaded at a time
+    inputs, outputs = [], []
+    current_chunk = None
+    for _, _, chunk, row in index:
+        if chunk != current_chunk:
+            with np.load(os.path.join(path, f"chunk_{chunk:05d}.npz")) as f:
+                chunk_inputs, chunk_outputs = f['inputs'], f['outputs']
+            current_chunk = chunk
+        inputs.append(chunk_inputs[row])
+        outputs.append(chunk_outputs[row])
+    return ([entry[0] for entry in index], [entry[1] for entry in index],
+            np.stack(inputs), np.stack(outputs))
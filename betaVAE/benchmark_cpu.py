@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env python3
+
+"""
+Measures the CPU throughput of the beta-VAE
+
+Training steps and embedding extraction are timed on random skeletons,
+in float32 and with bfloat16 autocast, and with or without sampling
+of the latent space at inference.
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+from vae import VAE
+from vae import cpu_autocast
+from vae import vae_loss
+
+
+def parse_args(argv):
+    """ Parses command-line arguments """
+    parser = argparse.ArgumentParser(
+        prog='benchmark_cpu.py',
+        description='Measures the CPU throughput of the beta-VAE')
+    parser.add_argument(
+        "-b", "--batch_size", type=int, default=64,
+        help='Batch size.')
+    parser.add_argument(
+        "-s", "--steps", type=int, default=10,
+        help='Number of timed batches.')
+    parser.add_argument(
+        "-t", "--threads", type=int, default=None,
+        help='Number of torch threads. Default is torch default.')
+    parser.add_argument(
+        "-n", "--n_latent", type=int, default=4,
+        help='Size of latent space.')
+    return parser.parse_args(argv)
+
+
+def throughput(step, batch_size, steps):
+    """ Returns the number of samples per second of step """
+    step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return batch_size * steps / (time.perf_counter() - start)
+
+
+def benchmark_cpu(batch_size=64, steps=10, n_latent=4):
+    """ Prints the samples per second of training and inference """
+    in_shape = (1, 20, 40, 40)
+    torch.manual_seed(0)
+    vae = VAE(in_shape, n_latent, depth=3)
+    criterion = torch.nn.CrossEntropyLoss(
+        weight=torch.FloatTensor([1, 2]), reduction='sum')
+    optimizer = torch.optim.Adam(vae.parameters(), lr=2e-4)
+    inputs = (torch.rand(batch_size, *in_shape) > 0.9).float()
+    target = torch.squeeze(inputs, dim=1).long()
+
+    def train_step(bf16):
+        def step():
+            optimizer.zero_grad()
+            with cpu_autocast("cpu", bf16):
+                output, z, logvar = vae(inputs)
+            _, _, loss = vae_loss(output.float(), target, z.float(),
+                                  logvar.float(), criterion, kl_weight=2)
+            loss.backward()
+            optimizer.step()
+        return step
+
+    def inference_step(bf16, sample):
+        def step():
+            with torch.no_grad(), cpu_autocast("cpu", bf16):
+                vae(inputs, sample=sample)
+        return step
+
+    print(f"batch size {batch_size}, {torch.get_num_threads()} threads")
+    vae.train()
+    for bf16 in (False, True):
+        speed = throughput(train_step(bf16), batch_size, steps)
+        print(f"training {'bf16' if bf16 else 'fp32'}: "
+              f"{speed:.1f} samples/s")
+    vae.eval()
+    for bf16 in (False, True):
+        for sample in (True, False):
+            speed = throughput(inference_step(bf16, sample),
+                               batch_size, steps)
+            print(f"inference {'bf16' if bf16 else 'fp32'}, "
+                  f"{'sampling' if sample else 'mean only'}: "
+                  f"{speed:.1f} samples/s")
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    benchmark_cpu(batch_size=args.batch_size, steps=args.steps,
+                  n_latent=args.n_latent)
+
+    # example of use
+    # python3 benchmark_cpu.py -b 64 -s 10 -t 8
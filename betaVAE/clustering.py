@@ -5,41 +5,65 @@
 import torch
 import pandas as pd
 import numpy as np
-from sklearn import metrics
 from sklearn.manifold import TSNE
 from sklearn.cluster import KMeans, AffinityPropagation
-from sklearn.metrics import silhouette_samples, silhouette_score
 import json
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 
+from SimCLR.evaluation.silhouette import silhouette_samples, \
+                                         silhouette_score_sampled
+
 
 class Cluster():
     """ Performs cluster analysis of encoded subjects
     """
-    def __init__(self, X, root_dir):
+    def __init__(self, X, root_dir, sample_size=None):
+        """
+        Args:
+            X: array of encoded subjects
+            root_dir: str, directory where to save plots
+            sample_size: int, if the number of subjects is larger,
+                         silhouette scores are estimated on a stratified
+                         subsample
+        """
         self.n_clusters_list = [2, 3, 4, 5, 6, 7, 8, 9, 10]
         self.x = X
         self.dir = root_dir
+        self.sample_size = sample_size
+
+    def silhouette(self, cluster_labels):
+        """ Returns silhouette score, per-sample values and their labels
+        """
+        if self.sample_size is None or len(self.x) <= self.sample_size:
+            sample_silhouette_values = silhouette_samples(self.x, cluster_labels)
+            return np.mean(sample_silhouette_values), sample_silhouette_values, \
+                   cluster_labels
+        score, lower, upper, rows, sample_silhouette_values = \
+            silhouette_score_sampled(self.x, cluster_labels,
+                                     sample_size=self.sample_size,
+                                     random_state=0, return_samples=True)
+        print(f"Silhouette estimated on {len(rows)} subjects, "
+              f"95% confidence interval = [{lower}, {upper}]")
+        return score, sample_silhouette_values, np.asarray(cluster_labels)[rows]
 
     def plot_silhouette(self):
         res_silhouette = {'kmeans':{2: 0, 3: 0, 4: 0, 5:0, 6:0, 7: 0, 8: 0, 9:0, 10: 0},
                           'AffinityPropagation':{}}
         for n in self.n_clusters_list:
             cluster_labels= KMeans(n_clusters=n, random_state=0).fit_predict(self.x)
-            res_silhouette['kmeans'][n] = str(metrics.silhouette_score(self.x, cluster_labels))
+            # Compute the silhouette scores for each sample
+            silhouette_avg, sample_silhouette_values, sample_labels = \
+                self.silhouette(cluster_labels)
+            res_silhouette['kmeans'][n] = str(silhouette_avg)
 
             fig, ax1 = plt.subplots()
             ax1.set_ylim([0, len(self.x) + (n + 1) * 10])
-            silhouette_avg = silhouette_score(self.x, cluster_labels)
             print("For n_clusters =", n, "The average silhouette_score with kmeans is :", silhouette_avg)
 
-            # Compute the silhouette scores for each sample
-            sample_silhouette_values = silhouette_samples(self.x, cluster_labels)
-
             y_lower = 10
             for i in range(n):
-                ith_cluster_silhouette_values = sample_silhouette_values[cluster_labels == i]
+                ith_cluster_silhouette_values = sample_silhouette_values[sample_labels == i]
 
                 ith_cluster_silhouette_values.sort()
 
@@ -82,17 +106,17 @@ class Cluster():
             print(n_clusters_)
 
         if n_clusters_>1:
-            res_silhouette['AffinityPropagation'][n_clusters_] = str(metrics.silhouette_score(self.x, x_cluster_label))
+            silhouette_avg, _, _ = self.silhouette(x_cluster_label)
+            res_silhouette['AffinityPropagation'][n_clusters_] = str(silhouette_avg)
             fig2, ax2 = plt.subplots()
             ax2.set_ylim([0, len(self.x) + (n + 1) * 10])
-            silhouette_avg = silhouette_score(self.x, x_cluster_label)
             print("For n_clusters =", n_clusters_, "The average silhouette_score with AffinityPropagation is :", silhouette_avg)
 
-            sample_silhouette_values = silhouette_samples(self.x, cluster_labels)
+            _, sample_silhouette_values, sample_labels = self.silhouette(cluster_labels)
 
             y_lower = 10
             for i in range(n_clusters_):
-                ith_cluster_silhouette_values = sample_silhouette_values[cluster_labels == i]
+                ith_cluster_silhouette_values = sample_silhouette_values[sample_labels == i]
 
                 ith_cluster_silhouette_values.sort()
 
@@ -7,9 +7,31 @@ class Config:
         self.n = 4
         self.lr = 2e-4
         self.in_shape = (1, 20, 40, 40) # input size with padding
+        # CPU data-parallel training: number of processes,
+        # pinning of each process to its own cores,
+        # and cores (and loader workers) of each process for data loading
+        self.nb_processes = 1
+        self.pin_cores = False
+        self.loader_cores_per_process = 2
+        # bfloat16 autocast of the model on CPU
+        self.bf16 = False
+        # float16 autocast of the model on GPU, with gradient scaling
+        self.amp = False
+        # torch.compile of the model (torch >= 2.0)
+        self.compile = False
+        # number of batches whose gradients are summed before an update
+        self.accumulation_steps = 1
+        # number of reconstructions saved in save_dir/snapshots
+        self.nb_snapshots = 128
+        # data loaders
+        self.num_workers = 8
+        self.persistent_workers = True
+        self.prefetch_factor = 2
         #self.data_dir = "/path/to/data/directory"
         #self.subject_dir = "/path/to/list_of_subjects"
         #self.save_dir = "/path/to/saving/directory"
         self.save_dir = "/save_dir"
         self.data_dir = "/data_dir/"
         self.subject_dir = "/subject_dir/"
+        # directory where the normalized and padded skeletons are cached
+        self.cache_dir = self.data_dir
@@ -5,18 +5,48 @@
 """
 Tools in order to create pytorch dataloaders
 """
+import hashlib
+import json
 import os
 import sys
 
 import pandas as pd
 import numpy as np
+import torch
 from preprocess import *
+from SimCLR.evaluation.embedding_store import file_hash
+
+
+def normalize_crops(dataframe, in_shape):
+    """ Normalizes and pads all skeletons of the dataframe
+
+    Args:
+        dataframe: dataframe whose column 0 contains the skeletons
+        in_shape: tuple, input shape (c, h, w, d) with padding
+
+    Returns:
+        crops: uint8 array of size [N, c, h, w, d]
+    """
+    normalize = NormalizeSkeleton()
+    padding = Padding(list(in_shape), fill_value=0)
+    crops = np.empty((len(dataframe),) + tuple(in_shape), dtype=np.uint8)
+    for idx in range(len(dataframe)):
+        sample = np.expand_dims(np.squeeze(dataframe.iloc[idx][0]), axis=0)
+        sample = padding(normalize(sample))
+        if sample.min() < 0 or sample.max() > 255:
+            raise ValueError(f"Skeleton {idx} does not fit in uint8")
+        crops[idx] = sample
+    return crops
 
 
 def create_subset(config):
     """
     Creates dataset HCP_1 from HCP data
 
+    The skeletons are normalized and padded once, and cached in
+    config.cache_dir, keyed by the hash of the pickle file and by the
+    list of subjects. The dataset serves views of the memory-mapped cache.
+
     Args:
         config: instance of class Config
 
@@ -26,14 +56,58 @@ def create_subset(config):
     train_list = pd.read_csv(config.subject_dir, header=None, usecols=[0],
                              names=['subjects'])
     train_list['subjects'] = train_list['subjects'].astype('str')
+    filenames = list(train_list['subjects'])
 
-    tmp = pd.read_pickle(os.path.join(config.data_dir, "Rskeleton.pkl")).T
-    tmp.index.astype('str')
+    pickle_file = os.path.join(config.data_dir, "Rskeleton.pkl")
+    key = hashlib.sha1(json.dumps(
+        [file_hash(pickle_file), filenames, list(config.in_shape)]).encode()
+        ).hexdigest()
+    cache_file = os.path.join(config.cache_dir, f"skeleton_crops_{key}.npy")
 
-    tmp = tmp.merge(train_list, left_on = tmp.index, right_on='subjects', how='right')
+    if not os.path.isfile(cache_file):
+        tmp = pd.read_pickle(pickle_file).T
+        tmp.index.astype('str')
 
-    filenames = list(train_list['subjects'])
+        tmp = tmp.merge(train_list, left_on = tmp.index, right_on='subjects', how='right')
+
+        crops = normalize_crops(tmp, config.in_shape)
+        os.makedirs(config.cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as f:
+            np.save(f, crops)
+        os.replace(cache_file + '.tmp', cache_file)
 
-    subset = SkeletonDataset(dataframe=tmp, filenames=filenames)
+    # Copy-on-write: samples are writable views of the file
+    crops = np.load(cache_file, mmap_mode='c')
+    subset = SkeletonDataset(crops=crops, filenames=filenames)
 
     return subset
+
+
+def create_loader(config, dataset, batch_size, num_workers=None, **kwargs):
+    """
+    Creates a DataLoader with the loading parameters of config
+
+    Its workers are kept alive between epochs (config.persistent_workers)
+    and prefetch config.prefetch_factor batches each.
+
+    Args:
+        config: instance of class Config
+        dataset: torch dataset
+        batch_size: int, batch size
+        num_workers: int, number of loader workers,
+                     defaults to config.num_workers
+        kwargs: other arguments of DataLoader (shuffle, sampler, ...)
+
+    Returns:
+        loader: torch DataLoader
+    """
+    if num_workers is None:
+        num_workers = config.num_workers
+    if num_workers > 0:
+        kwargs.update(persistent_workers=config.persistent_workers,
+                      prefetch_factor=config.prefetch_factor)
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_size=batch_size,
+                                       num_workers=num_workers,
+                                       pin_memory=torch.cuda.is_available(),
+                                       **kwargs)
@@ -11,10 +11,15 @@ import itertools
 import torch
 
 from vae import ModelTester
+from vae import get_device
 from train import train_vae
+from train import train_vae_ddp
 from clustering import Cluster
+from load_data import create_loader
 from load_data import create_subset
 from config import Config
+from SimCLR.evaluation.embedding_store import EmbeddingStore
+from SimCLR.evaluation.embedding_store import file_hash
 
 
 if __name__ == '__main__':
@@ -28,25 +33,18 @@ if __name__ == '__main__':
     subset1 = create_subset(config)
     train_set, val_set = torch.utils.data.random_split(subset1,
                             [round(0.8*len(subset1)), round(0.2*len(subset1))])
-    trainloader = torch.utils.data.DataLoader(
-                  train_set,
-                  batch_size=config.batch_size,
-                  num_workers=8,
-                  shuffle=True)
-    valloader = torch.utils.data.DataLoader(
-                val_set,
-                batch_size=1,
-                num_workers=8,
-                shuffle=True)
-
-    val_label = []
-    for _, path in valloader:
-        val_label.append(path[0])
+    trainloader = create_loader(config, train_set,
+                                batch_size=config.batch_size,
+                                shuffle=True)
+    valloader = create_loader(config, val_set,
+                              batch_size=config.batch_size,
+                              shuffle=False)
+
+    # Validation subjects, in the order of valloader
+    val_label = [subset1.filenames[idx] for idx in val_set.indices]
     np.savetxt(f"{save_dir}val_label.csv", np.array(val_label), delimiter =", ", fmt ='% s')
 
-    device = "cpu"
-    if torch.cuda.is_available():
-        device = "cuda:0"
+    device = get_device()
 
     weights = [1, 2]
     class_weights = torch.FloatTensor(weights).to(device)
@@ -62,8 +60,12 @@ if __name__ == '__main__':
     print(cur_config)
 
     """ Train model for given configuration """
-    vae, final_loss_val = train_vae(config, trainloader, valloader,
-                                    root_dir=save_dir)
+    if config.nb_processes > 1:
+        vae, final_loss_val = train_vae_ddp(config, train_set, val_set,
+                                            root_dir=save_dir)
+    else:
+        vae, final_loss_val = train_vae(config, trainloader, valloader,
+                                        root_dir=save_dir)
 
     """ Evaluate model performances """
     dico_set_loaders = {'train': trainloader, 'val': valloader}
@@ -72,11 +74,17 @@ if __name__ == '__main__':
                          kl_weight=config.kl, loss_func=criterion,
                          n_latent=config.n, depth=3)
 
-    results = tester.test()
-    encoded = {loader_name:[results[loader_name][k] for k in results[loader_name].keys()] for loader_name in dico_set_loaders.keys()}
-    df_encoded = pd.DataFrame()
-    df_encoded['latent'] = encoded['train'] + encoded['val']
-    X = np.array(list(df_encoded['latent']))
+    results = tester.test(bf16=config.bf16)
+    X = np.concatenate([results[loader_name].latents
+                        for loader_name in dico_set_loaders.keys()])
+
+    store = EmbeddingStore(f"{save_dir}embedding_store",
+                           latent_size=config.n,
+                           checkpoint_hash=file_hash(f"{save_dir}vae.pt"),
+                           on_mismatch='reset',
+                           kl=config.kl)
+    store.append([subject for loader_name in dico_set_loaders.keys()
+                  for subject in results[loader_name].ids], X)
 
     cluster = Cluster(X, save_dir)
     res = cluster.plot_silhouette()
@@ -4,47 +4,33 @@
 import numpy as np
 import pandas as pd
 import torch
-import torchvision.transforms as transforms
+
+from SimCLR.utils.label_lut import LabelLUT
 
 
 class SkeletonDataset():
     """Custom dataset for skeleton images that includes image file paths.
 
     Args:
-        dataframe: dataframe containing training and testing arrays
-        filenames: optional, list of corresponding filenames
+        crops: uint8 array of size [N, c, h, w, d] of normalized and padded
+               skeletons, possibly memory-mapped
+        filenames: list of corresponding filenames
 
     Returns:
-        tuple_with_path: tuple of type (sample, filename) with sample normalized
-                         and padded
+        tuple_with_path: tuple of type (sample, filename), sample being
+                         a view of crops, without copy
     """
-    def __init__(self, dataframe, filenames=None):
-        self.df = dataframe
-        if filenames:
-            self.filenames = filenames
-        else:
-            self.filenames = None
+    def __init__(self, crops, filenames):
+        self.crops = crops
+        self.filenames = filenames
 
     def __len__(self):
-        return len(self.df)
+        return len(self.crops)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
-
-        if self.filenames:
-            filename = self.filenames[idx]
-            sample = np.expand_dims(np.squeeze(self.df.iloc[idx][0]), axis=0)
-        else:
-            filename = self.df.iloc[idx]['ID']
-            sample = self.df.iloc[idx][0]
-
-        fill_value = 0
-        self.transform = transforms.Compose([NormalizeSkeleton(),
-                         Padding([1, 20, 40, 40], fill_value=fill_value)
-                         ])
-        sample = self.transform(sample)
-        tuple_with_path = (sample, filename)
+        tuple_with_path = (self.crops[idx], self.filenames[idx])
         return tuple_with_path
 
 
@@ -57,17 +43,14 @@ class NormalizeSkeleton(object):
     def __init__(self, nb_cls=2):
         """ Initialize the instance"""
         self.nb_cls = nb_cls
-
-    def __call__(self, arr):
         if self.nb_cls==2:
-            arr[arr > 0] = 1
+            self.lut = LabelLUT.from_function(
+                lambda labels: np.where(labels > 0, 1, labels))
         else:
-            arr[arr==40]=30
-            arr[arr==70]=80
-            arr[arr==30]=1
-            arr[arr==60]=2
-            arr[arr==80]=3
-        return arr
+            self.lut = LabelLUT({40: 1, 70: 3, 30: 1, 60: 2, 80: 3})
+
+    def __call__(self, arr):
+        return self.lut(arr)
 
 
 class Padding(object):
@@ -1,21 +1,64 @@
 # -*- coding: utf-8 -*-
 # /usr/bin/env python3
 
+import contextlib
+import os
+import shutil
+
 import numpy as np
 import pandas as pd
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
 from torchsummary import summary
 
 from vae import *
 from deep_folding.utils.pytorchtools import EarlyStopping
+from load_data import create_loader
+from SimCLR.utils.cpu_parallel import node_partition
+from SimCLR.utils.snapshots import SnapshotWriter
+
+
+def autocast(device, config):
+    """ Returns the autocast context of the forward passes
+
+    float16 on GPU if config.amp, bfloat16 on CPU if config.bf16
+    """
+    if torch.device(device).type == "cuda":
+        return torch.autocast(device_type="cuda", dtype=torch.float16,
+                              enabled=config.amp)
+    return cpu_autocast(device, config.bf16)
+
+
+def grad_scaler(enabled):
+    """ Returns the loss scaler of float16 gradients, on GPU
+
+    torch.amp.GradScaler replaces torch.cuda.amp.GradScaler in torch >= 2.3
+    """
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+@contextlib.contextmanager
+def null_context():
+    """ Context doing nothing (contextlib.nullcontext needs python >= 3.7)
+    """
+    yield
 
 
-def train_vae(config, trainloader, valloader, root_dir=None):
+def train_vae(config, trainloader, valloader, root_dir=None,
+              rank=0, world_size=1):
     """ Trains beta-VAE for a given hyperparameter configuration
     Args:
         config: instance of class Config
         trainloader: torch loader of training data
         valloader: torch loader of validation data
         root_dir: str, directory where to save model
+        rank: int, rank of the process in data-parallel training
+        world_size: int, number of processes in data-parallel training;
+            the process group must have been initialized when > 1
 
     Returns:
         vae: trained model
@@ -24,94 +67,144 @@ def train_vae(config, trainloader, valloader, root_dir=None):
     torch.manual_seed(0)
     lr = config.lr
     vae = VAE(config.in_shape, config.n, depth=3)
-    device = "cpu"
-    if torch.cuda.is_available():
-        device = "cuda:0"
+    # Data-parallel processes use the gloo backend, on CPU
+    device = get_device() if world_size == 1 else "cpu"
     vae.to(device)
-    summary(vae, config.in_shape)
+    if rank == 0:
+        summary(vae, config.in_shape, device=device.split(':')[0])
+    # Gradients are averaged between processes at each backward pass
+    model = DistributedDataParallel(vae) if world_size > 1 else vae
+    if config.compile:
+        if hasattr(torch, "compile"):
+            model = torch.compile(model)
+        else:
+            print("torch.compile needs torch >= 2.0: model not compiled")
 
     weights = [1, 2]
     class_weights = torch.FloatTensor(weights).to(device)
     criterion = nn.CrossEntropyLoss(weight=class_weights, reduction='sum')
     optimizer = torch.optim.Adam(vae.parameters(), lr=lr)
+    # Loss scaling of float16 gradients, on GPU only
+    scaler = grad_scaler(config.amp and torch.device(device).type == "cuda")
 
     nb_epoch = config.nb_epoch
     early_stopping = EarlyStopping(patience=12, verbose=True, root_dir=root_dir)
 
     list_loss_train, list_loss_val = [], []
 
-    # arrays enabling to see model reconstructions
-    id_arr, phase_arr, input_arr, output_arr = [], [], [], []
+    # store enabling to see model reconstructions, replaced at each training
+    snapshots = None
+    if rank == 0:
+        shutil.rmtree(config.save_dir + 'snapshots', ignore_errors=True)
+        snapshots = SnapshotWriter(config.save_dir + 'snapshots',
+                                   budget=config.nb_snapshots)
 
     for epoch in range(config.nb_epoch):
-        running_loss = 0.0
+        vae.train()
+        if isinstance(trainloader.sampler, DistributedSampler):
+            trainloader.sampler.set_epoch(epoch)
+        # Losses are summed on the device, without synchronization
+        running_loss = torch.zeros((), device=device)
         epoch_steps = 0
+        nb_steps = len(trainloader)
+        # The last group of the epoch may be shorter
+        last_group_start = nb_steps - (nb_steps % config.accumulation_steps
+                                       or config.accumulation_steps)
+        optimizer.zero_grad(set_to_none=True)
         for inputs, path in trainloader:
-            optimizer.zero_grad()
+            epoch_steps += 1
+            # Gradients are accumulated over config.accumulation_steps
+            # batches; processes synchronize them only before the update
+            update = epoch_steps % config.accumulation_steps == 0 \
+                or epoch_steps == nb_steps
+            group_steps = config.accumulation_steps
+            if epoch_steps > last_group_start:
+                group_steps = nb_steps - last_group_start
+            sync = null_context()
+            if world_size > 1 and not update:
+                sync = model.no_sync()
 
-            inputs = Variable(inputs).to(device, dtype=torch.float32)
+            inputs = inputs.to(device, dtype=torch.float32,
+                               non_blocking=True)
             target = torch.squeeze(inputs, dim=1).long()
-            output, z, logvar = vae(inputs)
-            recon_loss, kl, loss = vae_loss(output, target, z,
-                                    logvar, criterion,
-                                    kl_weight=config.kl)
-            output = torch.argmax(output, dim=1)
-            loss.backward()
-            optimizer.step()
-
-            running_loss += loss.item()
-            epoch_steps += 1
-        print("[%d] loss: %.3f" % (epoch + 1,
-                                        running_loss / epoch_steps))
-        list_loss_train.append(running_loss / epoch_steps)
-        running_loss = 0.0
+            with sync:
+                with autocast(device, config):
+                    output, z, logvar = model(inputs)
+                output, z, logvar = output.float(), z.float(), logvar.float()
+                recon_loss, kl, loss = vae_loss(output, target, z,
+                                        logvar, criterion,
+                                        kl_weight=config.kl)
+                scaler.scale(loss / group_steps).backward()
+            if update:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+            running_loss += loss.detach()
+        train_loss = running_loss.item() / epoch_steps
+        if rank == 0:
+            print("[%d] loss: %.3f" % (epoch + 1, train_loss))
+        list_loss_train.append(train_loss)
 
         """ Saving of reconstructions for visualization in Anatomist software """
-        if epoch == nb_epoch-1:
-            for k in range(len(path)):
-                id_arr.append(path[k])
-                phase_arr.append('train')
-                input_arr.append(np.array(np.squeeze(inputs[k]).cpu().detach().numpy()))
-                output_arr.append(np.squeeze(output[k]).cpu().detach().numpy())
-
-        # Validation loss
-        val_loss = 0.0
-        val_steps = 0
-        total = 0
+        if epoch == nb_epoch-1 and rank == 0:
+            snapshots.add(path, inputs[:, 0], torch.argmax(output, dim=1),
+                          phase='train')
+
+        # Validation loss, per sample
+        val_loss = torch.zeros((), device=device)
+        val_samples = 0
         vae.eval()
         for inputs, path in valloader:
             with torch.no_grad():
-                inputs = Variable(inputs).to(device, dtype=torch.float32)
-                output, z, logvar = vae(inputs)
+                inputs = inputs.to(device, dtype=torch.float32,
+                                   non_blocking=True)
+                with autocast(device, config):
+                    output, z, logvar = vae(inputs)
+                output, z, logvar = output.float(), z.float(), logvar.float()
                 target = torch.squeeze(inputs, dim=1).long()
                 recon_loss_val, kl_val, loss = vae_loss(output, target,
                                         z, logvar, criterion,
                                         kl_weight=config.kl)
-                output = torch.argmax(output, dim=1)
 
-                val_loss += loss.cpu().numpy()
-                val_steps += 1
-        valid_loss = val_loss / val_steps
-        print("[%d] validation loss: %.3f" % (epoch + 1, valid_loss))
+                val_loss += loss
+                val_samples += len(path)
+        val_loss = val_loss.item()
+        if world_size > 1:
+            # Validation loss over the shards of all processes
+            val_total = torch.tensor([val_loss, val_samples],
+                                     dtype=torch.float64)
+            dist.all_reduce(val_total)
+            val_loss, val_samples = val_total.tolist()
+        valid_loss = val_loss / val_samples
         list_loss_val.append(valid_loss)
 
-        early_stopping(valid_loss, vae)
+        # Early stopping is decided and checkpointed by the first process
+        early_stop = False
+        if rank == 0:
+            print("[%d] validation loss: %.3f" % (epoch + 1, valid_loss))
+            early_stopping(valid_loss, vae)
+            early_stop = early_stopping.early_stop
+        if world_size > 1:
+            flag = torch.tensor([early_stop], dtype=torch.uint8)
+            dist.broadcast(flag, src=0)
+            early_stop = bool(flag.item())
 
         """ Saving of reconstructions for visualization in Anatomist software """
-        if early_stopping.early_stop or epoch == nb_epoch-1:
-            for k in range(len(path)):
-                id_arr.append(path[k])
-                phase_arr.append('val')
-                input_arr.append(np.array(np.squeeze(inputs[k]).cpu().detach().numpy()))
-                output_arr.append(np.squeeze(output[k]).cpu().detach().numpy())
+        if early_stop or epoch == nb_epoch-1:
+            if rank == 0:
+                snapshots.add(path, inputs[:, 0],
+                              torch.argmax(output, dim=1), phase='val')
             break
-    for key, array in {'input': input_arr, 'output' : output_arr,
-                           'phase': phase_arr, 'id': id_arr}.items():
-        np.save(config.save_dir+key, np.array([array]))
+
+    final_loss_val = list_loss_val[-1:]
+    if rank != 0:
+        return vae, final_loss_val
+
+    snapshots.close()
 
     plot_loss(list_loss_train[1:], config.save_dir+'tot_train_')
     plot_loss(list_loss_val[1:], config.save_dir+'tot_val_')
-    final_loss_val = list_loss_val[-1:]
 
     """Saving of trained model"""
     torch.save((vae.state_dict(), optimizer.state_dict()),
@@ -119,3 +212,70 @@ def train_vae(config, trainloader, valloader, root_dir=None):
 
     print("Finished Training")
     return vae, final_loss_val
+
+
+def _train_vae_process(rank, config, train_set, val_set, root_dir, queue):
+    """ Trains beta-VAE in process rank of train_vae_ddp """
+    world_size = config.nb_processes
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    worker_init_fn = None
+    if config.pin_cores:
+        partition = node_partition(world_size,
+                                   config.loader_cores_per_process)
+        partition.pin_process(rank)
+        worker_init_fn = partition.worker_init_fn(rank)
+
+    # Each process trains on its own shard of the training set
+    trainloader = create_loader(
+                  config, train_set,
+                  batch_size=config.batch_size,
+                  sampler=DistributedSampler(train_set, shuffle=True),
+                  num_workers=config.loader_cores_per_process,
+                  worker_init_fn=worker_init_fn)
+    valloader = create_loader(
+                config, val_set,
+                batch_size=config.batch_size,
+                sampler=DistributedSampler(val_set, shuffle=False),
+                num_workers=config.loader_cores_per_process,
+                worker_init_fn=worker_init_fn)
+
+    _, final_loss_val = train_vae(config, trainloader, valloader,
+                                  root_dir=root_dir,
+                                  rank=rank, world_size=world_size)
+    if rank == 0:
+        queue.put(final_loss_val)
+    dist.destroy_process_group()
+
+
+def train_vae_ddp(config, train_set, val_set, root_dir=None):
+    """ Trains beta-VAE on CPU with config.nb_processes processes
+
+    The processes are data-parallel (torch DDP, gloo backend):
+    each process has config.batch_size samples per batch.
+    With config.pin_cores, each process is pinned to its own cores,
+    split between its loader workers and its compute threads.
+
+    Args:
+        config: instance of class Config
+        train_set: torch dataset of training data
+        val_set: torch dataset of validation data
+        root_dir: str, directory where to save model
+
+    Returns:
+        vae: trained model
+        final_loss_val
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    queue = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_train_vae_process,
+             args=(config, train_set, val_set, root_dir, queue),
+             nprocs=config.nb_processes,
+             join=True)
+    final_loss_val = queue.get()
+
+    vae = VAE(config.in_shape, config.n, depth=3)
+    state_dict, _ = torch.load(config.save_dir + 'vae.pt')
+    vae.load_state_dict(state_dict)
+    vae.to(get_device())
+    return vae, final_loss_val
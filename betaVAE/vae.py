@@ -1,17 +1,32 @@
 # -*- coding: utf-8 -*-
 # /usr/bin/env python3
 
+from collections import namedtuple
 from collections import OrderedDict
 import numpy as np
 import torch
 import pandas as pd
-from torch.autograd import Variable
 import torch.nn as nn
 
 from deep_folding.utils.pytorchtools import EarlyStopping
 from postprocess import plot_loss
 
 
+def get_device():
+    """ Returns the device of the model: cuda:0 if available, cpu otherwise
+    """
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def cpu_autocast(device, enabled=True):
+    """ Returns a bfloat16 autocast context on CPU
+
+    It is disabled on other devices.
+    """
+    return torch.autocast(device_type="cpu", dtype=torch.bfloat16,
+                          enabled=enabled and torch.device(device).type == "cpu")
+
+
 class VAE(nn.Module):
     """ beta-VAE class
     """
@@ -85,9 +100,8 @@ class VAE(nn.Module):
                 nn.init.constant_(module.bias, 0)
 
     def sample_z(self, mean, logvar):
-        device = torch.device("cuda", index=0)
         stddev = torch.exp(0.5 * logvar)
-        noise = Variable(torch.randn(stddev.size(), device=device))
+        noise = torch.randn_like(stddev)
         return (noise * stddev) + mean
 
     def encode(self, x):
@@ -104,9 +118,15 @@ class VAE(nn.Module):
         out = self.decoder(out)
         return out
 
-    def forward(self, x):
+    def forward(self, x, sample=True):
+        """
+        Args:
+            x: input batch
+            sample: bool, if False, the latent mean is decoded
+                    without sampling (deterministic inference)
+        """
         mean, logvar = self.encode(x)
-        z = self.sample_z(mean, logvar)
+        z = self.sample_z(mean, logvar) if sample else mean
         out = self.decode(z)
         return out, mean, logvar
 
@@ -117,6 +137,18 @@ def vae_loss(output, input, mean, logvar, loss_func, kl_weight):
     return recon_loss, kl_loss, recon_loss + kl_weight * kl_loss
 
 
+TestResults = namedtuple('TestResults',
+                         ['ids', 'latents', 'loss', 'inputs', 'outputs'])
+TestResults.__doc__ = """Results of ModelTester.test on one loader
+
+    ids: list of the N subject IDs, in the order of the rows
+    latents: float32 array of size [N, n_latent] of the latent means
+    loss: mean loss per subject
+    inputs, outputs: uint8 arrays of size [N, h, w, d] of the inputs and
+        of their reconstructions, or None if not kept
+"""
+
+
 class ModelTester():
     """
     Class to test data with a trained model
@@ -132,12 +164,6 @@ class ModelTester():
             loss_func: reconstruction criterion
             n_latent: size of latent space
             depth: depth of the model
-
-        Returns:
-            results: dictionnary of type:
-                {"test_set_1": {"x1": latent_embedding_x1},
-                               {"x2": latent_embedding_x2}
-                }
         """
         self.model = model
         self.dico_set_loaders = dico_set_loaders
@@ -146,32 +172,63 @@ class ModelTester():
         self.depth = depth
         self.loss_func = loss_func
 
-    def test(self):
-        id_arr, input_arr, phase_arr, output_arr = [], [], [], []
-        self.list_loss_train, self.list_loss_val = [], []
-        device = torch.device("cuda", index=0)
+    def test(self, keep_reconstructions=False, bf16=False):
+        """ Computes the latent embeddings of all loaders
+
+        Batches stay on the device: latents are copied once per batch
+        into arrays allocated beforehand. The latent means are decoded
+        without sampling, so that results are deterministic.
 
-        results = {k:{} for k in self.dico_set_loaders.keys()}
-        out_z = []
+        Args:
+            keep_reconstructions: bool, if True, the inputs and their
+                                  reconstructions are also returned
+            bf16: bool, if True, the model runs in bfloat16 on CPU
+
+        Returns:
+            results: dictionnary of type:
+                {"test_set_1": TestResults(ids, latents, ...)}
+        """
+        device = next(self.model.parameters()).device
+        results = {}
 
+        self.model.eval()
         for loader_name, loader in self.dico_set_loaders.items():
-            self.model.eval()
+            nb_subjects = len(loader.dataset)
+            ids = []
+            latents = np.empty((nb_subjects, self.n_latent), dtype=np.float32)
+            inputs_arr, outputs_arr = None, None
+            if keep_reconstructions:
+                inputs_arr = np.empty((nb_subjects,) + tuple(self.model.in_shape[1:]),
+                                      dtype=np.uint8)
+                outputs_arr = np.empty_like(inputs_arr)
+            total_loss = torch.zeros((), device=device)
+
+            start = 0
             with torch.no_grad():
                 for inputs, path in loader:
-                    inputs = Variable(inputs).to(device, dtype=torch.float32)
-                    output, z, logvar = self.model(inputs)
+                    inputs = inputs.to(device, dtype=torch.float32)
+                    with cpu_autocast(device, bf16):
+                        output, z, logvar = self.model(inputs, sample=False)
+                    output, z, logvar = output.float(), z.float(), logvar.float()
                     target = torch.squeeze(inputs, dim=1).long()
-                    recon_loss_val, kl_val, loss_val = vae_loss(output, target, z, logvar, self.loss_func,
-                                     kl_weight=self.kl_weight)
-                    output = torch.argmax(output, dim=1)
-
-                    for k in range(len(path)):
-                        id_arr.append(path)
-                        input_arr.append(np.array(np.squeeze(inputs).cpu().detach().numpy()))
-                        output_arr.append(np.squeeze(output).cpu().detach().numpy())
-                        phase_arr.append(loader_name)
-                        out_z = np.array(np.squeeze(z[k]).cpu().detach().numpy())
-
-                        results[loader_name][path[k]] = out_z
+                    _, _, loss = vae_loss(output, target, z, logvar,
+                                          self.loss_func,
+                                          kl_weight=self.kl_weight)
+                    total_loss += loss
+
+                    stop = start + len(path)
+                    latents[start:stop] = z.cpu().numpy()
+                    if keep_reconstructions:
+                        inputs_arr[start:stop] = target.cpu().numpy()
+                        outputs_arr[start:stop] = \
+                            torch.argmax(output, dim=1).cpu().numpy()
+                    ids.extend(path)
+                    start = stop
+
+            results[loader_name] = TestResults(
+                ids=ids, latents=latents[:start],
+                loss=total_loss.item() / max(start, 1),
+                inputs=None if inputs_arr is None else inputs_arr[:start],
+                outputs=None if outputs_arr is None else outputs_arr[:start])
 
         return results
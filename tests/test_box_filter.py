@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the separable box filter of the evaluation"""
+import pytest
+import torch
+import torch.nn.functional as F
+
+pytest.importorskip("pytorch_ssim")
+
+from SimCLR.evaluation.eval_tools import box_filter_3d  # noqa: E402
+
+
+def dense_box_filter(volume, size):
+    """Sum over size**3 cubes with a dense ones kernel, channel by channel"""
+    nb_channels = volume.shape[1]
+    weight = torch.ones([nb_channels, 1, size, size, size],
+                        dtype=volume.dtype)
+    return F.conv3d(volume, weight, padding=size // 2, groups=nb_channels)
+
+
+@pytest.mark.parametrize("size", [1, 3, 11])
+@pytest.mark.parametrize("nb_channels", [1, 2])
+def test_box_filter_matches_dense_kernel(size, nb_channels):
+    torch.manual_seed(0)
+    volume = torch.randn(3, nb_channels, 13, 9, 15, dtype=torch.float64)
+    out = box_filter_3d(volume, size=size)
+    assert out.shape == volume.shape
+    torch.testing.assert_close(out, dense_box_filter(volume, size))
+
+
+def test_box_filter_float32():
+    torch.manual_seed(0)
+    volume = torch.randn(2, 1, 20, 20, 20)
+    torch.testing.assert_close(box_filter_3d(volume, size=11),
+                               dense_box_filter(volume, 11),
+                               rtol=1e-4, atol=1e-4)
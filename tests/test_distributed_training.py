@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of distributed training on CPU, with the gloo backend
+
+The processes are spawned on the local host; no GPU is needed.
+"""
+import json
+import multiprocessing
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+pytest.importorskip("pytorch_lightning")
+
+from omegaconf import OmegaConf  # noqa: E402
+
+from SimCLR.backbones.sync_batchnorm import CPUSyncBatchNorm  # noqa: E402
+from SimCLR.data.datamodule import DataModule  # noqa: E402
+from SimCLR.models.contrastive_learner import ContrastiveLearner  # noqa: E402
+
+_TIMEOUT = 600
+
+
+def _free_port():
+    """Returns a port that is free on the local host"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _init_gloo(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+
+def _loss_weights(inputs):
+    """Weights of a linear loss of the normalized batch"""
+    return torch.linspace(-1., 1., inputs.numel()).view(inputs.shape)
+
+
+def _sync_batchnorm_process(rank, world_size, port, inputs, result_file):
+    """Normalizes the shard rank of inputs; rank 0 saves the results"""
+    _init_gloo(rank, world_size, port)
+    torch.manual_seed(0)
+    norm = CPUSyncBatchNorm.convert_sync_batchnorm(torch.nn.BatchNorm3d(3))
+    shard = inputs.chunk(world_size)[rank].clone().requires_grad_()
+    out = norm(shard)
+    # Loss of the whole batch, as sum of the losses of the shards
+    (out * _loss_weights(inputs).chunk(world_size)[rank]).sum().backward()
+    outputs = [torch.zeros_like(out) for _ in range(world_size)]
+    grads = [torch.zeros_like(shard) for _ in range(world_size)]
+    dist.all_gather(outputs, out.detach())
+    dist.all_gather(grads, shard.grad)
+    if rank == 0:
+        torch.save({'output': torch.cat(outputs),
+                    'grad': torch.cat(grads),
+                    'weight_grad': norm.weight.grad,
+                    'running_mean': norm.running_mean,
+                    'running_var': norm.running_var}, result_file)
+    dist.destroy_process_group()
+
+
+def test_cpu_sync_batchnorm_matches_full_batch(tmp_path):
+    torch.manual_seed(1)
+    inputs = torch.randn(8, 3, 4, 4, 4) * 2 + 1
+    result_file = str(tmp_path / "result.pt")
+    mp.spawn(_sync_batchnorm_process,
+             args=(2, _free_port(), inputs, result_file),
+             nprocs=2, join=True)
+    result = torch.load(result_file)
+
+    norm = torch.nn.BatchNorm3d(3)
+    full = inputs.clone().requires_grad_()
+    out = norm(full)
+    (out * _loss_weights(inputs)).sum().backward()
+    # Each process back-propagates the loss of its shard: the gradient
+    # of the weights is the sum over the processes, reduced by DDP
+    assert torch.allclose(result['output'], out, atol=1e-5)
+    assert torch.allclose(result['grad'], full.grad, atol=1e-5)
+    assert torch.allclose(result['running_mean'], norm.running_mean)
+    assert torch.allclose(result['running_var'], norm.running_var)
+
+
+class RandomCropsModule(DataModule):
+    """Random binary crops, with two views per subject"""
+
+    def setup(self, stage=None, mode=None):
+        generator = torch.Generator().manual_seed(0)
+        crops = (torch.rand(16, 2, 1, 12, 12, 12,
+                            generator=generator) > 0.7).float()
+        dataset = [(crop, f"sub-{i}") for i, crop in enumerate(crops)]
+        self.dataset_train = dataset
+        self.dataset_val = dataset[:8]
+        self.dataset_test = dataset[:8]
+
+
+class RecordingLearner(ContrastiveLearner):
+    """Contrastive learner saving its BatchNorm running means at train end
+
+    The means of all processes are saved by the first one,
+    in the folder of its logger.
+    """
+
+    def on_train_end(self):
+        means = torch.cat([module.running_mean for module in self.modules()
+                           if isinstance(module, CPUSyncBatchNorm)])
+        gathered = [torch.zeros_like(means)
+                    for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, means)
+        if self.global_rank == 0:
+            with open(f"{self.logger.save_dir}/running_means.json", 'w') as f:
+                json.dump([m.tolist() for m in gathered], f)
+        super(RecordingLearner, self).on_train_end()
+
+
+def _train(tmp_dir):
+    """Trains the contrastive learner on 2 CPU processes"""
+    from pytorch_lightning import loggers as pl_loggers
+
+    import SimCLR.main
+    config = OmegaConf.create(dict(
+        growth_rate=8, block_config=[2], num_init_features=8,
+        num_representation_features=8, num_outputs=8, drop_rate=0.,
+        input_size=[1, 12, 12, 12], batch_size=4, pin_mem=False,
+        num_cpu_workers=0, seed=0, lr=1e-4, weight_decay=0.,
+        temperature=0.1, max_epochs=2, nb_epochs_per_tSNE=1,
+        nb_steps_per_flush_logs=1, log_every_n_steps=1,
+        checkpoint_path=None, device='cpu', renderer='numpy',
+        nb_renderers=1, accelerator='cpu', devices=2, num_nodes=1,
+        strategy='ddp_spawn', sync_batchnorm=True))
+    SimCLR.main.DataModule = RandomCropsModule
+    SimCLR.main.ContrastiveLearner = RecordingLearner
+    logger = pl_loggers.TensorBoardLogger(tmp_dir)
+    SimCLR.main.train_model(config, logger=logger)
+
+
+def test_ddp_gloo_sync_batchnorm_training(tmp_path):
+    # Epoch-end visualizations run on the first process only:
+    # the training hangs if they synchronize the BatchNorm layers.
+    # Training runs in its own process, so that a hang fails the test
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=_train, args=(str(tmp_path),))
+    process.start()
+    process.join(_TIMEOUT)
+    if process.is_alive():
+        process.terminate()
+        raise AssertionError(f"Training did not end in {_TIMEOUT} s")
+    assert process.exitcode == 0
+
+    with open(tmp_path / "running_means.json") as f:
+        running_means = json.load(f)
+    assert len(running_means) == 2
+    assert torch.allclose(torch.tensor(running_means[0]),
+                          torch.tensor(running_means[1]))
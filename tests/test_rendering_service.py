@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the rendering service, with stand-in renderers
+
+Anatomist is not needed: StandInRenderer plays the part of a renderer.
+"""
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from SimCLR.utils.plots.rendering_service import NumpyRenderer
+from SimCLR.utils.plots.rendering_service import RenderingService
+
+
+class StandInRenderer:
+    """Renders a volume as a small image filled with the sum of the volume
+
+    Renderings take a random time, so that they finish out of order.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+
+    def render(self, volume):
+        time.sleep(random.uniform(0., 0.02))
+        return torch.full((3, 4, 4), float(np.sum(volume)))
+
+
+class PidRenderer:
+    """Renders the process id of the renderer"""
+
+    def render(self, volume):
+        return torch.full((3, 1, 1), float(os.getpid()))
+
+
+class BrokenRenderer:
+    """Renderer that cannot be created, as Anatomist without display"""
+
+    def __init__(self):
+        raise RuntimeError("no display")
+
+    def render(self, volume):
+        raise AssertionError("never called")
+
+
+class ThreadRenderer:
+    """Renders the identifier of the thread that created the renderer"""
+
+    threads = set()
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        ThreadRenderer.threads.add(self.thread)
+
+    def render(self, volume):
+        assert threading.get_ident() == self.thread
+        return torch.full((3, 1, 1), float(self.thread % 1000003))
+
+
+class CrashingRenderer:
+    """Renderer whose process dies, as Anatomist on a segfault"""
+
+    def render(self, volume):
+        if np.sum(volume):
+            os._exit(1)
+        return torch.zeros((3, 1, 1))
+
+
+def volumes(nb_volumes):
+    """Volumes whose sums are 0, 1, ..., nb_volumes - 1"""
+    vols = np.zeros((nb_volumes, 2, 3, 4), dtype=np.int16)
+    vols[:, 0, 0, 0] = np.arange(nb_volumes)
+    return vols
+
+
+def test_render_batch_keeps_order_in_threads():
+    service = RenderingService(StandInRenderer, nb_renderers=4)
+    images = service.render_batch(volumes(20))
+    service.close()
+    assert images.shape == (20, 3, 4, 4)
+    assert images[:, 0, 0, 0].tolist() == list(range(20))
+
+
+def test_render_batch_keeps_order_in_process():
+    service = RenderingService(StandInRenderer, isolated=True)
+    images = service.render_batch(torch.from_numpy(volumes(10)))
+    service.close()
+    assert images[:, 0, 0, 0].tolist() == list(range(10))
+
+
+def test_isolated_renderer_runs_in_its_own_process():
+    service = RenderingService(PidRenderer, isolated=True)
+    image = service.submit(np.zeros((2, 2, 2))).result()
+    service.close()
+    assert int(image[0, 0, 0]) != os.getpid()
+
+
+def test_fallback_to_numpy_renderer():
+    for isolated in (False, True):
+        service = RenderingService(BrokenRenderer, isolated=isolated)
+        volume = np.zeros((4, 4, 4), dtype=np.int16)
+        volume[1:3, 1:3, 1:3] = 1
+        images = service.render_batch([volume, volume])
+        service.close()
+        expected = NumpyRenderer().render(volume)
+        assert images.shape == (2,) + tuple(expected.shape)
+        assert torch.equal(images[0], expected)
+
+
+def test_submit_batch_renders_first_volume():
+    service = RenderingService(StandInRenderer)
+    img = torch.from_numpy(volumes(3)).unsqueeze(1)
+    image = service.submit_batch(img[1:]).result()
+    service.close()
+    assert float(image[0, 0, 0]) == 1.
+
+
+def test_renderer_process_death_fails_futures():
+    service = RenderingService(CrashingRenderer, isolated=True)
+    futures = [service.submit(volume) for volume in volumes(4)]
+    assert torch.equal(futures[0].result(timeout=60), torch.zeros((3, 1, 1)))
+    for future in futures[1:]:
+        with pytest.raises(RuntimeError, match="died"):
+            future.result(timeout=60)
+    with pytest.raises(RuntimeError, match="died"):
+        service.submit(volumes(1)[0]).result(timeout=60)
+    service.close()
+
+
+def test_one_renderer_per_thread():
+    service = RenderingService(ThreadRenderer, nb_renderers=3)
+    images = service.render_batch(volumes(12))
+    service.close()
+    assert len(set(images[:, 0, 0, 0].tolist())) <= 3
+    assert len(ThreadRenderer.threads) == 3